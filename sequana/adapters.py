@@ -72,7 +72,11 @@ See :class:`FindAdaptersFromDesign` for details.
 """
 import os
 
+from sequana.lazy import numpy as np
+from sequana.lazy import pandas as pd
+from sequana.lazy import pylab
 from sequana.fasta import FastA
+from sequana.kmer import encode_kmers, _to_buffer
 from sequana.datatools import sequana_data
 #from sequana import logger
 
@@ -365,6 +369,13 @@ class AdapterReader(object):
             self._data = [self._to_read(this) for this in filename]
 
         self._sanity_check()
+        self._reset()
+
+    def _reset(self):
+        # the k-mer index of the sequences and the identifier fields are
+        # built on request (must be reset if the data is modified)
+        self._index = None
+        self._fields = None
 
     def __len__(self):
         return len(self._data)
@@ -428,8 +439,13 @@ class AdapterReader(object):
 
         If the subsequence is short, it may return more than 1 adapters. Besides,
         the sequence is searched for without position information right now.
+
+        Adapters are searched for using a k-mer index (see
+        :class:`AdapterIndex`) built on the first call.
         """
-        found = [i for i,x in enumerate(self.sequences) if subsequence in x]
+        if self._index is None:
+            self._index = AdapterIndex(self)
+        found = self._index.get_adapters(subsequence)
         if len(found) == 0:
             return None
 
@@ -485,13 +501,18 @@ class AdapterReader(object):
 
         """
         # there should be only one
+        if self._fields is None:
+            self._fields = {}
+            for i, this in enumerate(self._data):
+                for field in set(this.identifier.split("|")):
+                    self._fields.setdefault(field, []).append(i)
         adapters = []
-        for this in self._data:
-            if prefix + str(index_name) in this.identifier.split("|"):
-                this_adapter = Adapter(identifier=this.identifier,
-                                       sequence=this.sequence,
-                                       comment=this.comment)
-                adapters.append(this_adapter)
+        for i in self._fields.get(prefix + str(index_name), []):
+            this = self._data[i]
+            this_adapter = Adapter(identifier=this.identifier,
+                                   sequence=this.sequence,
+                                   comment=this.comment)
+            adapters.append(this_adapter)
 
         if len(adapters) == 0:
             return None
@@ -587,6 +608,7 @@ class AdapterReader(object):
             fields = this.identifier.split("|")
             identifier = "|".join([self._reverse(field) for field in fields])
             this.identifier = identifier
+        self._reset()
 
     def reverse_complement(self):
         """Reverse-complement all sequences inplace
@@ -609,6 +631,7 @@ class AdapterReader(object):
             fields = this.identifier.split("|")
             identifier = "|".join([self._reverse_comp(field) for field in fields])
             this.identifier = identifier
+        self._reset()
 
     def to_fasta(self, filename):
         """Save sequences into fasta file"""
@@ -624,6 +647,266 @@ class AdapterReader(object):
                                             this.sequence))
 
 
+class AdapterIndex(object):
+    """K-mer index of a set of adapters
+
+    All k-mers of the adapters are stored in a sorted array so that
+
+    - adapters containing a sequence are found in O(length) using the first
+      k-mer of the sequence as a seed (:meth:`get_adapters`),
+    - all k-mers of a batch of reads are searched for at once with numpy
+      (:meth:`scan`).
+
+    ::
+
+        from sequana.adapters import AdapterIndex
+        index = AdapterIndex(["Nextera", "TruSeq"])
+        index.get_adapters("CTGTCTCTTATACACATCT")
+
+    By default, forward and reverse complement adapters of all types
+    available in Sequana (see :func:`get_sequana_adapters`) are indexed.
+    """
+    def __init__(self, adapters=None, k=12):
+        """.. rubric:: constructor
+
+        :param adapters: a type of adapters (e.g. Nextera), a FASTA file, an
+            :class:`AdapterReader` or a list of those. All Sequana adapters
+            if None.
+        :param int k: length of the k-mers (up to 31). Sequences shorter than
+            k are searched for linearly.
+        """
+
+        if k < 1 or k > 31:
+            raise ValueError("k must be between 1 and 31")
+        self.k = k
+        if adapters is None:
+            adapters = sorted(_get_registered_adapters())
+        if not isinstance(adapters, (list, tuple)):
+            adapters = [adapters]
+
+        self.identifiers, self.sequences, self.sources = [], [], []
+        registered = _get_registered_adapters()
+        for this in adapters:
+            if isinstance(this, str) and this in registered:
+                for direction in ("fwd", "revcomp"):
+                    self._add(get_sequana_adapters(this, direction),
+                        "%s_%s" % (this, direction))
+            elif isinstance(this, str):
+                source = os.path.basename(this).replace("adapters_", "")
+                self._add(this, source.rsplit(".", 1)[0])
+            else:
+                self._add(this, "")
+
+        buf, offsets = _to_buffer(self.sequences)
+        kmers, positions = encode_kmers(buf, offsets, k=k,
+            return_positions=True)
+        adapter = np.searchsorted(offsets, positions, "right") - 1
+        order = np.lexsort((adapter, kmers))
+        self._kmers = kmers[order]
+        self._adapters = adapter[order]
+        self._offsets = (positions - offsets[adapter])[order]
+
+        # k-mers shared by the same set of adapters belong to the same group
+        self._unique, starts = np.unique(self._kmers, return_index=True)
+        groups = {}
+        self._kmer_groups = np.zeros(len(self._unique), dtype=np.int64)
+        for i, members in enumerate(np.split(self._adapters, starts[1:])):
+            members = tuple(np.unique(members))
+            self._kmer_groups[i] = groups.setdefault(members, len(groups))
+        self.groups = sorted(groups, key=groups.get)
+
+    def _add(self, adapters, source):
+        reader = AdapterReader(adapters)
+        self.identifiers.extend(reader.identifiers)
+        self.sequences.extend(reader.sequences)
+        self.sources.extend([source] * len(reader))
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def get_adapters(self, subsequence):
+        """Return indices of the adapters containing a sequence
+
+        :param str subsequence: a sequence (ACGT letters)
+        :return: sorted list of adapter indices (see :attr:`identifiers`)
+        """
+
+        L = len(subsequence)
+        kmers, positions = encode_kmers([subsequence], k=self.k,
+            return_positions=True)
+        if len(kmers) == 0:
+            # too short or no valid k-mer
+            return [i for i, x in enumerate(self.sequences) if subsequence in x]
+        kmer, position = kmers[0], positions[0]
+        start = np.searchsorted(self._kmers, kmer, "left")
+        end = np.searchsorted(self._kmers, kmer, "right")
+        found = set()
+        for adapter, offset in zip(self._adapters[start:end],
+                self._offsets[start:end]):
+            first = offset - position
+            if first >= 0 and \
+                    self.sequences[adapter][first:first + L] == subsequence:
+                found.add(int(adapter))
+        return sorted(found)
+
+    def scan(self, sequences, offsets=None):
+        """Search for adapter k-mers in a batch of sequences
+
+        :param sequences: list of sequences or a uint8 buffer of concatenated
+            sequences (see :class:`sequana.fastq.FastQBatch`)
+        :param offsets: offsets of the sequences if *sequences* is a buffer
+        :return: three arrays with one entry per k-mer found: the sequence
+            index, the position in the sequence and the group of adapters
+            that contain the k-mer (see :attr:`groups`). Sorted by sequence
+            and position.
+        """
+
+        if offsets is None:
+            sequences, offsets = _to_buffer(sequences)
+        kmers, positions = encode_kmers(sequences, offsets, k=self.k,
+            return_positions=True)
+        index = np.searchsorted(self._unique, kmers)
+        index[index == len(self._unique)] = 0
+        found = self._unique[index] == kmers if len(self._unique) else \
+            np.zeros(len(kmers), dtype=bool)
+        positions = positions[found]
+        reads = np.searchsorted(offsets, positions, "right") - 1
+        return reads, positions - offsets[reads], self._kmer_groups[index[found]]
+
+
+class AdapterContent(object):
+    """Accumulate the adapter content of reads
+
+    ::
+
+        from sequana.adapters import AdapterContent
+        from sequana.fastq import FastQBlockReader
+        content = AdapterContent()
+        for batch in FastQBlockReader("test.fastq.gz"):
+            content.update(batch)
+        content.get_adapters()
+        content.plot_adapter_content()
+
+    Reads are not trimmed. For each adapter, the number of reads that
+    contain at least one k-mer of the adapter is counted. The position of the
+    first adapter k-mer of each read is also stored. Adapter sequences
+    shorter than k at the end of reads are not detected. Instances computed
+    on different files or shards can be merged (see :meth:`merge`).
+    """
+    def __init__(self, adapters=None, k=12):
+        """.. rubric:: constructor
+
+        :param adapters: an :class:`AdapterIndex` or the adapters to be
+            indexed (see :class:`AdapterIndex`)
+        :param int k: length of the k-mers
+        """
+        if isinstance(adapters, AdapterIndex):
+            self.index = adapters
+        else:
+            self.index = AdapterIndex(adapters, k=k)
+        self.n_reads = 0
+        self.n_reads_with_adapters = 0
+        self.adapter_counts = np.zeros(len(self.index), dtype=np.int64)
+        self.position_counts = np.zeros(0, dtype=np.int64)
+
+        groups = self.index.groups
+        self._group_sizes = np.array([len(x) for x in groups], dtype=np.int64)
+        self._group_members = np.array([x for group in groups for x in group],
+            dtype=np.int64)
+        self._group_offsets = np.concatenate([[0], np.cumsum(self._group_sizes)])
+
+    def update(self, batch):
+        """Scan a batch of reads (:class:`~sequana.fastq.FastQBatch`)"""
+        from sequana.fastq import _resize
+
+        reads, positions, groups = self.index.scan(batch.sequences,
+            batch.offsets)
+        self.n_reads += len(batch)
+        if len(reads) == 0:
+            return
+
+        # position of the first adapter k-mer of each read
+        found, first = np.unique(reads, return_index=True)
+        self.n_reads_with_adapters += len(found)
+        positions = positions[first]
+        self.position_counts = _resize(self.position_counts,
+            positions.max() + 1)
+        self.position_counts += np.bincount(positions,
+            minlength=len(self.position_counts))
+
+        # reads containing each adapter
+        pairs = np.unique(reads * len(self._group_sizes) + groups)
+        reads, groups = np.divmod(pairs, len(self._group_sizes))
+        sizes = self._group_sizes[groups]
+        members = np.repeat(self._group_offsets[groups] - np.cumsum(sizes) +
+            sizes, sizes) + np.arange(sizes.sum())
+        adapters = self._group_members[members]
+        pairs = np.unique(np.repeat(reads, sizes) * len(self.index) + adapters)
+        self.adapter_counts += np.bincount(pairs % len(self.index),
+            minlength=len(self.index))
+
+    def merge(self, other):
+        """Add the counts of another :class:`AdapterContent` (in place)"""
+        from sequana.fastq import _add
+        if other.index.identifiers != self.index.identifiers:
+            raise ValueError("Cannot merge results of different adapters")
+        self.n_reads += other.n_reads
+        self.n_reads_with_adapters += other.n_reads_with_adapters
+        self.adapter_counts += other.adapter_counts
+        self.position_counts = _add(self.position_counts, other.position_counts)
+        return self
+
+    def get_adapters(self, min_fraction=0):
+        """Return the adapters found in the reads as a dataframe
+
+        :param float min_fraction: report adapters found in at least this
+            fraction of the reads
+        :return: dataframe with source file, identifier, sequence, number and
+            percentage of reads, sorted by decreasing number of reads
+        """
+        df = pd.DataFrame({"source": self.index.sources,
+            "identifier": self.index.identifiers,
+            "sequence": self.index.sequences,
+            "reads": self.adapter_counts})
+        df["percentage"] = df["reads"] / float(max(self.n_reads, 1)) * 100
+        df = df[(df["reads"] > 0) & (df["reads"] >= min_fraction * self.n_reads)]
+        return df.sort_values("reads", ascending=False).reset_index(drop=True)
+
+    def get_adapter_content(self):
+        """Return the percentage of reads with an adapter at each position
+
+        A read is counted at position p if its first adapter k-mer starts
+        at position p or before (cumulative distribution as in FastQC).
+        """
+        return pd.Series(np.cumsum(self.position_counts) /
+            float(max(self.n_reads, 1)) * 100)
+
+    def plot_adapter_content(self, fontsize=16):
+        """Plot the percentage of reads with adapters along the reads"""
+        pylab.clf()
+        self.get_adapter_content().plot()
+        pylab.xlabel("Position in read (bp)", fontsize=fontsize)
+        pylab.ylabel("Reads with adapters (%)", fontsize=fontsize)
+        pylab.grid(True)
+
+
+def scan_adapters(filename, adapters=None, k=12):
+    """Return the :class:`AdapterContent` of all reads of a FastQ file
+
+    ::
+
+        from sequana.adapters import scan_adapters
+        content = scan_adapters("test.fastq.gz", ["Nextera"])
+        content.get_adapters(min_fraction=0.001)
+
+    """
+    from sequana.fastq import FastQBlockReader
+    content = AdapterContent(adapters, k=k)
+    for batch in FastQBlockReader(filename):
+        content.update(batch)
+    return content
+
+
 class FindAdaptersFromDesign(object):
     """Extract adapter(s) corresponding to an experimental design file
 
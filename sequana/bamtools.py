@@ -21,6 +21,7 @@
 .. autosummary::
 
     Alignment
+    AlignmentMetric
     BAM
     CRAM
     SAM
@@ -32,9 +33,11 @@
 
 """
 import os
+import copy
 import json
 from collections import Counter
 from collections import OrderedDict
+from operator import attrgetter
 
 from sequana.lazy import pandas as pd
 from sequana.lazy import numpy as np
@@ -54,7 +57,11 @@ Interesting commands::
     samtools flagstat contaminant.bam
 """
 
-__all__ = ['BAM','Alignment', 'SAMFlags', "CS", "SAM", "CRAM"]
+__all__ = ['BAM','Alignment', 'SAMFlags', "CS", "SAM", "CRAM",
+    "AlignmentMetric", "ReadCount", "FlagMetric", "MapqMetric",
+    "ReadLengthMetric", "QueryLengthMetric", "MeanQualityMetric", "GCMetric",
+    "CoverageMetric", "IndelMetric", "InsertSizeMetric", "register_metric",
+    "get_bam_regions", "fetch_region", "run_on_regions"]
 
 
 # simple decorator to rewind the BAM file
@@ -111,6 +118,1177 @@ def is_cram(filename, *args):
     return f.is_cram
 
 
+# alignment attributes stored as numpy arrays in the batches (None is
+# replaced by -1); other attributes are stored as lists
+_numeric_fields = ("flag", "mapping_quality", "reference_id",
+    "reference_start", "reference_end", "reference_length", "query_length",
+    "query_alignment_length", "next_reference_id", "next_reference_start",
+    "template_length")
+
+
+def _iter_batches(alignments, fields, chunksize=10000):
+    """Yield batches of alignments as dictionaries (one entry per field)
+
+    A field is an attribute name or a tuple (name, function) where the
+    function returns the value of an alignment.
+    """
+    import gc
+    from itertools import islice
+    alignments = iter(alignments)
+    getters = [field if isinstance(field, tuple) else (field, attrgetter(field))
+        for field in fields]
+    fields = [name for name, getter in getters]
+    while True:
+        # the alignments of a batch are kept in memory; they have no
+        # reference cycles so the garbage collector (which would scan them
+        # many times) is disabled meanwhile. This is 3 times faster.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            chunk = list(islice(alignments, chunksize))
+            batch = {}
+            for name, getter in getters:
+                batch[name] = [getter(x) for x in chunk]
+            del chunk
+        finally:
+            if enabled:
+                gc.enable()
+        if len(batch[fields[0]]) == 0:
+            return
+        for name in fields:
+            if name in _numeric_fields:
+                values = batch[name]
+                if None in values:
+                    values = [-1 if x is None else x for x in values]
+                batch[name] = np.array(values, dtype=np.int64)
+        yield batch
+
+
+def _add_counts(counts1, counts2):
+    """Sum two histograms with possibly different lengths"""
+    if len(counts1) < len(counts2):
+        counts1, counts2 = counts2, counts1
+    counts = counts1.copy()
+    counts[0:len(counts2)] += counts2
+    return counts
+
+
+def _gc_content(sequences):
+    """Return GC content (percentage) of a list of sequences
+
+    Empty sequences (or None) are ignored.
+    """
+    from sequana.kmer import _to_buffer
+    sequences = [x for x in sequences if x]
+    if len(sequences) == 0:
+        return np.zeros(0)
+    buf, offsets = _to_buffer(sequences)
+    table = np.zeros(256, dtype=np.int64)
+    table[np.frombuffer(b"GCgc", dtype=np.uint8)] = 1
+    gc = np.add.reduceat(table[buf], offsets[:-1])
+    return gc / np.diff(offsets) * 100.
+
+
+class AlignmentMetric(object):
+    """Base class of the accumulators computed by :meth:`SAMBAMbase.collect`
+
+    A metric declares the alignment attributes (:attr:`fields`) it needs.
+    Alignments are streamed by batches; a batch is a dictionary with one
+    entry per field (numpy arrays for numeric attributes such as *flag* or
+    *reference_start*, lists otherwise). Only compact accumulators are kept
+    (histograms, depth arrays) and metrics of the same type can be merged,
+    so that results computed on several parts of a file can be combined.
+
+    ::
+
+        >>> from sequana import BAM, sequana_data
+        >>> b = BAM(sequana_data("test.bam"))
+        >>> results = b.collect(["flags", "mapq"])
+        >>> results["mapq"].counts[60]
+
+    New metrics are registered with :func:`register_metric`.
+    """
+    #: name used in :meth:`SAMBAMbase.collect`
+    name = None
+    #: attributes of the alignments required by :meth:`update`
+    fields = ()
+
+    def __init__(self):
+        self.references = ()
+        self.lengths = ()
+
+    def set_header(self, references, lengths):
+        """Set names and lengths of the references (called by
+        :meth:`SAMBAMbase.collect` before the first update)"""
+        self.references = tuple(references)
+        self.lengths = tuple(lengths)
+
+    def update(self, batch):
+        """Update the metric with a batch of alignments"""
+        raise NotImplementedError
+
+    def merge(self, other):
+        """Merge another metric of the same type (in place)"""
+        raise NotImplementedError
+
+    def get_params(self):
+        """Return the parameters of the metric (dictionary)
+
+        Metrics computed with different parameters are cached separately
+        (see :class:`sequana.cache.StatsCache`).
+        """
+        return {}
+
+    def get_state(self):
+        """Return the accumulators as a dictionary of numpy arrays"""
+        return {key: np.asarray(value) for key, value in self.__dict__.items()
+                if not isinstance(value, dict)}
+
+    def set_state(self, state):
+        """Restore the accumulators returned by :meth:`get_state`"""
+        for key, value in state.items():
+            if key in ("references", "lengths"):
+                value = tuple(value.tolist())
+            elif value.ndim == 0:
+                value = value.item()
+            setattr(self, key, value)
+        return self
+
+
+class ReadCount(AlignmentMetric):
+    """Number of alignments"""
+    name = "count"
+    fields = ("flag",)
+
+    def __init__(self):
+        super(ReadCount, self).__init__()
+        self.count = 0
+
+    def update(self, batch):
+        self.count += len(batch["flag"])
+
+    def merge(self, other):
+        self.count += other.count
+        return self
+
+
+class _HistogramMetric(AlignmentMetric):
+    # histogram (bincount) of an integer field
+    minlength = 1
+
+    def __init__(self):
+        super(_HistogramMetric, self).__init__()
+        self.counts = np.zeros(self.minlength, dtype=np.int64)
+
+    def _get_values(self, batch):
+        return batch[self.fields[0]]
+
+    def update(self, batch):
+        values = self._get_values(batch)
+        if len(values):
+            self.counts = _add_counts(self.counts, np.bincount(values))
+
+    def merge(self, other):
+        self.counts = _add_counts(self.counts, other.counts)
+        return self
+
+    def as_dict(self):
+        """Return the non-zero counts as a dictionary"""
+        return {int(x): int(self.counts[x]) for x in np.nonzero(self.counts)[0]}
+
+    def get_values(self):
+        """Return one value per alignment (sorted)"""
+        return np.repeat(np.arange(len(self.counts)), self.counts)
+
+
+class FlagMetric(_HistogramMetric):
+    """Histogram of the SAM flags (combinations of bits)"""
+    name = "flags"
+    fields = ("flag",)
+    minlength = 4096
+
+    def get_samflags_count(self):
+        """Return the number of alignments having each bit set"""
+        flags = np.arange(len(self.counts))
+        return {samflag: int(self.counts[(flags & samflag) > 0].sum())
+            for samflag in (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048)}
+
+
+class MapqMetric(_HistogramMetric):
+    """Histogram of the mapping qualities"""
+    name = "mapq"
+    fields = ("mapping_quality",)
+    minlength = 256
+
+
+class ReadLengthMetric(_HistogramMetric):
+    """Histogram of the reference lengths of the mapped reads"""
+    name = "read_length"
+    fields = ("flag", "reference_length")
+
+    def _get_values(self, batch):
+        lengths = batch["reference_length"]
+        return lengths[((batch["flag"] & 4) == 0) & (lengths >= 0)]
+
+
+class QueryLengthMetric(_HistogramMetric):
+    """Histogram of the read lengths (query length)"""
+    name = "query_length"
+    fields = ("query_length",)
+
+    def _get_values(self, batch):
+        lengths = batch["query_length"]
+        return lengths[lengths >= 0]
+
+
+class MeanQualityMetric(AlignmentMetric):
+    """Average of the mean quality of the reads
+
+    Reads without qualities are ignored.
+    """
+    name = "mean_quality"
+    fields = ("query_qualities",)
+
+    def __init__(self):
+        super(MeanQualityMetric, self).__init__()
+        self.total = 0.
+        self.count = 0
+
+    def update(self, batch):
+        qualities = [x for x in batch["query_qualities"] if x is not None and len(x)]
+        if len(qualities) == 0:
+            return
+        offsets = np.zeros(len(qualities) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in qualities], out=offsets[1:])
+        buf = np.frombuffer(b"".join(qualities), dtype=np.uint8)
+        sums = np.add.reduceat(buf.astype(np.float64), offsets[:-1])
+        self.total += np.sum(sums / np.diff(offsets))
+        self.count += len(qualities)
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+        return self
+
+    def _get_mean(self):
+        return self.total / self.count if self.count else np.nan
+    mean = property(_get_mean)
+
+
+class GCMetric(AlignmentMetric):
+    """Histogram of the GC content of the reads
+
+    The GC content (percentage) is stored in bins of :attr:`resolution`.
+    Mean and standard deviation are computed exactly.
+    """
+    name = "gc"
+    fields = ("query_sequence",)
+    resolution = 0.1
+
+    def __init__(self):
+        super(GCMetric, self).__init__()
+        self.counts = np.zeros(int(round(100 / self.resolution)) + 1,
+            dtype=np.int64)
+        self.total = 0.
+        self.total2 = 0.
+
+    def update(self, batch):
+        gc = _gc_content(batch["query_sequence"])
+        bins = np.round(gc / self.resolution).astype(np.int64)
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+        self.total += gc.sum()
+        self.total2 += (gc * gc).sum()
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.total += other.total
+        self.total2 += other.total2
+        return self
+
+    def _get_bins(self):
+        return np.arange(len(self.counts)) * self.resolution
+    bins = property(_get_bins, doc="GC content of each bin")
+
+    def _get_mean(self):
+        N = self.counts.sum()
+        return self.total / N if N else np.nan
+    mean = property(_get_mean)
+
+    def _get_std(self):
+        N = self.counts.sum()
+        if N == 0:
+            return np.nan
+        return np.sqrt(max(0, self.total2 / N - self.mean ** 2))
+    std = property(_get_std)
+
+
+class CoverageMetric(AlignmentMetric):
+    """Depth of coverage of each reference
+
+    Starts and ends of the alignments are counted (by batches) in int32
+    difference arrays so that the depth is a cumulative sum; there is no
+    loop over the bases. Difference arrays only span the positions
+    covered by the alignments, which keeps memory low when a contig is
+    processed by regions (see :func:`run_on_regions`). They grow
+    geometrically as alignments are added, so that scanning a file sorted by
+    coordinates takes linear time.
+
+    ::
+
+        >>> from sequana import BAM, sequana_data
+        >>> from sequana.bamtools import CoverageMetric
+        >>> b = BAM(sequana_data("measles.fa.sorted.bam"))
+        >>> coverage = b.collect([CoverageMetric(min_mapq=30)])["coverage"]
+        >>> depth = coverage.get_depth("ENA|K01711|K01711.1")
+        >>> coverage.to_bed("measles.bed")
+
+    The BED file has the format of *bedtools genomecov -d* (or *samtools
+    depth -aa*) and can be analysed with :class:`sequana.bedtools.GenomeCov`.
+    As with bedtools, the depth includes deletions and skipped regions of
+    the alignments.
+    """
+    name = "coverage"
+    fields = ("flag", "mapping_quality", "reference_id", "reference_start",
+        "reference_end")
+
+    def __init__(self, min_mapq=0, exclude_flags=0):
+        """.. rubric:: constructor
+
+        :param int min_mapq: ignore alignments with a lower mapping quality
+        :param int exclude_flags: ignore alignments with any of these bits
+            set (e.g. 1796 to ignore unmapped, secondary, QC failed and
+            duplicated reads as samtools depth does)
+        """
+        super(CoverageMetric, self).__init__()
+        self.min_mapq = min_mapq
+        self.exclude_flags = exclude_flags
+        # reference index -> (offset, difference array)
+        self.diff = {}
+
+    def get_params(self):
+        return {"min_mapq": self.min_mapq, "exclude_flags": self.exclude_flags}
+
+    def get_state(self):
+        state = super(CoverageMetric, self).get_state()
+        for reference_id, (offset, diff) in self.diff.items():
+            state["diff_%s" % reference_id] = diff
+            state["offset_%s" % reference_id] = np.asarray(offset)
+        return state
+
+    def set_state(self, state):
+        state = dict(state)
+        self.diff = {}
+        for key in [x for x in state if x.startswith("diff_")]:
+            reference_id = int(key[5:])
+            offset = int(state.pop("offset_%s" % reference_id))
+            self.diff[reference_id] = (offset, state.pop(key))
+        return super(CoverageMetric, self).set_state(state)
+
+    def _get_diff(self, reference_id, start, end):
+        # difference array covering at least the positions start to end
+        # (included)
+        if reference_id in self.diff:
+            offset, diff = self.diff[reference_id]
+            if offset <= start and end < offset + len(diff):
+                return offset, diff
+            # the array grows geometrically (at least doubles) so that the
+            # cost of the copies is linear with the length of the reference
+            # when alignments are sorted by coordinates
+            if start < offset:
+                start = min(start, max(0, offset - len(diff)))
+            else:
+                start = offset
+            if end >= offset + len(diff):
+                capacity = offset + 2 * len(diff) - 1
+                if reference_id < len(self.lengths):
+                    # no need to go beyond the end of the reference
+                    capacity = min(capacity, self.lengths[reference_id])
+                end = max(end, capacity)
+            else:
+                end = offset + len(diff) - 1
+        newdiff = np.zeros(end - start + 1, dtype=np.int32)
+        if reference_id in self.diff:
+            newdiff[offset - start:offset - start + len(diff)] = diff
+        self.diff[reference_id] = (start, newdiff)
+        return start, newdiff
+
+    def update(self, batch):
+        ids = batch["reference_id"]
+        starts = batch["reference_start"]
+        ends = batch["reference_end"]
+        keep = (ids >= 0) & (starts >= 0) & (ends > 0)
+        keep &= batch["mapping_quality"] >= self.min_mapq
+        if self.exclude_flags:
+            keep &= (batch["flag"] & self.exclude_flags) == 0
+        ids, starts, ends = ids[keep], starts[keep], ends[keep]
+        for reference_id in np.unique(ids):
+            mask = ids == reference_id
+            these_starts, these_ends = starts[mask], ends[mask]
+            offset, diff = self._get_diff(reference_id, these_starts.min(),
+                these_ends.max())
+            np.add.at(diff, these_starts - offset, 1)
+            np.add.at(diff, these_ends - offset, -1)
+
+    def merge(self, other):
+        for reference_id, (offset, diff) in other.diff.items():
+            offset1, diff1 = self._get_diff(reference_id, offset,
+                offset + len(diff) - 1)
+            diff1[offset - offset1:offset - offset1 + len(diff)] += diff
+        return self
+
+    def _get_index(self, reference):
+        if isinstance(reference, str):
+            return self.references.index(reference)
+        return reference
+
+    def get_depth(self, reference=0):
+        """Return the depth of coverage of a reference
+
+        :param reference: name or index of the reference
+        :return: numpy array (one value per base)
+        """
+        reference_id = self._get_index(reference)
+        length = self.lengths[reference_id]
+        depth = np.zeros(length, dtype=np.int32)
+        if reference_id in self.diff:
+            offset, diff = self.diff[reference_id]
+            N = max(0, min(len(diff), length - offset))
+            depth[offset:offset + N] = np.cumsum(diff[:N], dtype=np.int32)
+        return depth
+
+    def get_depth_as_dict(self):
+        """Return the depth of coverage of all references (keyed by name)"""
+        return {name: self.get_depth(i) for i, name in enumerate(self.references)}
+
+    def get_stats(self):
+        """Return a dataframe with the length, mean depth and breadth of
+        coverage (percentage of bases covered) of each reference"""
+        data = []
+        for i, name in enumerate(self.references):
+            depth = self.get_depth(i)
+            data.append((name, len(depth), depth.mean() if len(depth) else 0,
+                (depth > 0).mean() * 100 if len(depth) else 0))
+        df = pd.DataFrame(data, columns=["name", "length", "DOC", "BOC"])
+        return df.set_index("name")
+
+    def to_bed(self, filename, references=None, chunksize=1000000):
+        """Save the depth in a BED file (name, position, depth)
+
+        :param str filename: output BED file
+        :param references: list of references (names or indices) to save.
+            All references by default.
+        :param int chunksize: number of rows written at once
+
+        Positions are 1-based and all positions are reported (as with
+        *bedtools genomecov -d*).
+        """
+        if references is None:
+            references = range(len(self.references))
+        with open(filename, "w") as fout:
+            for reference in references:
+                reference_id = self._get_index(reference)
+                name = self.references[reference_id]
+                depth = self.get_depth(reference_id)
+                for start in range(0, len(depth), chunksize):
+                    chunk = depth[start:start + chunksize]
+                    df = pd.DataFrame({"name": name,
+                        "pos": np.arange(start + 1, start + len(chunk) + 1),
+                        "cov": chunk})
+                    df.to_csv(fout, sep="\t", header=False, index=False)
+
+
+class IndelMetric(AlignmentMetric):
+    """Histograms of insertions and deletions (from the CIGAR)
+
+    CIGARs are parsed by batches (see
+    :func:`sequana.cigar.get_cigar_operations`) and indels are counted in
+    fixed-size arrays so that memory and time do not depend on the number
+    of indels (long reads included):
+
+    - :attr:`insertions` and :attr:`deletions`: number of indels of each
+      length (index). Indels of *max_length* or more are counted in the last
+      bin (overflow).
+    - :attr:`contigs`: number of insertions, deletions and aligned bases
+      (M, =, X operations) of each reference (one row per reference).
+    - :attr:`positions`: number of insertions and deletions in windows of
+      *bin_size* bases along each reference (dictionary keyed by reference
+      index; arrays of 2 rows).
+
+    ::
+
+        >>> from sequana import BAM, sequana_data
+        >>> b = BAM(sequana_data("measles.fa.sorted.bam"))
+        >>> indels = b.collect(["indels"])["indels"]
+        >>> indels.get_stats()
+    """
+    name = "indels"
+    fields = ("reference_id", "reference_start", "cigarstring")
+
+    def __init__(self, max_length=1000, bin_size=1000):
+        """.. rubric:: constructor
+
+        :param int max_length: indels longer than *max_length* are counted
+            in the last bin of the histograms
+        :param int bin_size: size of the windows used to count indels along
+            the references
+        """
+        super(IndelMetric, self).__init__()
+        self.max_length = max_length
+        self.bin_size = bin_size
+        self.insertions = np.zeros(max_length + 1, dtype=np.int64)
+        self.deletions = np.zeros(max_length + 1, dtype=np.int64)
+        self.contigs = np.zeros((0, 3), dtype=np.int64)
+        self.positions = {}
+
+    def set_header(self, references, lengths):
+        super(IndelMetric, self).set_header(references, lengths)
+        self.contigs = np.zeros((len(lengths), 3), dtype=np.int64)
+
+    def get_params(self):
+        return {"max_length": self.max_length, "bin_size": self.bin_size}
+
+    def get_state(self):
+        state = super(IndelMetric, self).get_state()
+        for reference_id, positions in self.positions.items():
+            state["positions_%s" % reference_id] = positions
+        return state
+
+    def set_state(self, state):
+        state = dict(state)
+        self.positions = {}
+        for key in [x for x in state if x.startswith("positions_")]:
+            self.positions[int(key[10:])] = state.pop(key)
+        return super(IndelMetric, self).set_state(state)
+
+    def _get_positions(self, reference_id):
+        if reference_id not in self.positions:
+            N = self.lengths[reference_id] // self.bin_size + 1
+            self.positions[reference_id] = np.zeros((2, N), dtype=np.int64)
+        return self.positions[reference_id]
+
+    def update(self, batch):
+        from sequana.cigar import get_cigar_operations
+        ids = batch["reference_id"]
+        starts = batch["reference_start"]
+        cigars = batch["cigarstring"]
+        mapped = np.nonzero((ids >= 0) & (starts >= 0))[0]
+        rows, codes, lengths = get_cigar_operations([cigars[i] for i in mapped])
+        if len(rows) == 0:
+            return
+        ids, starts = ids[mapped][rows], starts[mapped][rows]
+
+        # position of the operations on the reference (cumulative sum of the
+        # operations consuming the reference within each alignment)
+        consumed = lengths * np.isin(codes, (0, 2, 3, 7, 8))
+        cumsum = np.cumsum(consumed)
+        first = np.searchsorted(rows, rows)
+        positions = starts + cumsum - consumed - (cumsum[first] - consumed[first])
+
+        clipped = np.minimum(lengths, self.max_length)
+        N = len(self.insertions)
+        insertions, deletions = codes == 1, codes == 2
+        self.insertions += np.bincount(clipped[insertions], minlength=N)
+        self.deletions += np.bincount(clipped[deletions], minlength=N)
+
+        M = len(self.contigs)
+        aligned = np.isin(codes, (0, 7, 8))
+        self.contigs[:, 0] += np.bincount(ids[insertions], minlength=M)
+        self.contigs[:, 1] += np.bincount(ids[deletions], minlength=M)
+        self.contigs[:, 2] += np.bincount(ids[aligned], weights=lengths[aligned],
+            minlength=M).astype(np.int64)
+
+        indels = insertions | deletions
+        ids, positions = ids[indels], positions[indels] // self.bin_size
+        kinds = deletions[indels].astype(np.int64)
+        for reference_id in np.unique(ids):
+            mask = ids == reference_id
+            counts = self._get_positions(reference_id)
+            np.add.at(counts, (kinds[mask], positions[mask]), 1)
+
+    def merge(self, other):
+        if (self.max_length, self.bin_size) != (other.max_length, other.bin_size):
+            raise ValueError("Cannot merge IndelMetric with different "
+                "max_length or bin_size")
+        self.insertions += other.insertions
+        self.deletions += other.deletions
+        self.contigs += other.contigs
+        for reference_id, counts in other.positions.items():
+            self._get_positions(reference_id)
+            self.positions[reference_id] += counts
+        return self
+
+    def get_stats(self):
+        """Return a dataframe with the number of insertions, deletions and
+        the indel rates (per aligned base) of each reference"""
+        df = pd.DataFrame(self.contigs, index=list(self.references),
+            columns=["insertions", "deletions", "aligned_bases"])
+        bases = df["aligned_bases"].replace(0, np.nan)
+        df["insertion_rate"] = df["insertions"] / bases
+        df["deletion_rate"] = df["deletions"] / bases
+        return df
+
+    def get_positions(self, reference=0):
+        """Return the number of insertions and deletions along a reference
+
+        :param reference: name or index of the reference
+        :return: dataframe with the start of the windows as index and two
+            columns (insertions, deletions)
+        """
+        if isinstance(reference, str):
+            reference = self.references.index(reference)
+        counts = self._get_positions(reference)
+        return pd.DataFrame({"insertions": counts[0], "deletions": counts[1]},
+            index=np.arange(counts.shape[1]) * self.bin_size)
+
+
+def _get_read_group(alignment):
+    return alignment.get_tag("RG") if alignment.has_tag("RG") else "unknown"
+
+
+class _MatePairing(object):
+    # Pairs the mates of the primary alignments of pairs mapped on the same
+    # reference, whatever the order of the file. The leftmost mate of a pair
+    # waits in *pending* (keyed by read name) until the rightmost mate is
+    # read; rightmost mates read before their mate (or whose mate was
+    # removed from *pending*) wait in *unpaired*. Values stored with the
+    # mates are given by the caller.
+    fields = ("flag", "query_name", "reference_id", "reference_start",
+        "next_reference_id", "next_reference_start")
+
+    def __init__(self, max_pending=1000000, max_unpaired=100000):
+        self.max_pending = max_pending
+        self.max_unpaired = max_unpaired
+        self.pending = OrderedDict()
+        self.unpaired = OrderedDict()
+        # heap of (position of the mate, name) used to remove the pending
+        # mates whose mate was not found. Positions are (reference_id,
+        # start) encoded as integers. The position is None if the file is
+        # not sorted by coordinates.
+        self._heap = []
+        self._position = -1
+
+    def select(self, batch):
+        """Return the indices of the alignments that can be paired"""
+        flags = batch["flag"]
+        ids = batch["reference_id"]
+        keep = ((flags & 1) > 0) & ((flags & 2316) == 0)
+        keep &= (ids >= 0) & (ids == batch["next_reference_id"])
+        keep &= (batch["reference_start"] >= 0) & (batch["next_reference_start"] >= 0)
+        return np.nonzero(keep)[0]
+
+    def _shrink(self):
+        # the oldest mates are removed if the tables are too large. Values
+        # of the rightmost mates removed are returned.
+        while len(self.pending) > self.max_pending:
+            self.pending.popitem(last=False)
+        evicted = []
+        while len(self.unpaired) > self.max_unpaired:
+            evicted.append(self.unpaired.popitem(last=False)[1])
+        return evicted
+
+    def update(self, batch, indices, values):
+        """Pair the alignments of a batch (given by *indices*, one value each)
+
+        :return: list of pairs (value of the leftmost mate, value of the
+            rightmost mate) and list of values of rightmost mates whose mate
+            was not seen (removed since the table was full)
+        """
+        import heapq
+        flags = batch["flag"]
+        ids = batch["reference_id"]
+        starts = batch["reference_start"]
+        mate_starts = batch["next_reference_start"]
+
+        # positions encoded as integers to detect unsorted files and to
+        # find the mates that should have been read already
+        mapped = ((ids << 32) + starts)[ids >= 0]
+        if len(mapped) and self._position is not None:
+            if mapped[0] < self._position or np.any(np.diff(mapped) < 0):
+                self._position = None
+                self._heap = []
+            else:
+                self._position = int(mapped[-1])
+
+        first = (starts < mate_starts) | ((starts == mate_starts) &
+            ((flags & 64) > 0))
+        indices = np.asarray(indices, dtype=np.int64)
+        mate_positions = ((ids << 32) + mate_starts)[indices].tolist()
+        names = batch["query_name"]
+        pending, unpaired = self.pending, self.unpaired
+        pairs = []
+        for i, is_first, mate_position, value in zip(indices.tolist(),
+                first[indices].tolist(), mate_positions, values):
+            name = names[i]
+            mate = (unpaired if is_first else pending).pop(name, None)
+            if mate is not None:
+                pairs.append((value, mate) if is_first else (mate, value))
+            elif is_first:
+                pending[name] = value
+                if self._position is not None:
+                    heapq.heappush(self._heap, (mate_position, name))
+            else:
+                unpaired[name] = value
+
+        # mates whose mate should have been read (filtered or missing) are
+        # removed
+        if self._position is not None:
+            heap = self._heap
+            while heap and heap[0][0] < self._position:
+                pending.pop(heapq.heappop(heap)[1], None)
+        return pairs, self._shrink()
+
+    def merge(self, other):
+        """Pair the mates left by two instances (see :meth:`update`)"""
+        pairs = []
+        for pending, unpaired in ((self.pending, other.unpaired),
+                (other.pending, self.unpaired)):
+            for name in [x for x in pending if x in unpaired]:
+                pairs.append((pending.pop(name), unpaired.pop(name)))
+        self.pending.update(other.pending)
+        self.unpaired.update(other.unpaired)
+        return pairs, self._shrink()
+
+
+class InsertSizeMetric(AlignmentMetric):
+    """Histograms of the insert sizes of the read pairs
+
+    The insert size of a pair is the distance between the leftmost mapped
+    base and the rightmost mapped base of the two mates (the absolute
+    TLEN of the SAM specification). Only primary alignments of pairs whose
+    mates are both mapped on the same reference are used.
+
+    The mates are not expected to be consecutive, so files sorted by
+    coordinates (or not sorted at all) are supported. The leftmost mate of
+    a pair is kept in a hash table (keyed by read name) until the rightmost
+    mate is read. On files sorted by coordinates, the table only holds the
+    pairs overlapping the current position: reads whose mate should have
+    been read already are removed. Rightmost mates read before their mate
+    (or whose mate was removed) are kept in a second table. The sizes of
+    the tables are limited to *max_pending* and *max_unpaired* reads
+    (checked after each batch of alignments) so that memory is bounded
+    whatever the order of the file.
+
+    When a mate was not seen (filtered, removed from the tables or processed
+    in another region), the TLEN of the alignment is used if it is set.
+    Mates that are not paired at the end of a region are kept so that
+    metrics computed on regions (see :func:`run_on_regions`) are merged
+    exactly, unless the tables were full.
+
+    Insert sizes are counted in histograms (one per read group or library)
+    of *max_size* + 1 bins; the last bin counts the inserts of *max_size*
+    or more.
+
+    ::
+
+        >>> from sequana import BAM, sequana_data
+        >>> b = BAM(sequana_data("measles.fa.sorted.bam"))
+        >>> insert_size = b.collect(["insert_size"])["insert_size"]
+        >>> insert_size.get_stats()
+        >>> counts = insert_size.get_counts()
+
+    See also :meth:`SAMBAMbase.get_insert_sizes`.
+    """
+    name = "insert_size"
+    fields = ("flag", "mapping_quality", "query_name", "reference_id",
+        "reference_start", "reference_end", "next_reference_id",
+        "next_reference_start", "template_length")
+
+    def __init__(self, max_size=10000, min_mapq=0, exclude_flags=1536,
+            group_by=None, libraries=None, max_pending=1000000,
+            max_unpaired=100000):
+        """.. rubric:: constructor
+
+        :param int max_size: inserts larger than *max_size* are counted in
+            the last bin of the histograms
+        :param int min_mapq: ignore pairs with a mate having a lower mapping
+            quality
+        :param int exclude_flags: ignore pairs with a mate having any of
+            these bits set (by default, QC failed and duplicated reads).
+            Secondary and supplementary alignments are always ignored.
+        :param str group_by: None (a single histogram named *all*),
+            *read_group* (one histogram per RG tag) or *library* (one
+            histogram per library of the read groups)
+        :param dict libraries: library of each read group (used with
+            *group_by* set to *library*; see
+            :meth:`SAMBAMbase.get_insert_sizes`)
+        :param int max_pending: maximum number of leftmost mates waiting for
+            their mate
+        :param int max_unpaired: maximum number of rightmost mates whose
+            mate was not seen. Beyond, their TLEN is used.
+        """
+        super(InsertSizeMetric, self).__init__()
+        if group_by not in (None, "read_group", "library"):
+            raise ValueError("group_by must be None, read_group or library")
+        self.max_size = max_size
+        self.min_mapq = min_mapq
+        self.exclude_flags = exclude_flags
+        self.group_by = group_by
+        self.libraries = dict(libraries or {})
+        if group_by is not None:
+            self.fields = self.fields + (("read_group", _get_read_group),)
+        # group -> histogram
+        self.counts = {}
+        # mates waiting for their mate: (group, start, end, template length)
+        # The group is None if the pair must be ignored.
+        self._pairing = _MatePairing(max_pending, max_unpaired)
+
+    def get_params(self):
+        return {"max_size": self.max_size, "min_mapq": self.min_mapq,
+            "exclude_flags": self.exclude_flags, "group_by": self.group_by,
+            "libraries": self.libraries}
+
+    def get_state(self):
+        # mates not paired are counted (see get_counts) so that the state
+        # is final
+        counts = self.get_counts_as_dict()
+        state = {"references": np.asarray(self.references),
+            "lengths": np.asarray(self.lengths),
+            "groups": np.array(list(counts), dtype=str)}
+        for i, group in enumerate(counts):
+            state["counts_%s" % i] = counts[group]
+        return state
+
+    def set_state(self, state):
+        state = dict(state)
+        groups = [str(x) for x in state.pop("groups")]
+        self.counts = {group: state.pop("counts_%s" % i)
+            for i, group in enumerate(groups)}
+        self._pairing = _MatePairing(self._pairing.max_pending,
+            self._pairing.max_unpaired)
+        return super(InsertSizeMetric, self).set_state(state)
+
+    def _get_group(self, read_group):
+        if self.group_by == "library":
+            return self.libraries.get(read_group, read_group)
+        return read_group
+
+    def _count(self, group, sizes):
+        sizes = np.minimum(np.asarray(sizes, dtype=np.int64), self.max_size)
+        counts = np.bincount(sizes, minlength=self.max_size + 1)
+        if group in self.counts:
+            counts += self.counts[group]
+        self.counts[group] = counts
+
+    def _add(self, pairs, unpaired):
+        # insert sizes of the pairs and TLEN of the mates not paired
+        sizes = {}
+        for (group1, start1, end1, _), (group, start, end, _) in pairs:
+            if group is not None and group1 is not None:
+                sizes.setdefault(group, []).append(max(end, end1) -
+                    min(start, start1))
+        for group, start, end, tlen in unpaired:
+            if group is not None and tlen != 0:
+                sizes.setdefault(group, []).append(abs(tlen))
+        for group, values in sizes.items():
+            self._count(group, values)
+
+    def update(self, batch):
+        indices = self._pairing.select(batch)
+        valid = batch["mapping_quality"][indices] >= self.min_mapq
+        if self.exclude_flags:
+            valid &= (batch["flag"][indices] & self.exclude_flags) == 0
+        if self.group_by is None:
+            groups = ["all"] * len(indices)
+        else:
+            groups = [self._get_group(batch["read_group"][i]) for i in indices]
+        values = zip([x if y else None for x, y in zip(groups, valid.tolist())],
+            batch["reference_start"][indices].tolist(),
+            batch["reference_end"][indices].tolist(),
+            batch["template_length"][indices].tolist())
+        self._add(*self._pairing.update(batch, indices, values))
+
+    def merge(self, other):
+        if self.get_params() != other.get_params():
+            raise ValueError("Cannot merge InsertSizeMetric with different "
+                "parameters")
+        for group, counts in other.counts.items():
+            if group in self.counts:
+                counts = counts + self.counts[group]
+            self.counts[group] = counts.copy()
+        # pairs whose mates were processed separately
+        self._add(*self._pairing.merge(other._pairing))
+        return self
+
+    def get_counts_as_dict(self):
+        """Return the histograms (keyed by group)
+
+        The rightmost mates whose mate was not seen are counted using
+        their TLEN (if not zero).
+        """
+        counts = {group: x.copy() for group, x in self.counts.items()}
+        sizes = {}
+        for group, start, end, tlen in self._pairing.unpaired.values():
+            if group is not None and tlen != 0:
+                sizes.setdefault(group, []).append(abs(tlen))
+        for group, values in sizes.items():
+            values = np.minimum(np.asarray(values, dtype=np.int64), self.max_size)
+            values = np.bincount(values, minlength=self.max_size + 1)
+            counts[group] = counts[group] + values if group in counts else values
+        return {group: counts[group] for group in sorted(counts)}
+
+    def get_counts(self, group=None):
+        """Return the histogram of a group (all groups by default)"""
+        counts = self.get_counts_as_dict()
+        if group is not None:
+            return counts[group]
+        return sum(counts.values(), np.zeros(self.max_size + 1, dtype=np.int64))
+
+    def get_stats(self):
+        """Return a dataframe with the number of pairs, the mean, standard
+        deviation, median and mode of the insert sizes of each group
+
+        Inserts of *max_size* or more are not used to compute the
+        statistics; their number is given in the *overflow* column.
+        """
+        data = []
+        sizes = np.arange(self.max_size)
+        for group, counts in self.get_counts_as_dict().items():
+            N = counts[:-1].sum()
+            if N:
+                mean = (sizes * counts[:-1]).sum() / N
+                std = np.sqrt(((sizes - mean) ** 2 * counts[:-1]).sum() / N)
+                median = np.searchsorted(np.cumsum(counts[:-1]), N / 2.)
+                mode = np.argmax(counts[:-1])
+            else:
+                mean, std, median, mode = np.nan, np.nan, np.nan, np.nan
+            data.append((group, counts.sum(), mean, std, median, mode,
+                counts[-1]))
+        df = pd.DataFrame(data, columns=["group", "pairs", "mean", "std",
+            "median", "mode", "overflow"])
+        return df.set_index("group")
+
+
+_metrics = OrderedDict()
+
+
+def register_metric(metric):
+    """Register a subclass of :class:`AlignmentMetric` (by its name)
+
+    The metric can then be computed with :meth:`SAMBAMbase.collect`.
+    """
+    _metrics[metric.name] = metric
+    return metric
+
+
+for _metric in (ReadCount, FlagMetric, MapqMetric, ReadLengthMetric,
+        QueryLengthMetric, MeanQualityMetric, GCMetric, CoverageMetric,
+        IndelMetric, InsertSizeMetric):
+    register_metric(_metric)
+
+# metrics based on numeric fields only; cheap to compute so they are all
+# computed when one of them is needed
+_basic_metrics = ["count", "flags", "mapq", "read_length", "query_length"]
+
+
+def get_bam_regions(filename, region_size=None, mode="r"):
+    """Split an indexed BAM/CRAM file into regions
+
+    :param str filename: input BAM/CRAM file (must be indexed)
+    :param int region_size: contigs longer than *region_size* are split into
+        tiles of this size. If None, there is one region per contig.
+    :return: list of regions (contig, start, end). The last region
+        ("*", None, None) stands for the unmapped reads without coordinates.
+
+    Contigs without alignments are ignored if the index provides
+    statistics. Each alignment belongs to a single region: the one that
+    contains its starting position (see :func:`fetch_region`).
+    """
+    with pysam.AlignmentFile(filename, mode=mode) as bam:
+        if bam.has_index() is False:
+            raise ValueError("{} is not indexed".format(filename))
+        contigs = list(zip(bam.references, bam.lengths))
+        try:
+            used = set(x.contig for x in bam.get_index_statistics()
+                if x.total > 0)
+            contigs = [x for x in contigs if x[0] in used]
+        except Exception:
+            pass
+
+    regions = []
+    for contig, length in contigs:
+        size = region_size or length
+        for start in range(0, length, size):
+            regions.append((contig, start, min(start + size, length)))
+    regions.append(("*", None, None))
+    return regions
+
+
+def fetch_region(bam, region):
+    """Iterate over the alignments starting in a region
+
+    :param bam: an opened :class:`pysam.AlignmentFile`
+    :param region: (contig, start, end) tuple. Use ("*", None, None) for
+        the unmapped reads without coordinates.
+
+    Contrary to :meth:`pysam.AlignmentFile.fetch`, alignments that overlap
+    the start of the region but start before it are skipped, so that
+    alignments are not counted twice when iterating over adjacent regions.
+    """
+    contig, start, end = region
+    if contig == "*":
+        for alignment in bam.fetch("*"):
+            yield alignment
+        return
+    for alignment in bam.fetch(contig, start, end):
+        if alignment.reference_start >= start:
+            yield alignment
+
+
+def _region_job(args):
+    filename, mode, threads, function, region, kwargs = args
+    with pysam.AlignmentFile(filename, mode=mode, threads=threads) as bam:
+        return function(fetch_region(bam, region), **kwargs)
+
+
+def run_on_regions(filename, function, regions=None, region_size=None,
+        jobs=1, threads=1, merge=None, mode="r", **kwargs):
+    """Apply a function on all regions of an indexed BAM/CRAM in parallel
+
+    :param str filename: input BAM/CRAM file (must be indexed)
+    :param function: a function called as *function(alignments, **kwargs)*
+        where *alignments* iterates over the alignments of a region. It
+        must be defined at the top level of a module (it is sent to other
+        processes) and return an accumulator.
+    :param regions: list of (contig, start, end). See
+        :func:`get_bam_regions`, which is used by default.
+    :param int region_size: see :func:`get_bam_regions`
+    :param int jobs: number of processes
+    :param int threads: number of threads used by each process to
+        decompress the BAM file (pysam *threads* parameter)
+    :param merge: function that merges two accumulators. By default, the
+        *merge* method of the accumulators is used (the result of the first
+        region is updated in place). If False, the list of accumulators is
+        returned.
+    :return: the merged accumulator
+
+    Each process opens its own handle of the file. Results are merged in
+    the order of the regions so that the result does not depend on the
+    number of jobs::
+
+        from sequana.bamtools import run_on_regions
+
+        def count(alignments):
+            return sum(1 for x in alignments)
+
+        run_on_regions("test.bam", count, jobs=4, merge=lambda x, y: x + y)
+
+    """
+    if regions is None:
+        regions = get_bam_regions(filename, region_size=region_size, mode=mode)
+    tasks = [(filename, mode, threads, function, region, kwargs)
+        for region in regions]
+
+    if merge is None:
+        merge = lambda x, y: x.merge(y)
+
+    def reduce(results):
+        if merge is False:
+            return list(results)
+        result = next(results)
+        for other in results:
+            result = merge(result, other)
+        return result
+
+    if jobs > 1:
+        import multiprocessing
+        with multiprocessing.Pool(jobs) as pool:
+            # results are merged as they arrive (in order)
+            return reduce(pool.imap(_region_job, tasks))
+    else:
+        return reduce(_region_job(task) for task in tasks)
+
+
+_concordance_columns = ['length', "I", "D", "M", "mapq", "flags", "NM",
+    "mismatch"]
+
+
+def _concordance_job(alignments, max_align=-1, chunksize=10000):
+    """Return the counts used by :meth:`SAMBAMbase.get_df_concordance`
+
+    :return: a dataframe with one row per alignment (without concordance)
+    """
+    from sequana.cigar import get_cigar_counts, get_cs_counts
+
+    def get_tag(name):
+        return lambda x: x.get_tag(name) if x.has_tag(name) else None
+
+    fields = ["mapping_quality", "query_alignment_length", "flag",
+        "cigarstring", ("NM", get_tag("NM")), ("cs", get_tag("cs")),
+        ("tagged", lambda x: x.has_tag("NM") or bool(x.get_tags()))]
+    count = 0
+    dfs = []
+    for batch in _iter_batches(alignments, fields, chunksize):
+        # tags and cigar populated  if there is a match
+        # if we use --cs cigar is not populated so we can only look at tags
+        # tags can be an empty list
+        keep = [i for i, tagged in enumerate(batch["tagged"]) if tagged]
+        if max_align > 0:
+            keep = keep[0:max_align - count]
+        count += len(keep)
+        tags = [batch["cs"][i] for i in keep]
+        cigars = [batch["cigarstring"][i] for i in keep]
+
+        # CIGAR and cs tags are parsed by batches
+        cs = get_cs_counts(tags)
+        cigar = get_cigar_counts(cigars)
+        has_cs = np.array([x is not None for x in tags], dtype=bool)
+        has_cigar = np.array([bool(x) for x in cigars], dtype=bool)
+        # no info about substitutions in the cigar (NaN)
+        S = np.where(has_cs, cs[:, 3], np.where(has_cigar, np.nan, 0))
+        dfs.append(pd.DataFrame({
+            'length': batch["query_alignment_length"][keep],
+            "I": np.where(has_cs, cs[:, 1], cigar[:, 1]),
+            "D": np.where(has_cs, cs[:, 2], cigar[:, 2]),
+            "M": np.where(has_cs, cs[:, 0], cigar[:, 0]),
+            "mapq": batch["mapping_quality"][keep],
+            "flags": batch["flag"][keep],
+            "NM": [-1 if batch["NM"][i] is None else batch["NM"][i]
+                for i in keep],
+            "mismatch": S}))
+
+        logger.debug("Read {} alignments".format(count))
+        if max_align > 0 and count >= max_align:
+            break
+
+    return pd.concat(dfs, ignore_index=True) if dfs else \
+        pd.DataFrame(columns=_concordance_columns)
+
+
+def _collect_job(alignments, metrics, chunksize=10000):
+    # metrics are copied so that the same (empty) metrics can be used for
+    # all regions
+    metrics = [copy.deepcopy(metric) for metric in metrics]
+    # fields are (name, function) tuples or names
+    fields = {x[0] if isinstance(x, tuple) else x: x for metric in metrics
+        for x in metric.fields}
+    fields = [fields[x] for x in sorted(fields)]
+    for batch in _iter_batches(alignments, fields, chunksize):
+        for metric in metrics:
+            metric.update(batch)
+    return metrics
+
+
+def _merge_metrics(metrics1, metrics2):
+    return [x.merge(y) for x, y in zip(metrics1, metrics2)]
+
+
+def _get_index_counts(alignments):
+    """Return the number of mapped/unmapped alignments stored in the index
+
+    :param alignments: a :class:`pysam.AlignmentFile`
+    :return: dictionary with the *total*, *mapped* and *unmapped* counts or
+        None if the file is not an indexed BAM file. CRAM indices do not
+        store these counts.
+    """
+    if not alignments.is_bam or not alignments.has_index():
+        return None
+    try:
+        mapped, unmapped = alignments.mapped, alignments.unmapped
+    except (ValueError, AttributeError):
+        return None
+    return {"total": mapped + unmapped, "mapped": mapped, "unmapped": unmapped}
+
+
 
 
 class SAMBAMbase():
@@ -131,19 +1309,43 @@ class SAMBAMbase():
         >>> len(b)
         60
 
+    Most statistics (flags, MAPQ, read lengths, coverage...) are computed
+    with :meth:`collect`, which reads the file once for all the metrics
+    requested and caches the results; further calls to methods using the
+    same metrics do not read the file again.
+
+    The number of alignments (len) is read from the index of BAM files if
+    there is one (see :meth:`get_read_counts`).
+
+    Statistics can also be stored on disk so that they are not computed
+    again as long as the file is unchanged. Set *cache* to True to store
+    them next to the input file, or to a cache directory (or a
+    :class:`sequana.cache.StatsCache` instance)::
+
+        b = BAM("test.bam", cache=True)
+        b.collect()     # the file is read
+        b = BAM("test.bam", cache=True)
+        b.collect()     # results are loaded from test.bam.sequana_cache
+
     """
     # The mode rb means read-only (r) and that (b) for binary the format
     # So BAM or SAM can be read in theory.
-    def __init__(self, filename, mode="r", *args):
+    def __init__(self, filename, mode="r", *args, threads=1, cache=None):
+        from sequana.cache import get_cache
         self._filename = filename
         self._mode = mode
         self._args = args
+        self._threads = threads
+        self._cache = get_cache(cache)
         self._summary = None
         self._sorted = None
 
         # Save the length so that second time we need it, it is already
         # computed.
         self._N = None
+        self._counts = None
+        # metrics computed by collect()
+        self._collected = {}
         self.reset()
 
     def reset(self):
@@ -152,7 +1354,7 @@ class SAMBAMbase():
         except:
             pass
         self._data = pysam.AlignmentFile(self._filename,
-            mode=self._mode, *self._args)
+            mode=self._mode, *self._args, threads=self._threads)
 
     @_reset
     def get_read_names(self):
@@ -160,16 +1362,161 @@ class SAMBAMbase():
         names = [this.qname for this in self._data]
         return names
 
-    @_reset
     def __len__(self):
         if self._N is None:
-            logger.warning("Scanning the BAM. Please wait")
-            self._N = sum(1 for _ in self._data)
-            self.reset()
+            self._N = self.get_read_counts()["total"]
         return self._N
 
+    def get_read_counts(self):
+        """Return the number of alignments (total, mapped and unmapped)
+
+        :return: dictionary with the *total* number of alignments and the
+            number of *mapped* and *unmapped* alignments. Secondary and
+            supplementary alignments are included (see :meth:`get_stats`
+            for counts of reads).
+
+        The alignments are not read if the counts can be obtained otherwise.
+        In order of preference, counts are taken from:
+
+        - the statistics already computed (see :meth:`collect`),
+        - the index of BAM files (.bai or .csi),
+        - the statistics of the flags stored in the cache if the constructor
+          was called with *cache* set.
+
+        Otherwise, the file is scanned (and the statistics are stored in the
+        cache, if any)::
+
+            b = BAM("test.bam", cache=True)
+            b.get_read_counts()
+
+        """
+        if self._counts is None and "flags" not in self._collected:
+            self._counts = _get_index_counts(self._data)
+
+        if self._counts is None:
+            # histogram of the flags (loaded from the cache or computed)
+            flags = self._get_metric("flags").counts
+            unmapped = int(flags[np.arange(len(flags)) & 4 > 0].sum())
+            total = int(flags.sum())
+            self._counts = {"total": total, "mapped": total - unmapped,
+                            "unmapped": unmapped}
+        return dict(self._counts)
+
     @_reset
-    def get_df_concordance(self, max_align=-1):
+    def collect(self, metrics=None, chunksize=10000, jobs=1,
+            region_size=None):
+        """Compute several metrics in a single pass over the alignments
+
+        :param metrics: list of metric names (see below) or instances of
+            :class:`AlignmentMetric`. All registered metrics are computed by
+            default.
+        :param int chunksize: number of alignments per batch
+        :param int jobs: number of processes. If greater than 1 and the file
+            is indexed, regions of the file are processed in parallel (see
+            :func:`run_on_regions`) and the metrics are merged.
+        :param int region_size: size of the regions processed in parallel
+            (by default, the genome is split in about 4 regions per job)
+        :return: dictionary with the metrics (keyed by name)
+
+        Available metrics are count (:class:`ReadCount`), flags
+        (:class:`FlagMetric`), mapq (:class:`MapqMetric`), read_length
+        (:class:`ReadLengthMetric`), query_length
+        (:class:`QueryLengthMetric`), mean_quality
+        (:class:`MeanQualityMetric`), gc (:class:`GCMetric`), coverage
+        (:class:`CoverageMetric`), indels (:class:`IndelMetric`) and
+        insert_size (:class:`InsertSizeMetric`)::
+
+            >>> from sequana import BAM, sequana_data
+            >>> b = BAM(sequana_data("test.bam"))
+            >>> results = b.collect(["flags", "mapq", "gc"])
+            >>> results["gc"].mean
+
+        Results are cached: metrics given by name that were already computed
+        are not computed again. Metrics given as instances are always
+        computed (and replace the cached ones). The number of alignments is
+        always counted.
+        """
+        if metrics is None:
+            metrics = list(_metrics)
+
+        names, todo = [], []
+        for metric in list(metrics) + ["count"]:
+            if isinstance(metric, str):
+                if metric not in _metrics:
+                    raise ValueError("Unknown metric {}. Use one of {}".format(
+                        metric, list(_metrics)))
+                if metric in self._collected or metric in names:
+                    names.append(metric)
+                    continue
+                metric = _metrics[metric]()
+            metric.set_header(self._data.references, self._data.lengths)
+            names.append(metric.name)
+            if self._cache and self._load_metric(metric):
+                continue
+            todo.append(metric)
+
+        if todo:
+            logger.info("Scanning {} to compute {}".format(self._filename,
+                ", ".join(x.name for x in todo)))
+            if jobs > 1 and self._data.has_index():
+                if region_size is None:
+                    region_size = max(1, sum(self._data.lengths) // (4 * jobs))
+                todo = run_on_regions(self._filename, _collect_job,
+                    region_size=region_size, jobs=jobs, threads=self._threads,
+                    merge=_merge_metrics, mode=self._mode, metrics=todo,
+                    chunksize=chunksize)
+            else:
+                todo = _collect_job(self._data, todo, chunksize)
+            for metric in todo:
+                self._collected[metric.name] = metric
+                if self._cache:
+                    self._cache.set(self._filename, metric.name,
+                        metric.get_state(), self._get_cache_params(metric))
+            self.reset()
+        self._N = self._collected["count"].count
+        return {name: self._collected[name] for name in names}
+
+    def _get_cache_params(self, metric):
+        return dict(metric.get_params(), metric=type(metric).__name__)
+
+    def _load_metric(self, metric):
+        # restore a metric from the cache
+        state = self._cache.get(self._filename, metric.name,
+            self._get_cache_params(metric))
+        if state is None:
+            return False
+        self._collected[metric.name] = metric.set_state(state)
+        return True
+
+    def _get_metric(self, name):
+        # compute the basic metrics along with the one requested
+        return self.collect([name] + _basic_metrics)[name]
+
+    def get_insert_sizes(self, group_by=None, jobs=1, **kwargs):
+        """Return the insert sizes of the read pairs
+
+        :param str group_by: None (all pairs), *read_group* or *library*
+            (libraries are read from the header)
+        :param int jobs: number of processes (see :meth:`collect`)
+        :param kwargs: other parameters of :class:`InsertSizeMetric`
+        :return: a :class:`InsertSizeMetric` instance
+
+        ::
+
+            >>> from sequana import BAM, sequana_data
+            >>> b = BAM(sequana_data("measles.fa.sorted.bam"))
+            >>> b.get_insert_sizes().get_stats()
+
+        The file does not need to be sorted by names.
+        """
+        header = self._data.header.to_dict()
+        libraries = {x["ID"]: x.get("LB", x["ID"]) for x in header.get("RG", [])}
+        metric = InsertSizeMetric(group_by=group_by, libraries=libraries,
+            **kwargs)
+        return self.collect([metric], jobs=jobs)["insert_size"]
+
+    @_reset
+    def get_df_concordance(self, max_align=-1, jobs=1, region_size=None):
         """This methods returns a dataframe with Insert, Deletion, Match,
         Substitution, read length, concordance (see below for a definition)
 
@@ -181,69 +1528,36 @@ class SAMBAMbase():
 
         alignment that have no CS tag or CIGAR are ignored.
 
+        :param int max_align: number of alignments to use (all by default)
+        :param int jobs: number of processes. If greater than 1 and the file
+            is indexed, regions of the file are processed in parallel (see
+            :func:`run_on_regions`). Rows are in the order of the file. Not
+            used with *max_align*.
+        :param int region_size: size of the regions processed in parallel
+            (see :meth:`collect`)
 
         """
-        from sequana import Cigar
-        count = 0
-        I, D, M, L, mapq, flags, NM = [], [], [], [], [], [], []
-        S = []
-        for i, a in enumerate(self._data):
-            # tags and cigar populated  if there is a match
-            # if we use --cs cigar is not populated so we can only look at tags
-            # tags can be an empty list
-            if a.tags is None or len(a.tags) == 0:
-                continue
-            count += 1
-            mapq.append(a.mapq)
-            L.append(a.qlen)
-            try:
-                NM.append([x[1] for x in a.tags if x[0] == "NM"][0])
-            except:
-                NM.append(-1)
-
-            flags.append(a.flag)
-
-            if 'cs' in dict(a.tags):
-                cs = CS(dict(a.tags)['cs'])
-                S.append(cs['S'])
-                I.append(cs['I'])
-                D.append(cs['D'])
-                M.append(cs['M'])
-            elif a.cigarstring:
-                cigar = Cigar(a.cigarstring).as_dict()
-                I.append(cigar["I"])
-                D.append(cigar['D'])
-                M.append(cigar['M'])
-                S.append(None)  # no info about substitutions in the cigar
-            else:
-                I.append(0)
-                D.append(0)
-                M.append(0)
-                S.append(0)
-
-            if max_align>0 and count == max_align:
-                break
-
-            if count % 10000 == 0:
-                logger.debug("Read {} alignments".format(count))
-
-        I = np.array(I)
-        D = np.array(D)
-        M = np.array(M)
-        NM = np.array(NM)
+        if jobs > 1 and max_align <= 0 and self._data.has_index():
+            if region_size is None:
+                region_size = max(1, sum(self._data.lengths) // (4 * jobs))
+            dfs = run_on_regions(self._filename, _concordance_job,
+                region_size=region_size, jobs=jobs, threads=self._threads,
+                merge=False, mode=self._mode)
+        else:
+            dfs = [_concordance_job(self._data, max_align)]
 
-        try:
-            S = np.array(S)
+        dfs = [x for x in dfs if len(x)]
+        df = pd.concat(dfs, ignore_index=True) if dfs else \
+            pd.DataFrame(columns=_concordance_columns)
+        I, D, M, S = df.I.values, df.D.values, df.M.values, df.mismatch.values
+        if not np.isnan(S.astype(float)).any():
             C = 1 - (I + D + S)/(S + I + D + M)
             logger.info("computed Concordance based on minimap2 --cs option")
-        except:
+        else:
             logger.info("computed Concordance based on standard CIGAR information using INDEL and NM tag")
-            computed_S = NM - D - I
+            computed_S = df.NM.values - D - I
             C = 1 - (I + D + computed_S)/(computed_S + I + D + M)
-
-        df = pd.DataFrame([C, L, I, D, M, mapq, flags, NM, S])
-        df = df.T
-        df.columns = ["concordance", 'length', "I", "D", "M", "mapq", "flags", "NM", "mismatch"]
+        df.insert(0, "concordance", C)
         return df
 
     def __iter__(self):
@@ -286,8 +1600,14 @@ class SAMBAMbase():
             >>> df.query("description=='average quality'")
             36.9
 
-        .. note:: uses samtools behind the scene
+        .. note:: uses samtools behind the scene. The result is cached if
+            the *cache* parameter of the constructor is set.
         """
+        if self._cache:
+            df = self._cache.get_dataframe(self._filename, "samtools_stats")
+            if df is not None:
+                return df
+
         from easydev import shellcmd
         res = shellcmd("samtools stats %s" % self._filename)
         res = res.decode('utf-8')
@@ -313,6 +1633,8 @@ class SAMBAMbase():
         df = pd.DataFrame({"description": names, "count": values })
         df = df[['description', 'count']]
         df.sort_values(by='count', inplace=True)
+        if self._cache:
+            self._cache.set_dataframe(self._filename, "samtools_stats", df)
         return df
 
     def _count_item(self, d, item, n=1):
@@ -326,21 +1648,11 @@ class SAMBAMbase():
         if self._summary is not None:
             return self._summary
 
-        mapq_dict = {}
-        read_length_dict = {}
-        flag_dict = {}
-        mean_qualities = []
-        for read in self:
-            self._count_item(mapq_dict, read.mapq)
-            self._count_item(flag_dict, read.flag)
-            if read.is_unmapped is False:
-                self._count_item(read_length_dict, read.reference_length)
-            try:mean_qualities.append(pylab.mean(read.query_qualities))
-            except:mean_qualities.append(read.query_qualities)
-        self._summary = {"mapq": mapq_dict,
-                         "read_length": read_length_dict,
-                         "flags": flag_dict,
-                         "mean_quality": pylab.mean(mean_qualities)
+        results = self.collect(["mean_quality"] + _basic_metrics)
+        self._summary = {"mapq": results["mapq"].as_dict(),
+                         "read_length": results["read_length"].as_dict(),
+                         "flags": results["flags"].as_dict(),
+                         "mean_quality": results["mean_quality"].mean
                          }
         return self._summary
     summary = property(_get_summary)
@@ -419,6 +1731,10 @@ class SAMBAMbase():
     def get_flags_as_df(self):
         """Returns decomposed flags as a dataframe
 
+        There is one row per alignment (in the order of the file). Use
+        :meth:`get_samflags_count` if only the number of alignments having
+        each flag is needed.
+
         .. doctest::
 
             >>> from sequana import BAM, sequana_data
@@ -442,18 +1758,30 @@ class SAMBAMbase():
 
         .. seealso:: :class:`SAMFlags` for meaning of each flag
         """
-        flags = [s.flag for s in self]
-        data = [(this, [flag&this for flag in flags])
+        flags = [batch["flag"] for batch in _iter_batches(self._data, ["flag"])]
+        flags = np.concatenate(flags) if flags else np.zeros(0, dtype=np.int64)
+        data = [(this, flags & this)
             for this in (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048)]
         df = pd.DataFrame(dict(data))
 
         # special case of flag 0 has to be handled separetely. Indeed 0 & 0 is 0
         # If flag is zero, we store 1, otherwise 0
-        df[0] = [1 if x==0 else 0 for x in flags]
+        df[0] = (flags == 0).astype(int)
 
         df = df > 0
         return df
 
+    def get_flags_count(self):
+        """Return the number of alignments having each flag (series)
+
+        Same as *get_flags_as_df().sum()* but computed from the histogram of
+        the flags (see :meth:`get_samflags_count`). The index 0 is the
+        number of alignments with no flag set.
+        """
+        counts = self.get_samflags_count()
+        counts[0] = int(self._get_metric("flags").counts[0])
+        return pd.Series(counts).sort_index()
+
     def plot_bar_flags(self, logy=True, fontsize=16, filename=None):
         """Plot an histogram of the flags contained in the BAM
 
@@ -466,8 +1794,7 @@ class SAMBAMbase():
 
         .. seealso:: :class:`SAMFlags` for meaning of each flag
         """
-        df = self.get_flags_as_df()
-        df = df.sum()
+        df = self.get_flags_count()
         pylab.clf()
         if logy is True:
             barplot = df.plot(kind='bar', logy=logy, grid=True)
@@ -517,13 +1844,17 @@ class SAMBAMbase():
 
     @_reset
     def get_mapq_as_df(self):
-        """Return dataframe with mapq for each read"""
-        df = pd.DataFrame({'mapq': [this.mapq for this in self]})
-        return df
+        """Return dataframe with mapq for each read (in the order of the
+        file)"""
+        mapq = [batch["mapping_quality"] for batch in
+            _iter_batches(self._data, ["mapping_quality"])]
+        mapq = np.concatenate(mapq) if mapq else np.zeros(0, dtype=np.int64)
+        return pd.DataFrame({'mapq': mapq})
 
     @_reset
     def get_mapped_read_length(self):
-        """Return dataframe with read length for each read
+        """Return list with read length for each mapped read (in the order of
+        the file)
 
 
         .. plot::
@@ -534,8 +1865,10 @@ class SAMBAMbase():
             hist(b.get_mapped_read_length())
 
         """
-        read_length = [read.reference_length for read in self
-                       if read.is_unmapped is False]
+        read_length = []
+        for batch in _iter_batches(self._data, ["flag", "reference_length"]):
+            mapped = (batch["flag"] & 4) == 0
+            read_length.extend(batch["reference_length"][mapped].tolist())
         return read_length
 
     def get_samflags_count(self):
@@ -544,13 +1877,7 @@ class SAMBAMbase():
 
         :return: dictionary with keys as SAM flags
         """
-        samflags = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048)
-        samflags_count = dict.fromkeys(samflags, 0)
-        for flag, count in self.summary["flags"].items():
-            for samflag in samflags:
-                if flag&samflag != 0:
-                    samflags_count[samflag] += count
-        return samflags_count
+        return self._get_metric("flags").get_samflags_count()
 
 
     def plot_bar_mapq(self, fontsize=16, filename=None, ):
@@ -592,18 +1919,21 @@ class SAMBAMbase():
     def get_gc_content(self):
         """Return GC content for all reads (mapped or not)
 
+        Reads without sequence are ignored. This method keeps one value per
+        read; the histogram is available with the *gc* metric of
+        :meth:`collect`.
+
         .. seealso:: :meth:`plot_gc_content`
 
         """
-        data = [(f.seq.count("C") + f.seq.count('G')) / len(f.seq)*100. for f in self]
+        data = []
+        for batch in _iter_batches(self._data, ["query_sequence"]):
+            data.extend(_gc_content(batch["query_sequence"]).tolist())
         return data
 
-    @_reset
     def get_length_count(self):
         """Return counter of all fragment lengths"""
-        import collections
-        data = [this.rlen for this in self]
-        return collections.Counter(data)
+        return Counter(self._get_metric("query_length").as_dict())
 
     def plot_gc_content(self, fontsize=16, ec="k", bins=100):
         """plot GC content histogram
@@ -620,16 +1950,16 @@ class SAMBAMbase():
             b.plot_gc_content()
 
         """
-        data = self.get_gc_content()
+        metric = self.collect(["gc"])["gc"]
         try:
             X = np.linspace(0, 100, bins)
         except:
             X = bins.copy()
 
-        pylab.hist(data, X, density=True, ec=ec)
+        pylab.hist(metric.bins, X, weights=metric.counts, density=True, ec=ec)
         pylab.grid(True)
-        mu = pylab.mean(data)
-        sigma = pylab.std(data)
+        mu = metric.mean
+        sigma = metric.std
 
         X = pylab.linspace(X.min(), X.max(), 100)
 
@@ -668,33 +1998,22 @@ class SAMBAMbase():
         # this scans the alignments once for all
         self.alignments = [this for this in self]
 
-    @_reset
     def _set_coverage(self):
-        try: self.alignments
-        except: self._set_alignments()
-
-        reference_start = [this.reference_start for this in self.alignments]
-        reference_end = [this.reference_end for this in self.alignments]
-        N = max([this for this in reference_end if this])
+        # as in previous versions, the depths of all references are summed
+        # (position by position) up to the largest end of the alignments
+        metric = self.collect(["coverage"])["coverage"]
+        depths = [metric.get_depth(i) for i in range(len(metric.references))]
+        coverage = np.zeros(max([len(x) for x in depths] + [0]))
+        for depth in depths:
+            coverage[0:len(depth)] += depth
+        nonzero = np.flatnonzero(coverage)
+        self.coverage = coverage[0:nonzero[-1] + 1 if len(nonzero) else 0]
 
-        self.coverage = np.zeros(N)
-        for x, y in zip(reference_start, reference_end):
-            if y and x>=0 and y>=0: self.coverage[x:y] += 1
-            else: pass
-
-    @_reset
     def _set_indels(self):
-        try: self.alignments
-        except: self._set_alignments()
-
-        self.insertions = []
-        self.deletions = []
-        for this in self.alignments:
-            if this.cigarstring:
-                if "I" in this.cigarstring:
-                    self.insertions.extend([x[1] for x in this.cigartuples if x[0] == 1])
-                if "D" in this.cigarstring:
-                    self.deletions.extend([x[1] for x in this.cigartuples if x[0] == 2])
+        # histograms of insertions/deletions lengths (see IndelMetric)
+        metric = self.collect(["indels"])["indels"]
+        self.insertions = metric.insertions
+        self.deletions = metric.deletions
 
     def plot_coverage(self):
         """Please use :class:`GenomeCov` for more sophisticated
@@ -753,20 +2072,21 @@ class SAMBAMbase():
         instance 10M1I10M1I stored only 1 insertion in its report; Same comment
         for deletions.
 
-        .. todo:: speed up and handle long reads cases more effitiently by 
-            storing INDELS as histograms rather than lists
+        Indels are stored as histograms (see :class:`IndelMetric`); indels
+        longer than 1000 are counted as indels of length 1000.
         """
         try:
             self.insertions
         except:
             self._set_indels()
 
-        if len(self.insertions) ==0 or len(self.deletions) == 0:
+        if self.insertions.sum() == 0 or self.deletions.sum() == 0:
             raise ValueError("No deletions or insertions found")
 
-        N = max(max(Counter(self.deletions)), max(Counter(self.insertions))) + 1
-        D = [self.deletions.count(i) for i in range(N)]
-        I = [self.insertions.count(i) for i in range(N)]
+        N = max(np.nonzero(self.deletions)[0].max(),
+            np.nonzero(self.insertions)[0].max()) + 1
+        D = self.deletions[0:N].tolist()
+        I = self.insertions[0:N].tolist()
         R = [i/d if d!=0 else 0 for i,d in zip(I, D)]
         fig, ax = pylab.subplots()
         ax.plot(range(N), I, marker="x", label="Insertions")
@@ -786,19 +2106,22 @@ class SAMBAMbase():
 
 class SAM(SAMBAMbase):
     """SAM Reader. See :class:`~samtools.bamtools.SAMBAMBase` for details"""
-    def __init__(self, filename, *args):
-        super(SAM, self).__init__(filename, mode="r", *args)
+    def __init__(self, filename, *args, threads=1, cache=None):
+        super(SAM, self).__init__(filename, mode="r", *args, threads=threads,
+            cache=cache)
 
 class CRAM(SAMBAMbase):
     """CRAM Reader. See :class:`~sequana.bamtools.SAMBAMBase` for details"""
-    def __init__(self, filename, *args):
-        super(CRAM, self).__init__(filename, mode="r", *args)
+    def __init__(self, filename, *args, threads=1, cache=None):
+        super(CRAM, self).__init__(filename, mode="r", *args, threads=threads,
+            cache=cache)
 
 
 class BAM(SAMBAMbase):
     """BAM reader. See :class:`~sequana.bamtools.SAMBAMBase` for details"""
-    def __init__(self, filename, *args):
-        super(BAM, self).__init__(filename, mode="rb", *args)
+    def __init__(self, filename, *args, threads=1, cache=None):
+        super(BAM, self).__init__(filename, mode="rb", *args, threads=threads,
+            cache=cache)
 
 
 
@@ -950,10 +2273,11 @@ class CS(dict):
 
         >>> from sequana import CS
         >>> CS('-a:6-g:14+g:2+c:9*ac:10-a:13-a')
-        {'D': 3, 'I': 2, 'M': 54, 'S': 1}
+        {'D': 4, 'I': 2, 'M': 54, 'S': 1}
 
     When using some mapper, CIGAR are stored in another format called CS, which
     also includes the substitutions. See minimap2 documentation for details.
+    To parse many tags at once, use :func:`sequana.cigar.get_cs_counts`.
     """
     def __init__(self, tag):
         self.tag = tag
@@ -962,26 +2286,8 @@ class CS(dict):
             self[k] = v
 
     def _scan(self):
-        d = {"M":0, "I":0, "D":0, "S":0}
-        current = ":"  # this is just to start the loop with a key (set to 0)
-        number = "0"
-
-        for c in self.tag:
-            if c in ":+-*":
-                if current == ":":
-                    d["M"] += int(number)
-                elif current == "+":
-                    d["I"] += len(number)
-                elif current == "-":
-                    d["D"] += len(number)
-                elif current == "*":
-                    d["S"] += len(number)
-                current = c
-                number = ""
-            else: # a letter or number
-                number += c
-        assert d['S'] % 2 == 0
-        d['S'] //= 2
-        return d
+        from sequana.cigar import get_cs_counts, cs_types
+        counts = get_cs_counts([self.tag])[0]
+        return {key: int(value) for key, value in zip(cs_types, counts)}
 
 
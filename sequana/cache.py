@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of Sequana software
+#
+#  Copyright (c) 2016 - Sequana Development Team
+#
+#  File author(s):
+#      Thomas Cokelaer <thomas.cokelaer@pasteur.fr>
+#
+#  Distributed under the terms of the 3-clause BSD license.
+#  The full license is in the LICENSE file, distributed with this software.
+#
+#  website: https://github.com/sequana/sequana
+#  documentation: http://sequana.readthedocs.io
+#
+##############################################################################
+"""Persistent cache of statistics computed on input files
+
+Statistics computed on large files (e.g. histograms of a BAM file) are
+stored as numpy arrays in .npz files so that they are not computed again as
+long as the input file is unchanged::
+
+    from sequana.cache import StatsCache
+    cache = StatsCache()
+    data = cache.get("test.bam", "flags")
+    if data is None:
+        data = {"counts": compute_flags("test.bam")}
+        cache.set("test.bam", "flags", data)
+
+An entry is identified by the input file (absolute path), the name of the
+statistics and its parameters. The size and modification time of the input
+file are stored with the entry; the entry is ignored (and removed) if the
+file changed.
+
+Entries are stored next to the input file (in a *filename.sequana_cache*
+directory) or in a cache directory shared by all input files.
+
+.. autosummary::
+
+    StatsCache
+
+"""
+import os
+import json
+import glob
+import shutil
+import hashlib
+
+from sequana.lazy import numpy as np
+from sequana.lazy import pandas as pd
+
+from sequana import logger
+
+
+__all__ = ["StatsCache", "get_cache"]
+
+
+def _get_hash(data):
+    data = json.dumps(data, sort_keys=True).encode()
+    return hashlib.sha1(data).hexdigest()[0:16]
+
+
+class StatsCache(object):
+    """Store statistics (dictionaries of numpy arrays) computed on files
+
+    ::
+
+        cache = StatsCache("cache_directory", max_size=1e9)
+        cache.set("test.bam", "mapq", {"counts": counts}, params={"min": 0})
+        cache.get("test.bam", "mapq", params={"min": 0})["counts"]
+        cache.invalidate("test.bam")
+
+    Data frames can be stored with :meth:`set_dataframe` and
+    :meth:`get_dataframe`.
+    """
+    def __init__(self, directory=None, max_size=None):
+        """.. rubric:: constructor
+
+        :param str directory: where to store the entries. If None, entries
+            are stored next to each input file, in a directory named after
+            the input file with the *.sequana_cache* extension.
+        :param int max_size: maximum size of the cache in bytes. When the
+            size is exceeded, the least recently used entries are removed.
+            Entries larger than *max_size* are not kept. With
+            *directory* set to None, the limit applies to the entries of
+            each input file.
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+    def _get_directory(self, filename):
+        filename = os.path.abspath(filename)
+        if self.directory is None:
+            return filename + ".sequana_cache"
+        return os.path.join(self.directory, _get_hash(filename))
+
+    def _get_entry(self, filename, name, params):
+        return os.path.join(self._get_directory(filename),
+            "{}_{}.npz".format(name, _get_hash(params or {})))
+
+    def _get_stat(self, filename):
+        stat = os.stat(filename)
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    def get(self, filename, name, params=None):
+        """Return the data stored for a file or None
+
+        :param str filename: the input file
+        :param str name: name of the statistics
+        :param dict params: parameters used to compute the statistics
+        :return: dictionary of numpy arrays or None if there is no entry or
+            if the input file changed since the entry was stored.
+        """
+        entry = self._get_entry(filename, name, params)
+        try:
+            with np.load(entry, allow_pickle=False) as fin:
+                data = {key: fin[key] for key in fin.files}
+        except (IOError, OSError, ValueError):
+            return None
+        meta = json.loads(str(data.pop("__meta__")))
+        if meta != self._get_stat(filename):
+            logger.info("{} changed. Removing {}".format(filename, entry))
+            self._remove(entry)
+            return None
+        # keep track of the last access for the size limit
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return data
+
+    def set(self, filename, name, data, params=None):
+        """Store data computed on a file
+
+        :param str filename: the input file
+        :param str name: name of the statistics
+        :param dict data: dictionary of numpy arrays (or values that can be
+            converted into arrays without pickling)
+        :param dict params: parameters used to compute the statistics (must
+            be serialisable in JSON)
+        """
+        entry = self._get_entry(filename, name, params)
+        data = dict(data, __meta__=json.dumps(self._get_stat(filename)))
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            # write in a temporary file first so that concurrent readers
+            # never see a partial entry
+            temp = entry + ".%s.tmp.npz" % os.getpid()
+            np.savez(temp, **data)
+            os.replace(temp, entry)
+        except (IOError, OSError, ValueError) as err:
+            logger.warning("Could not save {} in the cache: {}".format(name,
+                err))
+            return
+        if self.max_size is not None:
+            self._shrink(os.path.dirname(entry) if self.directory is None
+                else self.directory)
+
+    def get_dataframe(self, filename, name, params=None):
+        """Return a dataframe stored with :meth:`set_dataframe` or None"""
+        data = self.get(filename, name, params)
+        if data is None:
+            return None
+        columns = [str(x) for x in data.pop("__columns__")]
+        return pd.DataFrame({x: data["column_%s" % i] for i, x in
+            enumerate(columns)}, columns=columns)
+
+    def set_dataframe(self, filename, name, df, params=None):
+        """Store a dataframe (columns only; the index is not stored)
+
+        Columns must have a numeric or string type. Columns of objects are
+        stored as floats (None being NaN) if possible, as strings otherwise.
+        """
+        data = {"column_%s" % i: df[x].values for i, x in enumerate(df.columns)}
+        data["__columns__"] = np.array([str(x) for x in df.columns])
+        for key, values in data.items():
+            if values.dtype == object:
+                numeric = all(x is None or isinstance(x, (int, float, np.number))
+                    for x in values)
+                data[key] = values.astype(float if numeric else str)
+        self.set(filename, name, data, params)
+
+    def _remove(self, entry):
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+
+    def _shrink(self, directory):
+        # remove the least recently used entries
+        entries = []
+        for entry in glob.glob(os.path.join(directory, "**", "*.npz"),
+                recursive=True):
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        total = sum(x[1] for x in entries)
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._remove(entry)
+            total -= size
+
+    def invalidate(self, filename, name=None):
+        """Remove the entries of a file
+
+        :param str filename: the input file
+        :param str name: remove the entries of these statistics only (all
+            entries by default)
+        """
+        directory = self._get_directory(filename)
+        if name is None:
+            shutil.rmtree(directory, ignore_errors=True)
+        else:
+            pattern = "{}_{}.npz".format(name, "[0-9a-f]" * 16)
+            for entry in glob.glob(os.path.join(directory, pattern)):
+                self._remove(entry)
+
+    def clear(self):
+        """Remove all entries (of the cache directory)"""
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def get_cache(cache):
+    """Return a :class:`StatsCache` given a *cache* parameter
+
+    :param cache: None or False (no cache), True (entries stored next to the
+        input files), the path of a cache directory or a
+        :class:`StatsCache` instance.
+    """
+    if cache is None or cache is False:
+        return None
+    elif cache is True:
+        return StatsCache()
+    elif isinstance(cache, str):
+        return StatsCache(cache)
+    return cache
@@ -14,11 +14,189 @@
 #  documentation: http://sequana.readthedocs.io
 #
 ##############################################################################
-import re
+"""CIGAR and cs tag parsers
 
+.. autosummary::
+
+    Cigar
+    get_cigar_counts
+    get_cigar_operations
+    get_cs_counts
+
+:class:`Cigar` manipulates a single CIGAR string. To get the number of
+bases of each operation for many alignments at once, use
+:func:`get_cigar_counts` (CIGAR strings or pysam cigartuples) and
+:func:`get_cs_counts` (cs tags from minimap2), which parse all inputs in a
+few numpy operations. :func:`get_cigar_operations` returns the individual
+operations of many CIGARs.
 """
-Note: could use pysam most probably to improve the speed.
-"""
+import re
+
+from sequana.lazy import numpy as np
+
+
+__all__ = ["Cigar", "get_cigar_counts", "get_cigar_operations",
+    "get_cs_counts"]
+
+
+#: CIGAR operations in the order of their code in the BAM format
+cigar_types = "MIDNSHP=XB"
+
+#: columns of the array returned by :func:`get_cs_counts`
+cs_types = "MIDS"
+
+
+def _to_buffer(strings):
+    # concatenate strings into a uint8 buffer (None is an empty string)
+    from sequana.kmer import _to_buffer
+    return _to_buffer([x or "" for x in strings])
+
+
+def _parse_numbers(buf, digits, ends):
+    # value of the numbers made of the digits at positions *digits*; each
+    # number ends before the position *ends* (one per digit)
+    return (buf[digits] - 48).astype(np.int64) * 10 ** (ends - digits - 1)
+
+
+def get_cigar_operations(cigars):
+    """Return all operations of many CIGARs
+
+    :param cigars: list of CIGAR strings or of cigartuples (as returned by
+        pysam). None or empty CIGARs (unmapped reads) are accepted.
+    :return: three numpy arrays with one item per operation: index of the
+        CIGAR in the input list, code of the operation (index in
+        :attr:`cigar_types`) and length. Operations are in the order of
+        the CIGARs.
+
+    ::
+
+        >>> from sequana.cigar import get_cigar_operations
+        >>> rows, codes, lengths = get_cigar_operations(["10S80M", "5M1I5M"])
+        >>> rows
+        array([0, 0, 1, 1, 1])
+        >>> codes
+        array([4, 0, 0, 1, 0])
+
+    Unknown operations are ignored.
+    """
+    N = len(cigars)
+    first = next((x for x in cigars if x), None)
+    if first is None:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+
+    if isinstance(first, (str, bytes)):
+        buf, offsets = _to_buffer(cigars)
+        lookup = np.full(256, -1, dtype=np.int64)
+        lookup[np.frombuffer(cigar_types.encode(), dtype=np.uint8)] = \
+            np.arange(len(cigar_types))
+        isdigit = (buf >= 48) & (buf <= 57)
+        operations = np.nonzero(~isdigit)[0]
+        digits = np.nonzero(isdigit)[0]
+        # each digit belongs to the number before the next operation
+        index = np.searchsorted(operations, digits)
+        keep = index < len(operations)
+        digits, index = digits[keep], index[keep]
+        lengths = np.bincount(index, minlength=len(operations),
+            weights=_parse_numbers(buf, digits, operations[index]))
+        lengths = lengths.astype(np.int64)
+        rows = np.searchsorted(offsets, operations, side="right") - 1
+        codes = lookup[buf[operations]]
+    else:
+        sizes = [len(x) if x else 0 for x in cigars]
+        data = np.array([item for x in cigars if x for item in x],
+            dtype=np.int64).reshape(-1, 2)
+        rows = np.repeat(np.arange(N), sizes)
+        codes, lengths = data[:, 0], data[:, 1]
+
+    keep = (codes >= 0) & (codes < len(cigar_types))
+    return rows[keep], codes[keep], lengths[keep]
+
+
+def get_cigar_counts(cigars):
+    """Return the number of bases of each CIGAR operation for many alignments
+
+    :param cigars: list of CIGAR strings or of cigartuples (as returned by
+        pysam). None or empty CIGARs (unmapped reads) are accepted.
+    :return: numpy array with one row per CIGAR and one column per
+        operation (in the order of :attr:`cigar_types` i.e. MIDNSHP=XB)
+
+    ::
+
+        >>> from sequana.cigar import get_cigar_counts
+        >>> get_cigar_counts(["10S80M5I5I1D", "2H10="])
+        array([[80, 10,  1,  0, 10,  0,  0,  0,  0,  0],
+               [ 0,  0,  0,  0,  0,  2,  0, 10,  0,  0]])
+
+    Unknown operations are ignored.
+    """
+    N = len(cigars)
+    rows, codes, lengths = get_cigar_operations(cigars)
+    counts = np.bincount(rows * len(cigar_types) + codes, weights=lengths,
+        minlength=N * len(cigar_types)).astype(np.int64)
+    return counts.reshape(N, len(cigar_types))
+
+
+def get_cs_counts(tags):
+    """Return matches, insertions, deletions and substitutions of cs tags
+
+    :param tags: list of cs tags (as created by minimap2 with the --cs
+        option, short or long form). None or empty tags are accepted.
+    :return: numpy array with one row per tag and 4 columns (see
+        :attr:`cs_types`): number of matching bases, inserted bases, deleted
+        bases and substitutions.
+
+    ::
+
+        >>> from sequana.cigar import get_cs_counts
+        >>> get_cs_counts([":6-g:14+g:2+c:9*ac:10-a"])
+        array([[41,  2,  2,  1]])
+
+    Introns (~ operations) are ignored.
+    """
+    N = len(tags)
+    counts = np.zeros((N, len(cs_types)), dtype=np.int64)
+    buf, offsets = _to_buffer(tags)
+    if len(buf) == 0:
+        return counts
+
+    isop = np.zeros(256, dtype=bool)
+    isop[np.frombuffer(b":+-*=~", dtype=np.uint8)] = True
+    operations = np.nonzero(isop[buf])[0]
+    rows = np.searchsorted(offsets, operations, side="right") - 1
+    # a token ends at the next operation or at the end of its tag
+    ends = np.append(operations[1:], len(buf))
+    ends = np.minimum(ends, offsets[rows + 1])
+    sizes = ends - operations - 1
+    kinds = buf[operations]
+
+    # numbers of the :N operations
+    colon = kinds == ord(":")
+    isdigit = (buf >= 48) & (buf <= 57)
+    digits = np.nonzero(isdigit)[0]
+    index = np.searchsorted(operations, digits, side="right") - 1
+    keep = (index >= 0)
+    digits, index = digits[keep], index[keep]
+    keep = colon[index]
+    digits, index = digits[keep], index[keep]
+    numbers = np.bincount(index, minlength=len(operations),
+        weights=_parse_numbers(buf, digits, ends[index])).astype(np.int64)
+
+    for column, (values, mask) in enumerate((
+            (numbers, colon),
+            (sizes, kinds == ord("+")),
+            (sizes, kinds == ord("-")),
+            (sizes, kinds == ord("*")))):
+        counts[:, column] = np.bincount(rows[mask], weights=values[mask],
+            minlength=N).astype(np.int64)
+    # long form: =ACGT are matches
+    mask = kinds == ord("=")
+    counts[:, 0] += np.bincount(rows[mask], weights=sizes[mask],
+        minlength=N).astype(np.int64)
+    # substitutions are stored as *ac (2 characters)
+    counts[:, 3] //= 2
+    return counts
+
 
 class Cigar(object):
     """
@@ -62,8 +240,9 @@ class Cigar(object):
 
     :reference: https://github.com/samtools/htslib/blob/develop/htslib/sam.h
     """
-    __slots__ = ['cigarstring']
+    __slots__ = ['cigarstring', '_cache']
     pattern = '(\d+)([A-Za-z])?'
+    _regex = re.compile(pattern)
     # could use a dictionary. would be faster
     #: valid CIGAR types
     types = "MIDNSHP=XB"
@@ -79,6 +258,8 @@ class Cigar(object):
         """
         #: the CIGAR string attribute
         self.cigarstring = cigarstring
+        # decomposition of the CIGAR string (parsed once)
+        self._cache = None
 
     def __str__(self):
         return self.cigarstring
@@ -91,7 +272,12 @@ class Cigar(object):
 
     def _decompose(self):
         # x is the type, y the number. Note the inversion in the tuple
-        return ((y, int(x)) for x,y in re.findall(self.pattern, self.cigarstring))
+        # The result is cached (and updated if cigarstring is changed)
+        if self._cache is None or self._cache[0] != self.cigarstring:
+            data = tuple((y, int(x)) for x, y in
+                self._regex.findall(self.cigarstring))
+            self._cache = (self.cigarstring, data)
+        return iter(self._cache[1])
 
     def as_sequence(self):
         return "".join( ( y*x for x,y in self._decompose()) ) 
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of Sequana software
+#
+#  Copyright (c) 2016 - Sequana Development Team
+#
+#  File author(s):
+#      Thomas Cokelaer <thomas.cokelaer@pasteur.fr>
+#      Dimitri Desvillechabrol <dimitri.desvillechabrol@pasteur.fr>,
+#          <d.desvillechabrol@gmail.com>
+#
+#  Distributed under the terms of the 3-clause BSD license.
+#  The full license is in the LICENSE file, distributed with this software.
+#
+#  website: https://github.com/sequana/sequana
+#  documentation: http://sequana.readthedocs.io
+#
+##############################################################################
+"""Demultiplexing of FastQ files
+
+Reads are assigned to the samples of an experimental design file (see
+:mod:`sequana.expdesign`) using their index (barcode) sequences. Indices are
+read from the read identifiers (e.g. *1:N:0:ATCACG+GTAAGG* with Illumina
+1.8+) or from index FastQ files (I1/I2)::
+
+    from sequana.demultiplex import Demultiplexer
+    demux = Demultiplexer("SampleSheet.csv", mismatches=1)
+    stats = demux.run("Undetermined_R1_.fastq.gz",
+        paired_filename="Undetermined_R2_.fastq.gz",
+        output_directory="demultiplexed")
+
+Barcodes are matched with a lookup table of all sequences within
+*mismatches* of a barcode (see :class:`BarcodeMatcher`) so that each read
+costs a single dictionary lookup. Sequences that are within *mismatches* of
+several barcodes are ambiguous and never assigned.
+"""
+import os
+import json
+import itertools
+from collections import Counter
+
+from sequana.lazy import numpy as np
+from sequana.fastq import FastQBlockReader
+from sequana.tools import ThreadedWriter
+
+import colorlog
+logger = colorlog.getLogger(__name__)
+
+
+__all__ = ["BarcodeMatcher", "Demultiplexer", "UNDETERMINED", "AMBIGUOUS"]
+
+
+#: code of reads that match no barcode
+UNDETERMINED = -1
+#: code of reads that match several barcodes (within the mismatches)
+AMBIGUOUS = -2
+
+
+def _zip_readers(readers):
+    # yield tuples of batches with same number of reads from several readers
+    # (see sequana.fastq._zip_batches for two readers)
+    readers = [iter(x) for x in readers]
+    batches = [None] * len(readers)
+    while True:
+        batches = [x if x else next(reader, None)
+            for x, reader in zip(batches, readers)]
+        if any(x is None for x in batches):
+            if any(x for x in batches):
+                raise ValueError("input files have different number of reads")
+            return
+        N = min(len(x) for x in batches)
+        yield tuple(x[0:N] for x in batches)
+        batches = [x[N:] for x in batches]
+
+
+def _reverse_complement(sequence):
+    return sequence.translate(bytes.maketrans(b"ACGTN", b"TGCAN"))[::-1]
+
+
+class BarcodeMatcher(object):
+    """Lookup table of barcodes and of their variants
+
+    ::
+
+        >>> matcher = BarcodeMatcher(["ACGTAC", "TTGGCC"], mismatches=1)
+        >>> matcher.lookup([b"ACGTAC", b"ACGTAA", b"GGGGGG"])
+        (array([ 0,  0, -1]), array([0, 1, 0]))
+
+    All sequences within *mismatches* substitutions (including N) of a
+    barcode are stored in a dictionary. A variant of several barcodes is
+    marked as :data:`AMBIGUOUS` and reported in :attr:`collisions`. An exact
+    barcode always takes precedence over a variant of another barcode.
+    """
+    def __init__(self, barcodes, mismatches=1):
+        """.. rubric:: constructor
+
+        :param list barcodes: barcodes (strings or bytes) of same length
+        :param int mismatches: maximum number of mismatches
+        """
+        self.barcodes = [x.encode() if isinstance(x, str) else x
+            for x in barcodes]
+        self.mismatches = mismatches
+        if len(set(self.barcodes)) != len(self.barcodes):
+            raise ValueError("Barcodes must be unique")
+        lengths = set(len(x) for x in self.barcodes)
+        if len(lengths) > 1:
+            raise ValueError("Barcodes must have the same length")
+        self.length = lengths.pop() if lengths else 0
+
+        #: list of (variant, barcode1, barcode2) ambiguous sequences
+        self.collisions = []
+        self._table = {}
+        for index, barcode in enumerate(self.barcodes):
+            self._table[barcode] = (index, 0)
+        for distance in range(1, mismatches + 1):
+            for index, barcode in enumerate(self.barcodes):
+                for variant in self._get_variants(barcode, distance):
+                    self._add(variant, index, distance)
+
+        if self.collisions:
+            logger.warning("%s sequences are within %s mismatches of several "
+                "barcodes and will not be assigned" % (len(self.collisions),
+                mismatches))
+
+    def _get_variants(self, barcode, distance):
+        for positions in itertools.combinations(range(len(barcode)), distance):
+            choices = [[x for x in b"ACGTN" if x != barcode[i]]
+                for i in positions]
+            for letters in itertools.product(*choices):
+                variant = bytearray(barcode)
+                for position, letter in zip(positions, letters):
+                    variant[position] = letter
+                yield bytes(variant)
+
+    def _add(self, variant, index, distance):
+        current, current_distance = self._table.get(variant, (None, None))
+        if current is None:
+            self._table[variant] = (index, distance)
+        elif current_distance < distance or current == index:
+            # closer to another barcode (or already stored)
+            return
+        elif current != AMBIGUOUS:
+            self.collisions.append((variant, self.barcodes[current],
+                self.barcodes[index]))
+            self._table[variant] = (AMBIGUOUS, distance)
+
+    def __len__(self):
+        return len(self._table)
+
+    def lookup(self, sequences):
+        """Return the barcode index and number of mismatches of sequences
+
+        :param sequences: list of sequences (bytes). Sequences longer than the
+            barcodes are truncated.
+        :return: two numpy arrays with the index of the barcode (or
+            :data:`UNDETERMINED` or :data:`AMBIGUOUS`) and the number of
+            mismatches.
+        """
+        L = self.length
+        default = (UNDETERMINED, 0)
+        table = self._table
+        results = [table.get(x[0:L], default) for x in sequences]
+        results = np.array(results, dtype=np.int64).reshape(len(results), 2)
+        return results[:, 0], results[:, 1]
+
+
+class Demultiplexer(object):
+    """Assign reads to samples using single or dual indices
+
+    ::
+
+        from sequana.demultiplex import Demultiplexer
+        demux = Demultiplexer({"A": "ACGTAC", "B": "TTGGCC"})
+        stats = demux.run("undetermined.fastq.gz", output_directory="out")
+        stats["samples"]["A"]["reads"]
+
+    Output files are named after the sample identifiers
+    (*{sample}_R1_.fastq.gz*, *{sample}_R2_.fastq.gz*). Unassigned reads are
+    written in *Undetermined_R1_.fastq.gz*. Files are written and compressed
+    concurrently (see :class:`sequana.tools.ThreadedWriter`).
+    """
+    def __init__(self, design, mismatches=1, lane=None,
+            reverse_complement_index2=False):
+        """.. rubric:: constructor
+
+        :param design: an experimental design file or instance of
+            :class:`~sequana.expdesign.ExpDesignAdapter`, or a dictionary
+            mapping sample identifiers to an index sequence or to a pair of
+            index sequences.
+        :param int mismatches: number of mismatches allowed per index
+        :param lane: if the design file has a *Lane* column, use only the
+            samples of that lane.
+        :param bool reverse_complement_index2: reverse complement the second
+            index of the design (depends on the sequencer).
+        """
+        if not isinstance(design, dict):
+            design = self._read_design(design, lane)
+        if not design:
+            raise ValueError("No sample with index sequences found")
+
+        self.samples = list(design.keys())
+        indices = [design[x] if isinstance(design[x], (list, tuple))
+            else (design[x],) for x in self.samples]
+        self.dual = len(indices[0]) == 2
+        if any(len(x) != len(indices[0]) for x in indices):
+            raise ValueError("All samples must have the same number of indices")
+        indices = [tuple(x.encode() if isinstance(x, str) else x for x in this)
+            for this in indices]
+        if reverse_complement_index2 and self.dual:
+            indices = [(x, _reverse_complement(y)) for x, y in indices]
+        if len(set(indices)) != len(indices):
+            raise ValueError("Several samples have the same indices")
+        self.indices = indices
+        self.mismatches = mismatches
+
+        self.matcher1 = BarcodeMatcher(sorted(set(x[0] for x in indices)),
+            mismatches)
+        # sample number of each combination of index1 (and index2)
+        index1 = [self.matcher1.barcodes.index(x[0]) for x in indices]
+        if self.dual:
+            self.matcher2 = BarcodeMatcher(sorted(set(x[1] for x in indices)),
+                mismatches)
+            index2 = [self.matcher2.barcodes.index(x[1]) for x in indices]
+            N2 = len(self.matcher2.barcodes)
+        else:
+            index2, N2 = [0] * len(indices), 1
+        self._samples = np.full(len(self.matcher1.barcodes) * N2, UNDETERMINED,
+            dtype=np.int64)
+        self._samples[np.array(index1) * N2 + np.array(index2)] = \
+            np.arange(len(indices))
+
+    def _read_design(self, design, lane):
+        from sequana.expdesign import ExpDesignAdapter
+        df = ExpDesignAdapter(design, verbose=False).df
+        if lane is not None:
+            df = df[df["Lane"] == lane]
+        design = {}
+        for _, row in df.iterrows():
+            index1 = row.get("Index1_Seq")
+            index2 = row.get("Index2_Seq")
+            if not isinstance(index1, str):
+                logger.warning("Sample %s has no index. Skipped" % row["Sample_ID"])
+                continue
+            this = (index1, index2) if isinstance(index2, str) else index1
+            if design.get(row["Sample_ID"], this) != this:
+                raise ValueError("Sample %s has several indices. Set the lane "
+                    "parameter" % row["Sample_ID"])
+            design[row["Sample_ID"]] = this
+        return design
+
+    def _get_header_indices(self, identifiers):
+        # Illumina 1.8+: @name 1:N:0:ACGTAC+TTGGCC; Illumina 1.4:
+        # @name#ACGTAC/1
+        indices = []
+        for identifier in identifiers:
+            identifier = identifier.rstrip()
+            if b" " in identifier:
+                index = identifier.rsplit(b":", 1)[-1]
+            else:
+                index = identifier.rsplit(b"#", 1)[-1].split(b"/")[0]
+            indices.append(index)
+        if not self.dual:
+            return [indices]
+        pairs = [x.split(b"+", 1) + [b""] for x in indices]
+        return [[x[0] for x in pairs], [x[1] for x in pairs]]
+
+    def assign(self, indices1, indices2=None):
+        """Return sample number and number of mismatches of index sequences
+
+        :param list indices1: first index of the reads (bytes)
+        :param list indices2: second index of the reads (dual indexing)
+        :return: two numpy arrays with the sample number (position in
+            :attr:`samples`) or :data:`UNDETERMINED` or :data:`AMBIGUOUS`
+            and the number of mismatches.
+        """
+        found1, mismatches = self.matcher1.lookup(indices1)
+        if self.dual:
+            found2, mismatches2 = self.matcher2.lookup(indices2)
+            mismatches = mismatches + mismatches2
+            N2 = len(self.matcher2.barcodes)
+        else:
+            found2, N2 = np.zeros(len(found1), dtype=np.int64), 1
+        ok = (found1 >= 0) & (found2 >= 0)
+        samples = np.full(len(found1), UNDETERMINED, dtype=np.int64)
+        samples[ok] = self._samples[found1[ok] * N2 + found2[ok]]
+        samples[(found1 == AMBIGUOUS) | (found2 == AMBIGUOUS)] = AMBIGUOUS
+        return samples, mismatches
+
+    def run(self, filename, output_directory=".", paired_filename=None,
+            index_filenames=None, undetermined=True, compresslevel=6,
+            threads=4, buffer_size=1000000, output_json="demultiplex.json",
+            max_undetermined=1000):
+        """Demultiplex a (paired) FastQ file
+
+        :param str filename: the FastQ file (R1)
+        :param str output_directory: where to write the FastQ files and the
+            JSON statistics (created if needed)
+        :param str paired_filename: the mate file (R2)
+        :param list index_filenames: FastQ files with the index reads (I1 and
+            I2 if dual). If not provided, indices are read from the read
+            identifiers.
+        :param bool undetermined: write the unassigned reads
+        :param int compresslevel: compression level of the output files
+        :param int threads: number of threads used to compress the outputs
+        :param int buffer_size: data of a sample is sent to its writer when
+            it exceeds this size (bytes)
+        :param str output_json: name of the JSON statistics file (in the
+            output directory). Not written if None.
+        :param int max_undetermined: number of most frequent unassigned
+            indices reported in the statistics
+        :return: a dictionary with the statistics (per sample: index,
+            number of reads and number of reads with 0, 1, ... mismatches)
+        """
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+
+        readers = [FastQBlockReader(filename)]
+        if paired_filename:
+            readers.append(FastQBlockReader(paired_filename))
+        nreads = len(readers)
+        if index_filenames:
+            if len(index_filenames) != (2 if self.dual else 1):
+                raise ValueError("one index file per index is required")
+            readers.extend(FastQBlockReader(x) for x in index_filenames)
+
+        batches = _zip_readers(readers)
+        names = self.samples + (["Undetermined"] if undetermined else [])
+        filenames = [[os.sep.join([output_directory,
+            "%s_R%s_.fastq.gz" % (name, i + 1)]) for i in range(nreads)]
+            for name in names]
+
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(threads)
+        writers = [[ThreadedWriter(x, compresslevel=compresslevel,
+            executor=executor) for x in these] for these in filenames]
+        buffers = [[[] for x in these] for these in filenames]
+        sizes = [0] * len(names)
+
+        def flush(i):
+            for writer, data in zip(writers[i], buffers[i]):
+                writer.write(b"".join(data))
+                del data[:]
+            sizes[i] = 0
+
+        nindices = 2 if self.dual else 1
+        counts = np.zeros((len(self.samples), nindices * self.mismatches + 1),
+            dtype=np.int64)
+        n_undetermined, n_ambiguous = 0, 0
+        unknown = Counter()
+        try:
+            for batch in batches:
+                if index_filenames:
+                    indices = [[x.get_sequence(i) for i in range(len(x))]
+                        for x in batch[nreads:]]
+                else:
+                    indices = self._get_header_indices(batch[0].identifiers)
+                samples, mismatches = self.assign(*indices)
+
+                np.add.at(counts, (samples[samples >= 0],
+                    mismatches[samples >= 0]), 1)
+                n_ambiguous += int((samples == AMBIGUOUS).sum())
+                unassigned = np.flatnonzero(samples < 0)
+                n_undetermined += len(unassigned)
+                unknown.update(b"+".join(x[i] for x in indices).decode()
+                    for i in unassigned)
+                if len(unknown) > 10 * max_undetermined:
+                    unknown = Counter(dict(unknown.most_common(max_undetermined)))
+
+                if undetermined:
+                    samples[samples < 0] = len(self.samples)
+                order = np.argsort(samples, kind="stable")
+                bounds = np.searchsorted(samples[order],
+                    np.arange(len(names) + 1))
+                for i in range(len(names)):
+                    these = order[bounds[i]:bounds[i+1]]
+                    if len(these) == 0:
+                        continue
+                    for data, this in zip(buffers[i], batch[0:nreads]):
+                        data.append(this.to_fastq(these))
+                    sizes[i] += len(buffers[i][0][-1])
+                    if sizes[i] > buffer_size:
+                        flush(i)
+            for i in range(len(names)):
+                flush(i)
+        finally:
+            for reader in readers:
+                reader.close()
+            for these in writers:
+                for writer in these:
+                    writer.close(wait=False)
+            for these in writers:
+                for writer in these:
+                    writer.join()
+            executor.shutdown()
+
+        stats = {"samples": {}, "undetermined": n_undetermined,
+            "ambiguous": n_ambiguous,
+            "total": int(counts.sum()) + n_undetermined,
+            "mismatches": self.mismatches,
+            "top_undetermined": dict(unknown.most_common(max_undetermined))}
+        for i, sample in enumerate(self.samples):
+            stats["samples"][sample] = {
+                "index": "+".join(x.decode() for x in self.indices[i]),
+                "reads": int(counts[i].sum()),
+                "mismatch_counts": [int(x) for x in counts[i]],
+                "filenames": filenames[i]}
+        if undetermined:
+            stats["undetermined_filenames"] = filenames[-1]
+        if output_json:
+            with open(os.sep.join([output_directory, output_json]), "w") as fout:
+                json.dump(stats, fout, indent=4, sort_keys=True)
+        return stats
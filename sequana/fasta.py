@@ -18,9 +18,11 @@
 ##############################################################################
 """Utilities to manipulate FASTQ and Reads"""
 import os
+from itertools import islice
+
 from pysam import FastxFile
-from easydev import Progress
 
+from sequana.lazy import pandas as pd
 from sequana import logger
 logger.name = __name__
 
@@ -28,6 +30,11 @@ logger.name = __name__
 __all__ = ["FastA"]
 
 
+# the index of package data files is not saved in the package directory
+_resources = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "resources")
+
+
 def is_fasta(filename):
     with open(filename, "r") as fin:
         try:
@@ -39,19 +46,152 @@ def is_fasta(filename):
             return False
 
 
+def _build_fai(filename):
+    """Return the samtools faidx entries of an uncompressed FastA file
+
+    Each entry is (name, length, offset, line bases, line width). Used if
+    the index cannot be saved (e.g. package data or read-only directory).
+    As with samtools, empty sequences are ignored. Sequences with lines of
+    different lengths (other than the last one) cannot be accessed by
+    offsets: their line bases and line width are set to 0.
+    """
+    entries = []
+    position = 0
+    current = None
+    with open(filename, "rb") as fin:
+        for line in fin:
+            if line.startswith(b">"):
+                if current and current[1]:
+                    entries.append(current)
+                name = line[1:].split(None, 1)[0].decode() if line[1:].strip() else ""
+                current = [name, 0, position + len(line), 0, 0]
+                last = None
+            elif current is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if last is None:
+                    current[3], current[4] = bases, len(line)
+                elif last != (current[3], current[4]) or bases > current[3]:
+                    # only the last line of a sequence can be shorter
+                    current[3], current[4] = 0, 0
+                last = (bases, len(line))
+                current[1] += bases
+            position += len(line)
+    if current and current[1]:
+        entries.append(current)
+    return entries
+
+
+def _read_fai(filename):
+    entries = []
+    with open(filename, "r") as fin:
+        for line in fin:
+            name, length, offset, linebases, linewidth = line.split("\t")[0:5]
+            entries.append([name, int(length), int(offset), int(linebases),
+                int(linewidth)])
+    return entries
+
+
 # cannot inherit from FastxFile (no object in the API ?)
 class FastA(object):
-    """Class to handle FastA files. Cannot be compressed
+    """Class to handle FastA files (uncompressed or BGZF compressed)
 
+    Names and lengths of the sequences are read from a samtools-compatible
+    index (*filename.fai*), which is created on request if missing or older
+    than the input file. Sequences of uncompressed files are read from a
+    memory-mapped file so that fetching a sequence does not decode the
+    others::
 
+        from sequana import FastA
+        fasta = FastA("reference.fasta")
+        fasta.names
+        fasta.lengths
+        fasta["chr1"]                            # whole sequence
+        fasta.get_sequence("chr1", 1000, 2000)   # 0-based, end excluded
+
+    Iterating over the instance yields the pysam records (all sequences are
+    then read). Empty sequences are not indexed. The index of the files
+    distributed with Sequana is kept in memory. So is the index of sequences
+    with lines of different lengths, which are then read with pysam.
+
+    The memory-mapped file is released with :meth:`close` or when used as a
+    context manager::
+
+        with FastA("reference.fasta") as fasta:
+            sequence = fasta["chr1"]
     """
     def __init__(self, filename, verbose=False):
         if filename.endswith(".gz"):
-            raise ValueError("Must be decompressed.")
+            from sequana.tools import is_bgzf
+            if not is_bgzf(filename):
+                raise ValueError("Must be decompressed or compressed with "
+                    "bgzip.")
         self._fasta = FastxFile(filename)
         self.filename = filename
-        logger.info("Reading input fasta file...please wait") 
-        self._N = len([x for x in FastxFile(filename)])
+        # index and memory-mapped file are created on request
+        self._index = None
+        self._positions = None
+        self._entries = None
+        self._mmap = None
+        self._faidx = None
+
+    def _get_index(self):
+        if self._index is None:
+            entries = []
+            if os.path.getsize(self.filename):
+                fai = self.filename + ".fai"
+                if not os.path.exists(fai) or \
+                        os.path.getmtime(fai) < os.path.getmtime(self.filename):
+                    fai = self._save_index()
+                entries = _read_fai(fai) if fai else _build_fai(self.filename)
+            self._index = pd.DataFrame(entries, columns=["name", "length",
+                "offset", "linebases", "linewidth"]).set_index("name")
+            self._positions = dict((name, i)
+                for i, name in enumerate(self._index.index))
+            self._entries = self._index.values.astype("int64")
+        return self._index
+    def _save_index(self):
+        # returns the index filename or None if the index is kept in memory
+        path = os.path.abspath(self.filename)
+        if path.startswith(_resources + os.sep) and \
+                not self.filename.endswith(".gz"):
+            return None
+        logger.info("Indexing %s" % self.filename)
+        try:
+            import pysam
+            pysam.faidx(self.filename)
+        except Exception as err:
+            # e.g. read-only directory or lines of different lengths
+            if self.filename.endswith(".gz"):
+                raise
+            logger.warning("Could not save the index: %s" % err)
+            return None
+        return self.filename + ".fai"
+
+    index = property(_get_index, doc="""Index of the sequences (dataframe)
+
+        Samtools faidx fields: length, offset of the first base in the file,
+        number of bases and of bytes per line.""")
+
+    def close(self):
+        """Close the memory-mapped file (reopened if a sequence is fetched)"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._faidx is not None:
+            self._faidx.close()
+            self._faidx = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
 
     def __iter__(self):
         return self
@@ -76,14 +216,61 @@ class FastA(object):
         return d
 
     def __len__(self):
-        return self._N
+        return len(self.index)
+
+    def __getitem__(self, name):
+        """Return the sequence given its name or position in the file"""
+        return self.get_sequence(name)
+
+    def __contains__(self, name):
+        self._get_index()
+        return name in self._positions
+
+    def get_sequence(self, name, start=None, end=None):
+        """Return a sequence (or part of it) using the index
+
+        :param name: name of the sequence or its position in the file
+        :param int start: 0-based start position
+        :param int end: end position (excluded). Up to the end of the
+            sequence if not provided.
+        """
+        index = self.index
+        if isinstance(name, int):
+            name = index.index[name]
+        if name not in self._positions:
+            raise KeyError("%s not found in %s" % (name, self.filename))
+        length, offset, linebases, linewidth = \
+            self._entries[self._positions[name]]
+        start = 0 if start is None else max(0, min(start, length))
+        end = length if end is None else max(start, min(end, length))
+
+        if self.filename.endswith(".gz"):
+            if self._faidx is None:
+                import pysam
+                self._faidx = pysam.FastaFile(self.filename)
+            return self._faidx.fetch(name, start, end)
+
+        if linebases == 0:
+            # lines of different lengths: the sequence is read with pysam
+            for record in FastxFile(self.filename):
+                if record.name == name:
+                    return record.sequence[start:end]
+
+        if self._mmap is None:
+            import mmap
+            with open(self.filename, "rb") as fin:
+                self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        first = offset + start // linebases * linewidth + start % linebases
+        last = offset + end // linebases * linewidth + end % linebases
+        data = self._mmap[first:last]
+        return data.replace(b"\n", b"").replace(b"\r", b"").decode()
 
     def _get_names(self):
-        return [this.name for this in self]
-    names = property(_get_names)
+        return list(self.index.index)
+    names = property(_get_names, doc="names of the sequences (from the index)")
 
     def _get_sequences(self):
-        return [this.sequence for this in self]
+        return [self.get_sequence(name) for name in self.names]
     sequences = property(_get_sequences)
 
     def _get_comment(self):
@@ -91,8 +278,8 @@ class FastA(object):
     comments = property(_get_comment)
 
     def _get_lengths(self):
-        return [len(this.sequence) for this in self]
-    lengths = property(_get_lengths)
+        return [int(x) for x in self.index["length"]]
+    lengths = property(_get_lengths, doc="lengths of the sequences (from the index)")
 
     def get_lengths_as_dict(self):
         return dict(zip(self.names, self.lengths))
@@ -123,52 +310,91 @@ class FastA(object):
         except FileNotFoundError:
             pass
 
+        # lengths are read from the index so that only the selected contigs
+        # are read
         n = 1
         with open(output_file, "w") as fp:
-            for contigs in self:
-                if len(contigs.sequence) < len_min:
+            for contig, length in zip(self.names, self.lengths):
+                if length < len_min:
                     break
-                name = ">{}_{} {}\n".format(project, n, contigs.name)
-                sequence = "\n".join([contigs.sequence[i:min(i+80, 
-                    len(contigs.sequence))] for i in range(0, 
-                    len(contigs.sequence), 80)]) + "\n"
+                contig_sequence = self.get_sequence(contig)
+                name = ">{}_{} {}\n".format(project, n, contig)
+                sequence = "\n".join([contig_sequence[i:min(i+80,
+                    length)] for i in range(0, length, 80)]) + "\n"
                 fp.write(name + sequence)
                 n += 1
 
-    def select_random_reads(self, N=None, output_filename="random.fasta"):
+    def select_random_reads(self, N=None, output_filename="random.fasta",
+            fraction=None, seed=None):
         """Select random reads and save in a file
 
         :param int N: number of random unique reads to select
             should provide a number but a list can be used as well.
-        :param str output_filename:
+        :param str output_filename: output file (compressed if the extension
+            is .gz)
+        :param float fraction: instead of N, select each read with this
+            probability.
+        :param seed: seed of the random generator (for reproducibility)
+        :return: the set of selected read indices
+
+        The input file is read only once (see
+        :meth:`sequana.fastq.FastQ.select_random_reads` for details).
         """
         import numpy as np
-        thisN = len(self)
-        if isinstance(N, int):
-            if N > thisN:
-                N = thisN
-            # create random set of reads to pick up
-            cherries = list(range(thisN))
-            np.random.shuffle(cherries)
-            # cast to set for efficient iteration
-            cherries = set(cherries[0:N])
-        elif isinstance(N, set):
-            cherries = N
-        elif isinstance(N, list):
+        from sequana.tools import open_writer, ReservoirSampler
+
+        sampler = None
+        if isinstance(N, (set, list)):
             cherries = set(N)
+        elif fraction is not None:
+            random = np.random.RandomState(seed)
+            cherries = set()
+        else:
+            sampler = ReservoirSampler(N, seed=seed)
+
         fasta = FastxFile(self.filename)
-        pb = Progress(thisN) # since we scan the entire file
-        with open(output_filename, "w") as fh:
-            for i, read in enumerate(fasta):
-                if i in cherries:
-                    fh.write(read.__str__() + "\n")
+        count = 0
+        with open_writer(output_filename) as fh:
+            while True:
+                reads = list(islice(fasta, 10000))
+                if not reads:
+                    break
+                if sampler is not None:
+                    sampler.update(reads)
+                    indices = []
+                elif fraction is not None:
+                    indices = np.flatnonzero(
+                        random.random_sample(len(reads)) < fraction)
+                    cherries.update((indices + count).tolist())
                 else:
-                    pass
-                pb.animate(i+1)
+                    indices = [i for i in range(len(reads))
+                               if i + count in cherries]
+                for i in indices:
+                    fh.write((reads[i].__str__() + "\n").encode())
+                count += len(reads)
+            if sampler is not None:
+                cherries = set(sampler.indices)
+                for read in sampler.items:
+                    fh.write((read.__str__() + "\n").encode())
         return cherries
 
+    def to_kmer_content(self, k=7, canonical=False):
+        """Return a Series with kmer count across all sequences
+
+        See :meth:`sequana.fastq.FastQ.to_kmer_content` for details.
+        """
+        from sequana.kmer import KmerCounter
+        counter = KmerCounter(k=k, canonical=canonical)
+        fasta = FastxFile(self.filename)
+        while True:
+            sequences = [x.sequence for x in islice(fasta, 10000)]
+            if not sequences:
+                break
+            counter.update(sequences)
+        return counter.to_series()
+
     def get_stats(self):
         stats = {}
-        stats["N"] = 2
-        stats["mean_length"] = mean(self.lengths)
+        stats["N"] = len(self)
+        stats["mean_length"] = self.index["length"].mean()
         return stats
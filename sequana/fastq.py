@@ -1,18 +1,24 @@
 """Utilities to manipulate FASTQ and Reads"""
 import io
+import os
 import time
 import zlib
 from itertools import islice
 import gzip
 import subprocess
 from functools import wraps
-from collections import Counter, defaultdict
+from collections import Counter
 
 
 from sequana.lazy import numpy as np
 from sequana.lazy import pandas as pd
 from sequana.lazy import pylab
-from sequana.tools import GZLineCounter
+from sequana import logger
+from sequana.tools import count_lines, open_writer, ReservoirSampler
+from sequana.tools import ThreadedWriter
+from sequana.tools import _find_bgzf_block
+from sequana.phred import to_scores, detect_offset, mean_quality
+from sequana.phred import quality_per_position
 from easydev import Progress, do_profile
 
 from atropos.io.seqio import FastqReader
@@ -20,19 +26,10 @@ from atropos.io.seqio import FastqReader
 import pysam
 from pysam import qualitystring_to_array
 
-try:
-    from itertools import izip_longest
-except:
-    from itertools import zip_longest as izip_longest
-
-# for filter fastq files. see below in FastQ for the usage
-# we want to take 4 lines at a time (assuming there is no empty lines)
-def grouper(iterable):
-    args = [iter(iterable)] * 4
-    return izip_longest(*args)
-
-
-__all__ = ["Identifier", "FastQ", "FastQC", "is_fastq"]
+__all__ = ["Identifier", "FastQ", "FastQC", "FastQCStats", "FastQBatch",
+    "FastQBlockReader", "get_fastq_shards", "get_fastqc_stats", "fastqc_batch",
+    "IdentifierFilter", "FastQIndex", "DuplicateEstimator",
+    "estimate_duplicates", "is_fastq"]
 
 
 def is_fastq(filename):
@@ -49,6 +46,139 @@ def is_fastq(filename):
             return False
 
 
+def _get_read_name(identifier):
+    """Return name of a read from its identifier (bytes or string)
+
+    The leading @ (or >), the comment and the /1 or /2 suffix are removed so
+    that names of paired reads are identical.
+    """
+    if not isinstance(identifier, bytes):
+        identifier = identifier.encode()
+    identifier = identifier.strip()
+    if identifier[0:1] in (b"@", b">"):
+        identifier = identifier[1:]
+    name = identifier.split(None, 1)[0] if identifier else identifier
+    if name[-2:] in (b"/1", b"/2"):
+        name = name[:-2]
+    return name
+
+
+def _hash_names(names):
+    # 64-bits hashes of read names as a numpy array
+    from hashlib import blake2b
+    return np.fromiter((int.from_bytes(blake2b(x, digest_size=8).digest(),
+        "little") for x in names), dtype=np.uint64, count=len(names))
+
+
+class IdentifierFilter(object):
+    """Set of read identifiers used to filter FastQ files
+
+    Two implementations are available. The *set* method stores the read
+    names in a Python set (hash table). For very large lists (e.g. millions
+    of host reads identified by Kraken), the *table* method stores 64-bits
+    hashes of the names in a sorted table saved in a temporary file and
+    memory-mapped. Names are then searched by batches using a binary search
+    (numpy.searchsorted). Lookups cost the same whatever the size of the list.
+
+    ::
+
+        from sequana.fastq import IdentifierFilter
+        ids = IdentifierFilter(["@read1", "read2/1"])
+        ids.isin([b"@read1 1:N:0", b"@read3"])    # array([True, False])
+
+    Names are normalised: the leading @, the comment and the /1 or /2
+    suffixes are ignored.
+
+    .. note:: with the *table* method, two different names may have the same
+        hash. The probability is negligible (about N/2^64 per read).
+    """
+    def __init__(self, identifiers, method="auto", max_set_size=5000000,
+            chunksize=1000000):
+        """.. rubric:: constructor
+
+        :param identifiers: list (or any iterable) of identifiers or a
+            filename with one identifier per line.
+        :param str method: *set*, *table* or *auto*. With *auto*, the
+            *table* method is used if there are more than *max_set_size*
+            identifiers.
+        :param int max_set_size: see *method*
+        :param int chunksize: number of identifiers hashed at a time when
+            building the table.
+        """
+        if method not in ("auto", "set", "table"):
+            raise ValueError("method must be 'auto', 'set' or 'table'")
+        self._table = None
+        self._set = None
+        self._tmpfile = None
+
+        if isinstance(identifiers, str):
+            with open(identifiers, "rb") as fin:
+                self._load((x for x in fin if x.strip()), method,
+                    max_set_size, chunksize)
+        else:
+            self._load(identifiers, method, max_set_size, chunksize)
+
+    def _load(self, identifiers, method, max_set_size, chunksize):
+        identifiers = iter(identifiers)
+        names = set()
+        if method in ("auto", "set"):
+            for identifier in identifiers:
+                names.add(_get_read_name(identifier))
+                if method == "auto" and len(names) > max_set_size:
+                    break
+            else:
+                self._set = names
+                return
+        self._build_table(names, identifiers, chunksize)
+
+    def _build_table(self, names, identifiers, chunksize):
+        import tempfile
+        hashes = [_hash_names(list(names))]
+        while True:
+            chunk = [_get_read_name(x) for x in islice(identifiers, chunksize)]
+            if not chunk:
+                break
+            hashes.append(_hash_names(chunk))
+        hashes = np.unique(np.concatenate(hashes))
+
+        self._tmpfile = tempfile.NamedTemporaryFile(suffix=".ids")
+        table = np.memmap(self._tmpfile.name, dtype=np.uint64, mode="w+",
+            shape=(max(1, len(hashes)),))
+        table[0:len(hashes)] = hashes
+        table.flush()
+        del table
+        self._table = np.memmap(self._tmpfile.name, dtype=np.uint64,
+            mode="r")[0:len(hashes)]
+
+    def _get_method(self):
+        return "set" if self._set is not None else "table"
+    method = property(_get_method, doc="method used to store the identifiers")
+
+    def __len__(self):
+        if self._set is not None:
+            return len(self._set)
+        return len(self._table)
+
+    def __contains__(self, identifier):
+        return bool(self.isin([identifier])[0])
+
+    def isin(self, identifiers):
+        """Return a boolean array telling whether identifiers are in the set
+
+        :param identifiers: list or array of identifiers (bytes or strings)
+        """
+        names = [_get_read_name(x) for x in identifiers]
+        if self._set is not None:
+            return np.fromiter((x in self._set for x in names), dtype=bool,
+                count=len(names))
+        hashes = _hash_names(names)
+        if len(self._table) == 0:
+            return np.zeros(len(names), dtype=bool)
+        positions = np.searchsorted(self._table, hashes)
+        positions[positions == len(self._table)] = 0
+        return self._table[positions] == hashes
+
+
 class Identifier(object):
     """Class to interpret Read's identifier
 
@@ -162,6 +292,657 @@ class Identifier(object):
         return "Identifier (%s)" % self.version
 
 
+def _gather(buf, starts, offsets):
+    """Concatenate the slices buf[start:start+length] into a single array
+
+    The lengths are encoded in the *offsets* array (cumulative sum starting at
+    0). The index is built with numpy only so no Python loop is involved.
+    """
+    lengths = np.diff(offsets)
+    index = np.arange(offsets[-1], dtype=np.int64)
+    index += np.repeat(starts - offsets[:-1], lengths)
+    return buf[index]
+
+
+class FastQBatch(object):
+    """A batch of FastQ records stored as numpy arrays
+
+    Sequences and qualities of all reads are concatenated into two uint8
+    buffers. The read *i* is stored between ``offsets[i]`` and
+    ``offsets[i+1]`` in both buffers (sequences and qualities have the same
+    length in a valid FastQ file). Identifiers are stored as bytes (including
+    the leading @ character) in a numpy object array.
+
+    ::
+
+        >>> from sequana.fastq import FastQBlockReader
+        >>> from sequana import sequana_data
+        >>> reader = FastQBlockReader(sequana_data("test.fastq", "testing"))
+        >>> batch = next(iter(reader))
+        >>> len(batch)
+        250
+        >>> batch.get_sequence(0)[0:10]
+        b'CTTACCTTCG'
+
+    """
+    def __init__(self, identifiers, sequences, qualities, offsets):
+        self.identifiers = identifiers
+        self.sequences = sequences
+        self.qualities = qualities
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def __getitem__(self, index):
+        """Return a read as a dictionary or a slice of the batch as a new batch
+
+        Slicing does not copy the underlying buffers.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("step is not supported when slicing a batch")
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop+1]
+            first, last = offsets[0], offsets[-1]
+            return FastQBatch(self.identifiers[start:stop],
+                self.sequences[first:last], self.qualities[first:last],
+                offsets - first)
+        return self.get_record(index)
+
+    def _get_lengths(self):
+        return np.diff(self.offsets)
+    lengths = property(_get_lengths, doc="length of each read")
+
+    def get_sequence(self, index):
+        """Return sequence of the read at position *index* as bytes"""
+        return self.sequences[self.offsets[index]:self.offsets[index+1]].tobytes()
+
+    def get_quality(self, index):
+        """Return quality of the read at position *index* as bytes"""
+        return self.qualities[self.offsets[index]:self.offsets[index+1]].tobytes()
+
+    def get_record(self, index):
+        """Return the read at position *index* as a dictionary
+
+        The dictionary is the one returned by :meth:`FastQ.next` that is
+        with keys *identifier*, *sequence* and *quality*.
+        """
+        return {"identifier": self.identifiers[index],
+                "sequence": self.get_sequence(index),
+                "quality": self.get_quality(index)}
+
+    def to_fastq(self, indices=None):
+        """Return the reads (all by default) in FastQ format (bytes)
+
+        :param indices: list of read indices to be formatted
+        """
+        if indices is None:
+            indices = range(len(self))
+        data = []
+        if len(indices) < len(self) // 10:
+            # a few reads: buffers are not converted
+            for index in indices:
+                data.extend((self.identifiers[index], b"\n",
+                    self.get_sequence(index), b"\n+\n",
+                    self.get_quality(index), b"\n"))
+            return b"".join(data)
+        # slicing bytes is faster than converting each numpy slice
+        sequences = self.sequences.tobytes()
+        qualities = self.qualities.tobytes()
+        offsets = self.offsets.tolist()
+        for index in indices:
+            start, end = offsets[index], offsets[index + 1]
+            data.extend((self.identifiers[index], b"\n",
+                sequences[start:end], b"\n+\n", qualities[start:end], b"\n"))
+        return b"".join(data)
+
+
+class _FormattedBatches(object):
+    # read-only sequence of records of (paired) batches in FastQ format.
+    # Records are formatted on request only.
+    def __init__(self, batches):
+        self.batches = batches
+
+    def __len__(self):
+        return len(self.batches[0])
+
+    def __getitem__(self, index):
+        return tuple(batch.to_fastq([index]) for batch in self.batches)
+
+
+def _zip_batches(batches1, batches2, strict=True):
+    """Yield pairs of batches with same number of reads from two readers
+
+    Used to process paired files (R1/R2) synchronously. If the files have
+    different number of reads, a ValueError is raised if *strict* is True.
+    Otherwise, the remaining batches of the longest file are yielded with
+    None.
+    """
+    batches1, batches2 = iter(batches1), iter(batches2)
+    batch1 = batch2 = None
+    while True:
+        if not batch1:
+            batch1 = next(batches1, None)
+        if not batch2:
+            batch2 = next(batches2, None)
+        if batch1 is None or batch2 is None:
+            if (batch1 or batch2) and strict:
+                raise ValueError("paired files have different number of reads")
+            while batch1 is not None:
+                yield batch1, None
+                batch1 = next(batches1, None)
+            while batch2 is not None:
+                yield None, batch2
+                batch2 = next(batches2, None)
+            return
+        N = min(len(batch1), len(batch2))
+        yield batch1[0:N], batch2[0:N]
+        batch1, batch2 = batch1[N:], batch2[N:]
+
+
+class FastQBlockReader(object):
+    """Block-oriented FastQ reader returning :class:`FastQBatch` instances
+
+    Instead of reading a FastQ file line by line, large blocks of data
+    (4Mb by default) are decompressed (if needed) and the record boundaries
+    are located in bulk using numpy. Incomplete records found at the end of a
+    block are kept and completed with the next block. ::
+
+        from sequana.fastq import FastQBlockReader
+        for batch in FastQBlockReader("test.fastq.gz"):
+            print(len(batch), batch.lengths.mean())
+
+    Input files may be compressed (.gz extension) or not. Lines are expected to
+    be 4 per read (no multi-line sequences).
+
+    A byte range (shard) of the file can be read using the *start* and *end*
+    parameters (see :func:`get_fastq_shards`). For compressed files, *start*
+    must be the beginning of a gzip member (e.g. a BGZF block) and *end* is
+    a position in the compressed file. A read belongs to the shard if its
+    header starts in the range. Shards are aligned on record boundaries so
+    that consecutive shards cover all reads exactly once.
+
+    """
+    def __init__(self, filename, block_size=4*1024*1024, start=0, end=None):
+        """.. rubric:: constructor
+
+        :param str filename: input FastQ file (gzipped or not)
+        :param int block_size: number of (decompressed) bytes read at a time.
+        :param int start: first byte of the shard (default to beginning of the
+            file)
+        :param int end: last byte (excluded) of the shard (default to end of
+            file)
+        """
+        self.filename = filename
+        self.block_size = block_size
+        self.start = start
+        self.end = end
+        self._fileobj = None
+        self._limit = None
+        # number of records yielded, number of (decompressed) bytes of these
+        # records and number of decompressed bytes read so far
+        self.nreads = 0
+        self.parsed = 0
+        self.decompressed = 0
+        self.positions = None
+        self.open()
+
+    def _is_range(self):
+        return self.start > 0 or self.end is not None
+
+    def open(self):
+        """(Re)open the input file"""
+        self.close()
+        if self.filename.endswith(".gz") and not self._is_range():
+            self._fileobj = gzip.open(self.filename, "rb")
+        else:
+            self._fileobj = open(self.filename, "rb")
+
+    def close(self):
+        if self._fileobj is not None:
+            self._fileobj.close()
+
+    def tell(self):
+        """Return current position in the input file
+
+        For compressed files, this is the position in the compressed data.
+        """
+        if isinstance(self._fileobj, gzip.GzipFile):
+            return self._fileobj.fileobj.tell()
+        return self._fileobj.tell()
+
+    def estimate_count(self):
+        """Estimate the number of reads of the file (or shard)
+
+        The estimate extrapolates the number of records read so far to the
+        size of the file using the current position in the (compressed)
+        input file. Reads are assumed to be homogeneous along the file.
+        """
+        if self.nreads == 0 or self.decompressed == 0:
+            return 0
+        end = self.end if self.end is not None else \
+            os.path.getsize(self.filename)
+        # compressed bytes corresponding to the records yielded so far
+        used = (self.tell() - self.start) * self.parsed / self.decompressed
+        return int(round(self.nreads * (end - self.start) / used))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _read_data(self):
+        # yields blocks of decompressed data. In range mode, self._limit is set
+        # to the number of decompressed bytes in the range as soon as it is
+        # known.
+        if not self._is_range():
+            data = self._fileobj.read(self.block_size)
+            while data:
+                yield data
+                data = self._fileobj.read(self.block_size)
+        elif not self.filename.endswith(".gz"):
+            self._fileobj.seek(self.start)
+            if self.end is not None:
+                self._limit = self.end - self.start
+            data = self._fileobj.read(self.block_size)
+            while data:
+                yield data
+                data = self._fileobj.read(self.block_size)
+        else:
+            # gzip members are decompressed one by one so that we know when
+            # the end of the range is reached.
+            chunksize = 256 * 1024
+            self._fileobj.seek(self.start)
+            offset = self.start
+            total = 0
+            buffer_, buffer_size = [], 0
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = self._fileobj.read(chunksize)
+            while data:
+                outstr = d.decompress(data)
+                total += len(outstr)
+                buffer_.append(outstr)
+                buffer_size += len(outstr)
+                if d.eof:
+                    stop = offset + len(data) - len(d.unused_data)
+                    if self._limit is None and self.end is not None and \
+                            stop >= self.end:
+                        self._limit = total
+                    data = d.unused_data or self._fileobj.read(chunksize)
+                    offset = stop
+                    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                else:
+                    offset += len(data)
+                    data = self._fileobj.read(chunksize)
+                if buffer_size >= self.block_size:
+                    yield b"".join(buffer_)
+                    buffer_, buffer_size = [], 0
+            if buffer_size:
+                yield b"".join(buffer_)
+
+    def _owned(self, position, starts):
+        # number of records starting at or before the end of the range
+        if self._limit is None:
+            return len(starts)
+        return int(np.searchsorted(position + starts, self._limit, side="right"))
+
+    def __iter__(self):
+        self._limit = None
+        self.nreads = self.parsed = self.decompressed = 0
+        # position of remaining in the (decompressed) range
+        position = 0
+        remaining = b""
+        # The first line is skipped since it may be incomplete. This is
+        # consistent with the previous shard, which includes the record
+        # starting at its end (if any).
+        skip = self.start > 0
+        for data in self._read_data():
+            self.decompressed += len(data)
+            data = remaining + data
+            if skip:
+                index = _find_first_record(data)
+                if index is None:
+                    remaining = data
+                    continue
+                position += index
+                data = data[index:]
+                skip = False
+
+            batch, remaining, starts = self._parse(data)
+            if batch is not None:
+                N = self._owned(position, starts)
+                if N < len(batch):
+                    if N:
+                        yield self._count(batch[0:N], position + starts[N],
+                            position + starts[0:N])
+                    return
+                yield self._count(batch, position + len(data) - len(remaining),
+                    position + starts)
+            position += len(data) - len(remaining)
+
+        # last chunk. Takes care of missing carriage return and trailing empty
+        # lines at the end of the file.
+        remaining = remaining.rstrip()
+        if skip and remaining:
+            index = _find_first_record(remaining + b"\n", final=True)
+            if index is None:
+                return
+            position += index
+            remaining = remaining[index:]
+        if remaining:
+            batch, remaining, starts = self._parse(remaining + b"\n")
+            if remaining.strip():
+                raise ValueError("Incomplete record found at the end of %s" %
+                    self.filename)
+            if batch is not None:
+                N = self._owned(position, starts)
+                if N:
+                    yield self._count(batch[0:N], self.decompressed,
+                        position + starts[0:N])
+
+    def _count(self, batch, parsed, positions):
+        # positions of the records in the (decompressed) range are available
+        # in the positions attribute when the batch is yielded
+        self.nreads += len(batch)
+        self.parsed = parsed
+        self.positions = positions
+        return batch
+
+    def _parse(self, data):
+        return _parse_records(data, self.filename)
+
+
+def _parse_records(data, filename):
+    """Parse all complete records found in data
+
+    :return: a :class:`FastQBatch` (None if there is no complete record),
+        the remaining bytes (incomplete record) and the positions of the
+        records in data.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buf == 10)
+    N = len(ends) // 4
+    if N == 0:
+        return None, data, None
+    ends = ends[0:4*N]
+    last = int(ends[-1]) + 1
+
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # handle \r\n line endings
+    stops = ends.copy()
+    stops[(buf[ends - 1] == 13) & (ends > starts)] -= 1
+
+    if np.any(buf[starts[0::4]] != ord("@")) or \
+            np.any(buf[starts[2::4]] != ord("+")):
+        raise ValueError("Invalid FastQ record found in %s" % filename)
+
+    lengths = stops[1::4] - starts[1::4]
+    if np.any(stops[3::4] - starts[3::4] != lengths):
+        raise ValueError("sequence and quality lengths differ in %s" %
+            filename)
+    offsets = np.zeros(N + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    sequences = _gather(buf, starts[1::4], offsets)
+    qualities = _gather(buf, starts[3::4], offsets)
+
+    identifiers = data[0:last].split(b"\n")[0:4*N:4]
+    identifiers = np.array([x.rstrip(b"\r") for x in identifiers],
+        dtype=object)
+    batch = FastQBatch(identifiers, sequences, qualities, offsets)
+    return batch, data[last:], starts[0::4]
+
+
+def _find_first_record(data, final=False):
+    """Return position of the first complete record found after the first line
+
+    The first line is skipped (it may be incomplete). Returns None if data
+    is too short to decide. A record is identified by a line starting with @
+    followed by a sequence, a line starting with + and a quality of same
+    length as the sequence (followed by another header if available).
+    """
+    position = data.find(b"\n") + 1
+    if position == 0:
+        return None
+    lines = data[position:].split(b"\n", 9)
+    if len(lines) < 10 and not final:
+        return None
+    # last item is either incomplete or the remaining data
+    lines = lines[:-1]
+    for i in range(0, min(4, len(lines) - 3)):
+        if lines[i][0:1] == b"@" and lines[i+2][0:1] == b"+" and \
+                len(lines[i+1].rstrip(b"\r")) == len(lines[i+3].rstrip(b"\r")) \
+                and (i + 4 >= len(lines) or lines[i+4][0:1] == b"@"):
+            return position
+        position += len(lines[i]) + 1
+    return None
+
+
+def get_fastq_shards(filename, N):
+    """Split a FastQ file into (at most) N byte ranges
+
+    :param str filename: a FastQ file (gzipped or not)
+    :param int N: number of shards
+    :return: list of tuples (start, end) to be used with
+        :class:`FastQBlockReader`.
+
+    Uncompressed files are split in N ranges of same size. Compressed files
+    can be split only if they are BGZF files (e.g. created with bgzip); the
+    ranges start at the beginning of a BGZF block. Standard gzip files are
+    not split (a single range is returned).
+    """
+    size = os.path.getsize(filename)
+    if N <= 1 or size == 0:
+        return [(0, size)]
+    if not filename.endswith(".gz"):
+        starts = [size * k // N for k in range(N)]
+    else:
+        starts = [0]
+        with open(filename, "rb") as fin:
+            for k in range(1, N):
+                start = _find_bgzf_block(fin, size * k // N, size * (k+1) // N)
+                if start is None:
+                    # not a BGZF file
+                    if k == 1 and _find_bgzf_block(fin, 0, 1) is None:
+                        break
+                    continue
+                if start > starts[-1]:
+                    starts.append(start)
+    return list(zip(starts, starts[1:] + [size]))
+
+
+class FastQIndex(object):
+    """Random access index of a FastQ file
+
+    The index stores the position of every K-th record (*step* parameter)
+    and optionally the (hashed) names of all reads. It is built in one pass
+    and saved next to the FastQ file (extension .fqi) so that it is built
+    only once::
+
+        from sequana.fastq import FastQIndex
+        index = FastQIndex("test.fastq", step=1000, names=True)
+        index.read(123456)               # 123457th read
+        index.read(100, 10)              # a batch of 10 reads
+        index.get_record_number("@HISEQ:426:C5T65ACXX:5:2302:1943:2127")
+
+    Uncompressed and BGZF files (see e.g. *bgzip* or :meth:`FastQ.split`)
+    are supported. For BGZF files, positions are virtual offsets (position of
+    the block in the compressed file shifted by 16 bits plus position within
+    the decompressed block). Gzip files made of a single member cannot be
+    accessed randomly.
+
+    Fetching a read requires reading at most *step* records. This is usually
+    accessed through :class:`FastQ` (e.g. ``fastq[10]``, ``fastq[10:20]``
+    or ``fastq["read_name"]``).
+    """
+    def __init__(self, filename, step=1000, names=False, cache=True):
+        """.. rubric:: constructor
+
+        :param str filename: the FastQ file (uncompressed or BGZF)
+        :param int step: position of every *step* record is stored
+        :param bool names: also index the read names
+        :param bool cache: save the index next to the input file and re-use
+            it if it exists and is valid (same input file size and
+            modification time, same parameters).
+        """
+        from sequana.tools import is_bgzf
+        self.filename = filename
+        self.step = step
+        self.bgzf = filename.endswith(".gz")
+        if self.bgzf and not is_bgzf(filename):
+            raise ValueError("%s is a gzip file but not BGZF. Random access "
+                "requires uncompressed or BGZF files" % filename)
+        self.index_filename = filename + ".fqi"
+        self.n_reads = 0
+        self.offsets = None
+        self.name_hashes = None
+        self.name_records = None
+        if cache is False or not self._load(names):
+            self.build(names)
+            if cache:
+                self.save()
+
+    def _get_signature(self):
+        stat = os.stat(self.filename)
+        return np.array([stat.st_size, stat.st_mtime_ns, self.step])
+
+    def _load(self, names):
+        if not os.path.exists(self.index_filename):
+            return False
+        try:
+            data = np.load(self.index_filename)
+            if not np.array_equal(data["signature"], self._get_signature()):
+                return False
+            if names and "name_hashes" not in data:
+                return False
+            self.offsets = data["offsets"]
+            self.n_reads = int(data["n_reads"])
+            if "name_hashes" in data:
+                self.name_hashes = data["name_hashes"]
+                self.name_records = data["name_records"]
+        except Exception as err:
+            logger.warning("Could not read %s (%s)" % (self.index_filename, err))
+            return False
+        return True
+
+    def save(self):
+        """Save the index (see *cache* parameter)"""
+        data = {"signature": self._get_signature(), "offsets": self.offsets,
+                "n_reads": self.n_reads}
+        if self.name_hashes is not None:
+            data["name_hashes"] = self.name_hashes
+            data["name_records"] = self.name_records
+        try:
+            with open(self.index_filename, "wb") as fout:
+                np.savez(fout, **data)
+        except (IOError, OSError) as err:
+            logger.warning("Could not save the index (%s)" % err)
+
+    def build(self, names=False):
+        """Scan the FastQ file and build the index"""
+        from sequana.tools import _get_bgzf_blocks
+        offsets, hashes = [], []
+        self.n_reads = 0
+        reader = FastQBlockReader(self.filename)
+        for batch in reader:
+            # records are numbered from 0 for the entire file
+            first = -self.n_reads % self.step
+            offsets.append(reader.positions[first::self.step])
+            if names:
+                hashes.append(_hash_names([_get_read_name(x)
+                    for x in batch.identifiers]))
+            self.n_reads += len(batch)
+        reader.close()
+
+        offsets = np.concatenate(offsets) if offsets else np.zeros(0, np.int64)
+        offsets = offsets.astype(np.int64)
+        if self.bgzf:
+            starts, decompressed = _get_bgzf_blocks(self.filename)
+            blocks = np.searchsorted(decompressed, offsets, side="right") - 1
+            offsets = (starts[blocks] << 16) + offsets - decompressed[blocks]
+        self.offsets = offsets.astype(np.uint64)
+
+        if names:
+            hashes = np.concatenate(hashes) if hashes else np.zeros(0, np.uint64)
+            self.name_records = np.argsort(hashes, kind="mergesort")
+            self.name_hashes = hashes[self.name_records]
+
+    def __len__(self):
+        return self.n_reads
+
+    def _open(self):
+        if self.bgzf:
+            return pysam.BGZFile(self.filename, "rb")
+        return open(self.filename, "rb")
+
+    def read(self, index, N=None):
+        """Return a read (or a batch of N reads starting at index)
+
+        :param int index: number of the read (starting at 0)
+        :param int N: if provided, a :class:`FastQBatch` with N reads (or
+            less at the end of the file) is returned instead of a single read
+            (as a dictionary, see :meth:`FastQ.next`).
+        """
+        if index < 0 or index >= self.n_reads:
+            raise IndexError("read index out of range")
+        count = 1 if N is None else min(N, self.n_reads - index)
+        with self._open() as fin:
+            fin.seek(int(self.offsets[index // self.step]))
+            for i in range(index % self.step):
+                for j in range(4):
+                    fin.readline()
+            lines = [fin.readline() for i in range(4 * count)]
+        if self.bgzf:
+            # pysam.BGZFile removes the end of lines
+            data = b"\n".join(lines) + b"\n"
+        else:
+            data = b"".join(lines)
+            if not data.endswith(b"\n"):
+                data += b"\n"
+        batch = _parse_records(data, self.filename)[0]
+        return batch if N is not None else batch[0]
+
+    def get_record_number(self, name):
+        """Return the number of the read with the given name
+
+        Requires an index built with *names* set to True.
+
+        :raises KeyError: if the read is not found
+        """
+        if self.name_hashes is None:
+            raise ValueError("read names are not indexed. Use names=True")
+        name = _get_read_name(name)
+        value = _hash_names([name])
+        first = np.searchsorted(self.name_hashes, value, side="left")[0]
+        last = np.searchsorted(self.name_hashes, value, side="right")[0]
+        for i in self.name_records[first:last]:
+            if _get_read_name(self.read(int(i))["identifier"]) == name:
+                return int(i)
+        raise KeyError(name)
+
+    def get_shards(self, N):
+        """Split the file into N shards with the same number of reads
+
+        :return: list of (start, end) positions that can be used by
+            :class:`FastQBlockReader` (e.g. in parallel workers).
+        """
+        anchors = np.unique(np.linspace(0, len(self.offsets), N + 1)
+            .astype(int)[1:-1])
+        positions = self.offsets[anchors].astype(np.int64)
+        if self.bgzf:
+            # start of the BGZF block containing the record
+            positions = positions >> 16
+        positions = sorted(set(positions.tolist()) - {0})
+        size = os.path.getsize(self.filename)
+        bounds = [0] + positions + [size]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+
 class FastQ(object):
     """Class to handle FastQ files
 
@@ -249,36 +1030,26 @@ class FastQ(object):
         self.__enter__()
         self._count_reads = nreads
 
-    def _count_lines_gz(self, CHUNKSIZE=65536):
-        ff = GZLineCounter(self.filename)
-        return len(ff)
+    def count_lines(self, jobs=1, cache=False):
+        """Return number of lines
 
-    def count_lines(self):
-        """Return number of lines"""
-        if self.filename.endswith("gz"):
-            count = self._count_lines_gz()
-        else:
-            count = self._count_reads_buf()
-        return count
+        :param int jobs: number of processes used to decompress multi-member
+            gzip files (e.g. BGZF).
+        :param bool cache: store/retrieve the count in a cache keyed by
+            path, size and modification time.
 
-    def count_reads(self):
+        See :func:`sequana.tools.count_lines` for details.
+        """
+        self._count_lines = count_lines(self.filename, jobs=jobs, cache=cache)
+        return self._count_lines
+
+    def count_reads(self, jobs=1, cache=False):
         """Return count_lines divided by 4"""
-        nlines = self.count_lines()
+        nlines = self.count_lines(jobs=jobs, cache=cache)
         if divmod(nlines, self._N)[1] != 0:
             print("WARNING. number of lines not multiple of 4.")
         return int(nlines / self._N)
 
-    def _count_reads_buf(self, block=1024*1024):
-        # 0.12 seconds to read 3.4M lines, faster than wc command
-        # on 2M reads, takes 0.1 seconds whereas wc takes 1.2 seconds
-        lines = 0
-        with open(self.filename, 'rb') as f:
-            buf = f.read(block)
-            while buf:
-                lines += buf.count(b'\n')
-                buf = f.read(block)
-        return lines
-
     def extract_head(self, N, output_filename):
         """Extract the heads of a FastQ files
 
@@ -387,138 +1158,227 @@ class FastQ(object):
             tozip = False
         return filename, tozip
 
-    def select_random_reads(self, N=None, output_filename="random.fastq"):
+    def select_random_reads(self, N=None, output_filename="random.fastq",
+            fraction=None, seed=None, paired_filename=None,
+            paired_output_filename=None):
         """Select random reads and save in a file
 
         :param int N: number of random unique reads to select
-            should provide a number but a list can be used as well. 
+            should provide a number but a list can be used as well.
             You can select random reads for R1, and re-use the returned list as
             input for the R2 (since pairs must be kept)
-        :param str output_filename:
+        :param str output_filename: output file (compressed if the extension
+            is .gz)
+        :param float fraction: instead of N, select each read with this
+            probability. The number of selected reads is then approximately
+            fraction times the number of reads.
+        :param seed: seed of the random generator (for reproducibility)
+        :param str paired_filename: the mate file (R2). The same reads are then
+            selected in both files.
+        :param str paired_output_filename: output file for the mate reads
+        :return: the set of selected read indices
+
+        The input file(s) are read only once: N reads are sampled with a
+        reservoir (see :class:`sequana.tools.ReservoirSampler`) so only the
+        selected reads are kept in memory. The number of reads does not need
+        to be known.
 
         If you have a pair of files, the same reads must be selected in R1 and
-        R2.::
+        R2::
+
+            f1 = FastQ(file1)
+            f1.select_random_reads(N=1000, output_filename="R1.fastq.gz",
+                paired_filename=file2, paired_output_filename="R2.fastq.gz")
+
+        or equivalently::
 
             f1 = FastQ(file1)
             selection = f1.select_random_reads(N=1000)
             f2 = FastQ(file2)
             f2.select_random_reads(selection)
 
-
         """
-        thisN = len(self)
-        if isinstance(N, int):
-            if N > thisN:
-                N = thisN
-            # create random set of reads to pick up
-            cherries = list(range(thisN))
-            np.random.shuffle(cherries)
-            # cast to set for efficient iteration
-            cherries = set(cherries[0:N])
-        elif isinstance(N, set):
-            cherries = N
-        elif isinstance(N, list):
-            cherries = set(N)
-
-        fastq = pysam.FastxFile(self.filename)
-
-
-        pb = Progress(thisN) # since we scan the entire file
-        with open(output_filename, "w") as fh:
-            for i, read in enumerate(fastq):
-                if i in cherries:
-                    fh.write(read.__str__() + "\n")
-                else:
-                    pass
-                pb.animate(i+1)
+        filenames = [self.filename]
+        outputs = [output_filename]
+        if paired_filename:
+            if paired_output_filename is None:
+                raise ValueError("paired_output_filename must be provided")
+            filenames.append(paired_filename)
+            outputs.append(paired_output_filename)
+
+        readers = [FastQBlockReader(filename) for filename in filenames]
+        if len(readers) == 2:
+            batches = _zip_batches(*readers)
+        else:
+            batches = ((batch,) for batch in readers[0])
+
+        writers = [open_writer(filename) for filename in outputs]
+        try:
+            if isinstance(N, (set, list)):
+                cherries = set(N)
+                selected = np.array(sorted(cherries), dtype=np.int64)
+                count = 0
+                for batch in batches:
+                    # selected indices within this batch
+                    first, last = np.searchsorted(selected,
+                        [count, count + len(batch[0])])
+                    indices = selected[first:last] - count
+                    for writer, this in zip(writers, batch):
+                        writer.write(this.to_fastq(indices))
+                    count += len(batch[0])
+            elif fraction is not None:
+                random = np.random.RandomState(seed)
+                cherries = set()
+                count = 0
+                for batch in batches:
+                    indices = np.flatnonzero(
+                        random.random_sample(len(batch[0])) < fraction)
+                    for writer, this in zip(writers, batch):
+                        writer.write(this.to_fastq(indices))
+                    cherries.update((indices + count).tolist())
+                    count += len(batch[0])
+            else:
+                sampler = ReservoirSampler(N, seed=seed)
+                for batch in batches:
+                    sampler.update(_FormattedBatches(batch))
+                cherries = set(sampler.indices)
+                for records in sampler.items:
+                    for writer, record in zip(writers, records):
+                        writer.write(record)
+        finally:
+            for writer in writers:
+                writer.close()
+            for reader in readers:
+                reader.close()
         return cherries
 
     def split_lines(self, N=100000, gzip=True):
-        """Not implemented"""
-        if self.filename.endswith(".gz"):
-            outputs = self._split_lines_gz(N, gzip=gzip)
-        else:
-            outputs = self._split_lines(N, gzip=gzip)
-        return outputs
+        """Split the file into files of N lines
 
-    def _split_lines_gz(self, N, gzip=True, CHUNKSIZE=65536):
-        # split input in N files
-        # There is a split function under Unix but (1) not under windows
-        # and (2) split a gzip into N chunks or n lines will split the
-        # reads in the middle. So, we want to unzip, select N lines (or chunks)
-        # and zip each chunk.
+        :param int N: number of lines per output file (multiple of 4)
+        :param bool gzip: compress the output files
+        :return: list of output filenames. Files are named after the input
+            file with the range of lines e.g. *filename_1_100000.fastq* and
+            *filename_100001_151234.fastq*.
+
+        See :meth:`split` for details.
+        """
         self._check_multiple(N)
-        N_chunk, remainder = divmod(self.n_lines, N)
-        if remainder > 0:
-            N_chunk += 1
+        if N >= self.n_lines:
+            print("Nothing to do. Choose a lower N value")
+            return
 
-        # let prepare some data first. Let us build the filenames once for all
+        left, right = self.filename.replace(".gz", "").rsplit(".", 1)
         outputs = []
-        for i in range(0, N_chunk):
-            lb = (i ) * N + 1
-            ub = (i + 1) * N
-            if ub > self.n_lines:
-                ub = self.n_lines
-
-            if self.filename.endswith(".gz"):
-                input_filename = self.filename.split(".gz")[0]
-                output_filename = input_filename
-            else:
-                input_filename = self.filename
-                output_filename = self.filename
-            output_filename.split(".", -1)
-            left, right = input_filename.rsplit(".", 1)
-            output_filename = left + "_%s_%s." % (lb, ub) + right
-            outputs.append(output_filename)
-
-        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
-        with open(self.filename, 'rb') as fin:
-            # init buffer
-            buf = fin.read(CHUNKSIZE)
-            count = 0
+        for lb in range(1, self.n_lines + 1, N):
+            ub = min(lb + N - 1, self.n_lines)
+            output = left + "_%s_%s." % (lb, ub) + right
+            outputs.append(output + ".gz" if gzip else output)
+        return self.split(outputs, N=N // 4)
+
+    def split(self, output_filename="split_{}.fastq.gz", N=None, nfiles=None,
+            round_robin=False, paired_filename=None,
+            paired_output_filename=None, bgzf=False, compresslevel=6,
+            threads=4):
+        """Split the file into several FastQ files
+
+        :param output_filename: template of the output filenames where {} is
+            replaced by the file number (starting at 1) or list of output
+            filenames. Output files are compressed if the extension is .gz.
+        :param int N: number of reads per output file
+        :param int nfiles: number of output files. If round_robin is False,
+            reads are first counted to get files of same size.
+        :param bool round_robin: with *nfiles*, send the reads in turn to each
+            output file. The number of reads does not need to be known.
+        :param str paired_filename: the mate file (R2), split in the same way
+        :param paired_output_filename: template or list of output filenames
+            for the mate file
+        :param bool bgzf: compress output files as BGZF
+        :param int compresslevel: compression level
+        :param int threads: number of threads used to compress the data
+        :return: list of output filenames (list of pairs of filenames in
+            paired mode)
+
+        The input file is read once. Each output file is written in its own
+        thread (see :class:`sequana.tools.ThreadedWriter`) and blocks of reads
+        are compressed concurrently by a pool of threads (zlib releases the
+        GIL)::
+
+            f = FastQ("test_R1_.fastq.gz")
+            f.split("chunk_{}_R1_.fastq.gz", nfiles=4,
+                paired_filename="test_R2_.fastq.gz",
+                paired_output_filename="chunk_{}_R2_.fastq.gz")
 
-            # open an output file handler
-            current_file_counter = 0
-            fout = open(outputs[0], "wb")
-
-            while buf:
-                outstr = d.decompress(buf)
-                count += outstr.count(b"\n")
-                if count > N:
-                    # if too many lines were read, fill the current file
-                    # and keep remaining data (skip the reading of new
-                    # data for now)
-                    missing = count - N
-                    outstr = outstr.strip().split(b"\n")
-                    NN = len(outstr)
-                    # we need to split the buffer into the part to save
-                    # in this file and the part to save in the next file later
-                    # on (remaining)
-                    # Note that there is no '\n' added here because we do not
-                    # read lines that we may end up in the middle of a line
-                    remaining  = b"\n".join(outstr[NN-missing-1:])
-                    # whereas here, we are at the end of a line
-                    outstr = b"\n".join(outstr[0:NN-missing-1]) + b"\n"
-                    # write and close that file
-                    fout.write(outstr)
-                    fout.close()
-                    # and open the next one where we can already save the end of
-                    # the buffer
-                    current_file_counter += 1
-                    fout = open(outputs[current_file_counter], "wb")
-                    fout.write(remaining)
-                    # we need to keep track of what has be written
-                    count = remaining.count(b'\n')
-                    # and finally we can now read a new chunk of data
-                    buf = fin.read(CHUNKSIZE)
-                else:
-                    fout.write(outstr)
-                    buf = fin.read(CHUNKSIZE)
+        """
+        if N is None and nfiles is None:
+            raise ValueError("either N or nfiles must be provided")
+
+        templates = [output_filename]
+        readers = [FastQBlockReader(self.filename)]
+        if paired_filename:
+            if paired_output_filename is None:
+                raise ValueError("paired_output_filename must be provided")
+            templates.append(paired_output_filename)
+            readers.append(FastQBlockReader(paired_filename))
+
+        def get_writers(index):
+            names = [x[index] if isinstance(x, (list, tuple))
+                     else x.format(index + 1) for x in templates]
+            outputs.append(names[0] if len(names) == 1 else tuple(names))
+            these = [ThreadedWriter(name, compresslevel=compresslevel,
+                bgzf=bgzf, executor=executor) for name in names]
+            writers.extend(these)
+            return these
+
+        if len(readers) == 2:
+            batches = _zip_batches(*readers)
+        else:
+            batches = ((batch,) for batch in readers[0])
 
-        if gzip is True:
-            for output in outputs:
-                self._gzip(output)
-            outputs = [x + ".gz" for x in outputs]
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(threads)
+        outputs = []
+        writers = []
+        try:
+            if nfiles and round_robin:
+                current = [get_writers(i) for i in range(nfiles)]
+                count = 0
+                for batch in batches:
+                    for i, these in enumerate(current):
+                        indices = range((i - count) % nfiles, len(batch[0]),
+                            nfiles)
+                        for writer, this in zip(these, batch):
+                            writer.write(this.to_fastq(indices))
+                    count += len(batch[0])
+            else:
+                if N is None:
+                    N = max(1, -(-self.count_reads() // nfiles))
+                current = None
+                for batch in batches:
+                    position = 0
+                    while position < len(batch[0]):
+                        if current is None:
+                            current = get_writers(len(outputs))
+                            count = 0
+                        n = min(N - count, len(batch[0]) - position)
+                        for writer, this in zip(current, batch):
+                            writer.write(this[position:position+n].to_fastq())
+                        position += n
+                        count += n
+                        if count == N:
+                            # this file is compressed while the next one is
+                            # filled
+                            for writer in current:
+                                writer.close(wait=False)
+                            current = None
+        finally:
+            for reader in readers:
+                reader.close()
+            for writer in writers:
+                writer.close(wait=False)
+            for writer in writers:
+                writer.join()
+            executor.shutdown()
         return outputs
 
     def _split_chunks(self, N=10):
@@ -530,50 +1390,6 @@ class FastQ(object):
             msg = "split_lines method expects a multiple of %s." %multiple
             raise ValueError(msg)
 
-    # This could be part of easydev or other software
-    # we could also use a unix command but won't work on other platforms
-    def _split_lines(self, N, gzip=True):
-        # split input in N files
-        # We will name them with reads number that is
-        # filename.fastq gives for example:
-        # --> filename_1_100000.fastq
-        # --> filename_100001_151234.fastq
-        self._check_multiple(N)
-
-        assert type(N) == int
-        if N >= self.n_lines:
-            print("Nothing to do. Choose a lower N value")
-            return
-
-        outputs = []
-        N_chunk, remainder = divmod(self.n_lines, N)
-
-        with open(self.filename) as fin:
-            for i in range(0, N_chunk):
-                lb = (i ) * N + 1
-                ub = (i + 1) * N
-                output_filename = self.filename
-                output_filename.split(".", -1)
-                left, right = self.filename.rsplit(".", 1)
-                output_filename = left + "_%s_%s." % (lb, ub) + right
-                outputs.append(output_filename)
-                with open(output_filename, 'w') as fout:
-                    fout.writelines(islice(fin, N))
-            # last chunk is dealt with outside the loop
-            lb = ub + 1
-            ub = self.n_lines
-            output_filename = left + "_%s_%s." % (lb, ub) + right
-            if remainder !=0:
-                outputs.append(output_filename)
-                with open(output_filename, 'w') as fout:
-                    fout.writelines(islice(fin, remainder))
-
-        if gzip is True:
-            for output in outputs:
-                self._gzip(output)
-            outputs = [x + ".gz" for x in outputs]
-        return outputs
-
     def split_chunks(self, N=10):
         """Not implemented"""
         assert N <=100, "you cannot split a file into more than 100 chunks"
@@ -615,56 +1431,85 @@ class FastQ(object):
             self._fileobj.close()
 
     def __enter__(self):
-        fh = open(self.filename, "rb")
-        if self.filename.endswith('.gz'):
-            self._fileobj = gzip.GzipFile(fileobj=fh)
-        else:
-            self._fileobj = fh
+        # records are read by blocks (see FastQBlockReader) and the file object
+        # is shared with the block reader.
+        self._reader = FastQBlockReader(self.filename)
+        self._fileobj = self._reader._fileobj
+        self._batches = iter(self._reader)
+        self._batch = None
+        self._batch_index = 0
         return self
 
     def __next__(self): # python 3
         return self.next()
 
     def next(self): # python 2
-        # reads 4 lines
-        d = {'quality':None, 'sequence': None, 'quality':None}
+        # reads 4 lines. Records are extracted from the current batch; a new
+        # batch is parsed once the current one is exhausted.
         try:
-            """data = islice(self._fileobj, 4)
-            d['identifier'] = next(data).strip()
-            d['sequence'] = next(data).strip()
-            skip = next(data)
-            d['quality'] = next(data).strip()
-            """
-
-            # 15% faster than islice + next
-            d['identifier'] = self._fileobj.readline().strip()
-            d['sequence'] = self._fileobj.readline().strip()
-            temp = self._fileobj.readline()
-            d['quality'] = self._fileobj.readline().strip()
-
-            # can be faster but slower on average
-            """d['identifier'] = self._fileobj.readlines(1)[0].strip()
-            d['sequence'] = self._fileobj.readlines(1)[0].strip()
-            self._fileobj.readlines(1)
-            d['quality'] = self._fileobj.readlines(1)[0].strip()
-            """
-            # Somehow the readlines still return "" even if the end of file is
-            # reached
-            if temp == b"":
-                raise StopIteration
+            if self._batch is None or self._batch_index >= len(self._batch):
+                self._batch = next(self._batches)
+                self._batch_index = 0
+            d = self._batch.get_record(self._batch_index)
+            self._batch_index += 1
         except KeyboardInterrupt:
             # THis should allow developers to break an function that iterates
             # through the read to run forever
             self._fileobj.close()
             self.__enter__()
-        except:
+        except StopIteration:
             self.rewind()
             raise StopIteration
+        except Exception:
+            # parse errors (invalid or truncated records) are raised. The
+            # file is rewound so that the next call raises them again.
+            self.rewind()
+            raise
 
         return d
 
+    def get_index(self, step=1000, names=False, cache=True):
+        """Return the random access index of the file (see :class:`FastQIndex`)
+
+        The index is built (or loaded from the cache) on the first call.
+        """
+        index = getattr(self, "_index", None)
+        if index is None or index.step != step or \
+                (names and index.name_hashes is None):
+            self._index = FastQIndex(self.filename, step=step, names=names,
+                cache=cache)
+        return self._index
+
     def __getitem__(self, index):
-        return 1
+        """Return a read (dictionary), a batch of reads or a read by name
+
+        ::
+
+            f = FastQ("test.fastq")
+            f[0]            # first read
+            f[-1]           # last read
+            f[10:20]        # a FastQBatch with 10 reads
+            f["@HISEQ:426:C5T65ACXX:5:2302:1943:2127"]
+
+        Requires an uncompressed or BGZF file (see :class:`FastQIndex`).
+        """
+        if isinstance(index, (str, bytes)):
+            fqindex = self.get_index(names=True)
+            return fqindex.read(fqindex.get_record_number(index))
+
+        fqindex = self.get_index()
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(fqindex))
+            if step != 1:
+                raise ValueError("step is not supported")
+            if stop <= start:
+                return FastQBatch(np.zeros(0, dtype=object),
+                    np.zeros(0, np.uint8), np.zeros(0, np.uint8),
+                    np.zeros(1, np.int64))
+            return fqindex.read(start, stop - start)
+        if index < 0:
+            index += len(fqindex)
+        return fqindex.read(index)
 
     def _to_fasta(self, output_filename="test.fasta", level=6, CHUNKSIZE=65536):
         """
@@ -700,81 +1545,103 @@ class FastQ(object):
         """
 
     def filter(self, identifiers_list=[], min_bp=None, max_bp=None,
-        progressbar=True, output_filename='filtered.fastq', remove=True):
+        progressbar=True, output_filename='filtered.fastq', remove=True,
+        paired_filename=None, paired_output_filename=None, bgzf=False):
         """Filter reads
 
+        :param identifiers_list: identifiers of the reads to be filtered. Can
+            be a list, a set, a filename (one identifier per line) or an
+            :class:`IdentifierFilter` (use the latter for very large lists).
         :param int min_bp: ignore reads with length shorter than min_bp
         :param int max_bp: ignore reads with length above max_bp
-
+        :param bool progressbar: show a progress bar
+        :param str output_filename: output file (compressed if the extension
+            is .gz)
+        :param bool remove: remove the reads found in *identifiers_list*.
+            If False, keep only those reads.
+        :param str paired_filename: the mate file (R2). Mates are filtered
+            according to the identifiers and lengths of the first file.
+        :param str paired_output_filename: output file for the mate reads
+        :param bool bgzf: compress output files as BGZF
+        :return: the number of reads written
+
+        Reads are processed by batches (see :class:`FastQBlockReader`) and
+        identifiers are searched in a hashed set or in a sorted table (see
+        :class:`IdentifierFilter`) so that the time does not depend on the
+        number of identifiers.
         """
-        # 7 seconds without identifiers to scan the file
-        # on a 750000 reads
-
         if min_bp is None:
             min_bp = 0
 
         if max_bp is None:
             max_bp = 1e9
 
-        # make sure we are at the beginning
-        self.rewind()
-
-        output_filename, tozip = self._istozip(output_filename)
+        if not isinstance(identifiers_list, IdentifierFilter):
+            identifiers_list = IdentifierFilter(identifiers_list)
+        filenames = [self.filename]
+        outputs = [output_filename]
+        if paired_filename:
+            if paired_output_filename is None:
+                raise ValueError("paired_output_filename must be provided")
+            filenames.append(paired_filename)
+            outputs.append(paired_output_filename)
+
+        readers = [FastQBlockReader(filename) for filename in filenames]
+        if len(readers) == 2:
+            batches = _zip_batches(*readers)
+        else:
+            batches = ((batch,) for batch in readers[0])
+        writers = [ThreadedWriter(filename, bgzf=bgzf) for filename in outputs]
 
-        with open(output_filename, "w") as fout:
-            pb = Progress(self.n_reads)
-            buf = ""
-            filtered = 0
-
-            for count, lines in enumerate(grouper(self._fileobj)):
-                identifier = lines[0].split()[0]
-                if lines[0].split()[0] in identifiers_list:
-                    filtered += 1
-                else:
-                    N = len(lines[1])
-                    if N <= max_bp and N >= min_bp:
-                        buf += "{}{}+\n{}".format(
-                            lines[0].decode("utf-8"),
-                            lines[1].decode("utf-8"),
-                            lines[3].decode("utf-8"))
-                    if count % 100000 == 0:
-                        fout.write(buf)
-                        buf = ""
+        if progressbar is True:
+            pb = Progress(os.path.getsize(self.filename))
+        filtered = 0
+        written = 0
+        try:
+            for batch in batches:
+                found = identifiers_list.isin(batch[0].identifiers)
+                filtered += int(found.sum())
+                lengths = batch[0].lengths
+                keep = (lengths >= min_bp) & (lengths <= max_bp)
+                keep &= ~found if remove else found
+                indices = np.flatnonzero(keep)
+                for writer, this in zip(writers, batch):
+                    writer.write(this.to_fastq(indices))
+                written += len(indices)
                 if progressbar is True:
-                    pb.animate(count+1)
-            fout.write(buf)
-            if filtered < len(identifiers_list):
-                print("\nWARNING: not all identifiers were found in the fastq file to " +
-                      "be filtered.")
-        if tozip is True: self._gzip(output_filename)
+                    pb.animate(readers[0].tell())
+        finally:
+            for writer in writers:
+                writer.close()
+            for reader in readers:
+                reader.close()
 
-    def to_kmer_content(self, k=7):
+        if filtered < len(identifiers_list):
+            print("\nWARNING: not all identifiers were found in the fastq file to " +
+                  "be filtered.")
+        return written
+
+    def to_kmer_content(self, k=7, canonical=False):
         """Return a Series with kmer count across all reads
 
         :param int k: (default to 7-mers)
-        :return: Pandas Series with index as kmer and values as count.
+        :param bool canonical: count a k-mer and its reverse complement
+            together
+        :return: Pandas Series with index as kmer and values as count
+            (sorted by decreasing counts). K-mers with N are ignored.
 
-        Takes about 30 seconds on a million reads.
+        K-mers are counted by batches of reads with
+        :class:`sequana.kmer.KmerCounter`.
         """
-        # Counter is slow if we apply it on each read.
-        # .count is slow as well
-        import collections
-        from sequana.kmer import get_kmer
-        counter = collections.Counter()
-        pb = Progress(len(self))
-        buffer_ = []
-        for i, this in enumerate(self):
-            buffer_.extend(list(get_kmer(this['sequence'], k)))
-            if len(buffer_) > 100000:
-                counter += collections.Counter(buffer_)
-                buffer_ = []
-            pb.animate(i)
-        counter += collections.Counter(buffer_)
-
-        ts = pd.Series(counter)
-        ts.sort_values(inplace=True, ascending=False)
-
-        return ts
+        from sequana.kmer import KmerCounter
+        counter = KmerCounter(k=k, canonical=canonical)
+        pb = Progress(os.path.getsize(self.filename))
+        reader = FastQBlockReader(self.filename)
+        for batch in reader:
+            counter.update(batch)
+            pb.animate(reader.tell())
+        reader.close()
+        return counter.to_series()
 
     def to_krona(self, k=7, output_filename="fastq.krona"):
         """Save Krona file with ACGT content within all k-mers
@@ -792,7 +1659,7 @@ class FastQ(object):
 
         with open(output_filename, "w") as fout:
             for index, count in ts.items():
-                letters = "\t".join([x for x in index.decode()])
+                letters = "\t".join([x for x in index])
                 fout.write("%s\t" % count + letters + "\n")
 
     def stats(self):
@@ -811,6 +1678,543 @@ class FastQ(object):
         return True
 
 
+def _resize(data, N):
+    """Return data with at least N rows (padded with zeros)"""
+    if len(data) >= N:
+        return data
+    newdata = np.zeros((N,) + data.shape[1:], dtype=data.dtype)
+    newdata[0:len(data)] = data
+    return newdata
+
+
+def _add(data1, data2):
+    """Sum two arrays with possibly different number of rows"""
+    N = max(len(data1), len(data2))
+    data = _resize(data1, N).astype(np.result_type(data1, data2))
+    data[0:len(data2)] += data2
+    return data
+
+
+class DuplicateEstimator(object):
+    """Streaming estimation of duplicated and over-represented sequences
+
+    Reads are hashed (see :func:`sequana.sketch.hash_sequences`). The number
+    of distinct reads is estimated with a :class:`~sequana.sketch.HyperLogLog`
+    and the number of occurences of the most frequent sequences with a
+    :class:`~sequana.sketch.CountMinSketch`, so that the memory footprint
+    (about 2Mb) does not depend on the number of reads::
+
+        from sequana.fastq import FastQBlockReader, DuplicateEstimator
+        dups = DuplicateEstimator()
+        for batch in FastQBlockReader("test.fastq.gz"):
+            dups.update(batch)
+        dups.duplicate_rate
+        dups.get_overrepresented()
+
+    As in FastQC, only the first 50 bases of the reads are used by default.
+    Estimators computed on different shards or lanes can be merged (see
+    :meth:`merge`).
+    """
+    def __init__(self, length=50, p=14, width=2**16, depth=4, ntop=50):
+        """.. rubric:: constructor
+
+        :param int length: number of bases used to compare reads (all bases
+            if None).
+        :param int p: precision of the HyperLogLog (relative error of about
+            1.04 / sqrt(2**p)).
+        :param int width: width of the Count-Min sketch
+        :param int depth: depth of the Count-Min sketch
+        :param int ntop: number of candidate over-represented sequences
+            kept in memory.
+        """
+        from sequana.sketch import HyperLogLog, CountMinSketch
+        self.length = length
+        self.ntop = ntop
+        self.n_reads = 0
+        self.hll = HyperLogLog(p=p)
+        self.cms = CountMinSketch(width=width, depth=depth)
+        # hash -> sequence of the most frequent sequences
+        self.candidates = {}
+
+    def update(self, batch, batch2=None):
+        """Add the reads of a :class:`FastQBatch`
+
+        :param batch2: reads paired with *batch* (same number of reads). A
+            pair is then a duplicate if both reads are duplicated.
+        """
+        from sequana.sketch import hash_sequences, combine_hashes
+        if len(batch) == 0:
+            return
+        hashes = hash_sequences(batch.sequences, batch.offsets, self.length)
+        sequences = [batch]
+        if batch2 is not None:
+            if len(batch2) != len(batch):
+                raise ValueError("paired batches have different number of reads")
+            hashes = combine_hashes(hashes, hash_sequences(batch2.sequences,
+                batch2.offsets, self.length))
+            sequences.append(batch2)
+
+        self.n_reads += len(batch)
+        self.hll.update(hashes)
+        unique, index, counts = np.unique(hashes, return_index=True,
+            return_counts=True)
+        self.cms.update(unique, counts)
+
+        # new candidates must be more frequent than the current ones
+        estimates = self.cms.query(unique)
+        if len(self.candidates) >= self.ntop:
+            threshold = self.cms.query(list(self.candidates.keys())).min()
+            keep = estimates > threshold
+            unique, index, estimates = unique[keep], index[keep], estimates[keep]
+        if len(unique) > self.ntop:
+            keep = np.argpartition(-estimates, self.ntop)[0:self.ntop]
+            unique, index = unique[keep], index[keep]
+        for key, i in zip(unique, index):
+            if key not in self.candidates:
+                self.candidates[key] = tuple(
+                    this.get_sequence(i)[0:self.length] for this in sequences)
+        self._select_candidates()
+
+    def _select_candidates(self):
+        if len(self.candidates) <= self.ntop:
+            return
+        keys = np.array(list(self.candidates.keys()), dtype=np.uint64)
+        estimates = self.cms.query(keys)
+        for key in keys[np.argsort(-estimates, kind="stable")[self.ntop:]]:
+            del self.candidates[key]
+
+    def merge(self, other):
+        """Add the reads of another :class:`DuplicateEstimator` (in place)"""
+        self.n_reads += other.n_reads
+        self.hll.merge(other.hll)
+        self.cms.merge(other.cms)
+        for key, sequences in other.candidates.items():
+            self.candidates.setdefault(key, sequences)
+        self._select_candidates()
+        return self
+
+    def _get_distinct(self):
+        return min(self.hll.cardinality, self.n_reads)
+    distinct = property(_get_distinct,
+        doc="estimated number of distinct reads (or pairs)")
+
+    def _get_duplicate_rate(self):
+        if self.n_reads == 0:
+            return 0.
+        return 1 - self.distinct / float(self.n_reads)
+    duplicate_rate = property(_get_duplicate_rate,
+        doc="estimated fraction of duplicated reads (FastQC definition)")
+
+    def get_overrepresented(self, min_fraction=0.001):
+        """Return the over-represented sequences as a dataframe
+
+        :param float min_fraction: only sequences representing at least this
+            fraction of the reads are reported (0.1% by default as in
+            FastQC).
+        :return: dataframe with the sequences (sequence2 for paired data),
+            the estimated count (upper bound) and percentage, sorted by
+            decreasing count.
+        """
+        if not self.candidates:
+            return pd.DataFrame(columns=["sequence", "count", "percentage"])
+        paired = len(next(iter(self.candidates.values()))) == 2
+        columns = ["sequence", "sequence2"] if paired else ["sequence"]
+        keys = np.array(list(self.candidates.keys()), dtype=np.uint64)
+        df = pd.DataFrame([[x.decode() for x in self.candidates[key]]
+            for key in keys], columns=columns)
+        df["count"] = self.cms.query(keys)
+        df["percentage"] = df["count"] / float(self.n_reads) * 100
+        df = df[df["count"] >= min_fraction * self.n_reads]
+        return df.sort_values("count", ascending=False).reset_index(drop=True)
+
+
+def estimate_duplicates(filename, paired_filename=None, **kwargs):
+    """Return a :class:`DuplicateEstimator` computed on a (paired) FastQ file
+
+    ::
+
+        from sequana.fastq import estimate_duplicates
+        dups = estimate_duplicates("A_R1_.fastq.gz", "A_R2_.fastq.gz")
+        dups.duplicate_rate
+
+    Other parameters are passed to :class:`DuplicateEstimator`.
+    """
+    estimator = DuplicateEstimator(**kwargs)
+    if paired_filename is None:
+        for batch in FastQBlockReader(filename):
+            estimator.update(batch)
+    else:
+        for batch1, batch2 in _zip_batches(FastQBlockReader(filename),
+                FastQBlockReader(paired_filename)):
+            estimator.update(batch1, batch2)
+    return estimator
+
+
+class FastQCStats(object):
+    """Vectorised accumulator of the statistics used by :class:`FastQC`
+
+    Batches of reads (see :class:`FastQBlockReader`) are processed with numpy
+    and only histograms are kept so that the memory footprint does not depend
+    on the number of reads::
+
+        from sequana.fastq import FastQBlockReader, FastQCStats
+        stats = FastQCStats(max_sample=500000)
+        for batch in FastQBlockReader("test.fastq.gz"):
+            stats.update(batch)
+        stats.gc_content
+
+    Statistics computed on all reads are the read length histogram, the base
+    counts, the quality counts and the GC content histogram. The per-position
+    histograms (quality and base composition), the mean quality per read and
+    the read length histogram used for plotting are computed on the first
+    *max_sample* reads only (as in the original :class:`FastQC` class).
+    """
+    #: order of the bases in the composition arrays (last column for other
+    #: characters)
+    bases = "ACGTN"
+
+    def __init__(self, max_sample=500000, tiles=False, offset=33,
+            duplicates=True):
+        """.. rubric:: constructor
+
+        :param int max_sample: number of reads used for per-position
+            statistics.
+        :param bool tiles: accumulate quality per position and per tile as
+            well (Illumina identifiers only).
+        :param int offset: phred offset of the qualities. If None, the
+            offset is guessed from the first batch of reads (see
+            :func:`sequana.phred.detect_offset`).
+        :param bool duplicates: estimate the duplication rate and the
+            over-represented sequences on all reads (see
+            :class:`DuplicateEstimator`).
+        """
+        self.max_sample = max_sample
+        self.tiles = tiles
+        self.offset = offset
+        self.duplicates = DuplicateEstimator() if duplicates else None
+
+        # all reads
+        self.n_reads = 0
+        self.length_counts = np.zeros(0, dtype=np.int64)
+        self.base_counts = np.zeros(6, dtype=np.int64)
+        self.quality_counts = np.zeros(256, dtype=np.int64)
+        self.gc_sum = 0.
+        self.gc_counts = np.zeros(101, dtype=np.int64)
+
+        # first max_sample reads only
+        self.n_sampled = 0
+        self.sample_length_counts = np.zeros(0, dtype=np.int64)
+        self.mean_quality_sum = 0.
+        self.quality_position_counts = np.zeros((0, 94), dtype=np.int64)
+        self.base_position_counts = np.zeros((0, 6), dtype=np.int64)
+        self.tile_quality_sum = {}
+        self.tile_quality_count = {}
+
+        self._codes = np.full(256, 5, dtype=np.int64)
+        for i, base in enumerate(self.bases):
+            self._codes[ord(base)] = i
+
+    def update(self, batch):
+        """Add the reads of a :class:`FastQBatch` to the statistics"""
+        N = len(batch)
+        if N == 0:
+            return
+        if self.offset is None:
+            self.offset = detect_offset(batch.qualities)
+        lengths = batch.lengths
+        codes = self._codes[batch.sequences]
+
+        self.length_counts = _resize(self.length_counts, lengths.max() + 1)
+        self.length_counts += np.bincount(lengths,
+            minlength=len(self.length_counts))
+        self.base_counts += np.bincount(codes, minlength=6)
+        self.quality_counts += np.bincount(batch.qualities, minlength=256)
+
+        # GC content per read (empty reads are ignored)
+        read_index = np.repeat(np.arange(N), lengths)
+        gc = np.bincount(read_index, weights=(codes == 1) | (codes == 2),
+            minlength=N)
+        nonzero = lengths > 0
+        gc = gc[nonzero] / lengths[nonzero] * 100
+        self.gc_sum += gc.sum()
+        self.gc_counts += np.bincount(gc.astype(np.int64), minlength=101)
+
+        if self.duplicates is not None:
+            self.duplicates.update(batch)
+
+        self.n_reads += N
+
+        M = min(N, self.max_sample - self.n_sampled)
+        if M > 0:
+            self._update_sample(batch[0:M])
+
+    def _update_sample(self, batch):
+        N = len(batch)
+        lengths = batch.lengths
+        position = np.arange(batch.offsets[-1]) - \
+            np.repeat(batch.offsets[:-1], lengths)
+        codes = self._codes[batch.sequences]
+
+        maxlen = lengths.max()
+        self.sample_length_counts = _resize(self.sample_length_counts, maxlen + 1)
+        self.sample_length_counts += np.bincount(lengths,
+            minlength=len(self.sample_length_counts))
+
+        nonzero = lengths > 0
+        means = mean_quality(batch.qualities, batch.offsets, self.offset)
+        self.mean_quality_sum += means[nonzero].sum()
+
+        self.quality_position_counts = _resize(self.quality_position_counts, maxlen)
+        self.quality_position_counts[0:maxlen] += quality_per_position(
+            batch.qualities, batch.offsets, self.offset)
+
+        self.base_position_counts = _resize(self.base_position_counts, maxlen)
+        L = len(self.base_position_counts)
+        self.base_position_counts += np.bincount(position * 6 + codes,
+            minlength=L * 6).reshape(L, 6)
+
+        if self.tiles:
+            quality = np.clip(to_scores(batch.qualities, self.offset), 0, 93)
+            tiles = np.array([Identifier(x).info['tile_number']
+                for x in batch.identifiers])
+            tiles = np.repeat(tiles, lengths)
+            for tile in np.unique(tiles):
+                mask = tiles == tile
+                total = np.bincount(position[mask], weights=quality[mask])
+                count = np.bincount(position[mask])
+                if tile not in self.tile_quality_sum:
+                    self.tile_quality_sum[tile] = np.zeros(0)
+                    self.tile_quality_count[tile] = np.zeros(0, dtype=np.int64)
+                for data, newdata in ((self.tile_quality_sum, total),
+                                      (self.tile_quality_count, count)):
+                    data[tile] = _resize(data[tile], len(newdata))
+                    data[tile][0:len(newdata)] += newdata
+
+        self.n_sampled += N
+
+    def merge(self, other, totals=True, sample=True):
+        """Add the statistics of another :class:`FastQCStats` (in place)
+
+        :param other: another :class:`FastQCStats` instance (e.g. computed on
+            another shard of the same file or on another lane).
+        :param bool totals: merge statistics computed on all reads
+        :param bool sample: merge statistics computed on sampled reads. The
+            per-position statistics are then computed on the union of the
+            sampled reads of both instances.
+        :return: the instance itself
+        """
+        if totals:
+            self.n_reads += other.n_reads
+            self.length_counts = _add(self.length_counts, other.length_counts)
+            self.base_counts += other.base_counts
+            self.quality_counts += other.quality_counts
+            self.gc_sum += other.gc_sum
+            self.gc_counts += other.gc_counts
+            if self.duplicates is not None and other.duplicates is not None:
+                self.duplicates.merge(other.duplicates)
+        if sample:
+            self.n_sampled += other.n_sampled
+            self.sample_length_counts = _add(self.sample_length_counts,
+                other.sample_length_counts)
+            self.mean_quality_sum += other.mean_quality_sum
+            self.quality_position_counts = _add(self.quality_position_counts,
+                other.quality_position_counts)
+            self.base_position_counts = _add(self.base_position_counts,
+                other.base_position_counts)
+            for tile in other.tile_quality_sum:
+                for data, newdata in ((self.tile_quality_sum, other.tile_quality_sum),
+                                      (self.tile_quality_count, other.tile_quality_count)):
+                    data[tile] = _add(data.get(tile, np.zeros(0)), newdata[tile])
+        return self
+
+    def _get_total_bp(self):
+        return int(self.base_counts[0:5].sum())
+    total_bp = property(_get_total_bp, doc="number of A, C, G, T, N bases")
+
+    def _get_min_length(self):
+        if self.n_reads == 0:
+            return 0
+        return int(np.flatnonzero(self.length_counts)[0])
+    min_length = property(_get_min_length, doc="shortest read length")
+
+    def _get_max_length(self):
+        if self.n_reads == 0:
+            return 0
+        return int(np.flatnonzero(self.length_counts)[-1])
+    max_length = property(_get_max_length, doc="longest read length")
+
+    def _get_mean_length(self):
+        if self.n_reads == 0:
+            return np.nan
+        lengths = np.arange(len(self.length_counts))
+        return (lengths * self.length_counts).sum() / float(self.n_reads)
+    mean_length = property(_get_mean_length, doc="average read length")
+
+    def _get_gc_content(self):
+        if self.length_counts[1:].sum() == 0:
+            return np.nan
+        return self.gc_sum / (self.length_counts[1:].sum())
+    gc_content = property(_get_gc_content,
+        doc="mean GC content of the reads (percentage)")
+
+    def _get_mean_quality(self):
+        if self.total_bp == 0:
+            return np.nan
+        qualities = np.arange(256) - self.offset
+        return (qualities * self.quality_counts).sum() / float(self.total_bp)
+    mean_quality = property(_get_mean_quality,
+        doc="mean quality of all bases (all reads)")
+
+    def _get_mean_read_quality(self):
+        if self.n_sampled == 0:
+            return np.nan
+        return self.mean_quality_sum / self.n_sampled
+    mean_read_quality = property(_get_mean_read_quality,
+        doc="average of the mean quality of the sampled reads")
+
+    def get_quality_per_position(self):
+        """Return mean and standard deviation of the quality per position
+
+        Computed on the sampled reads. The standard deviation is the
+        unbiased estimator (NaN if a position is covered by a single read).
+        """
+        counts = self.quality_position_counts
+        qualities = np.arange(94)
+        N = counts.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = counts.dot(qualities) / N
+            var = (counts.dot(qualities ** 2) - N * mean ** 2) / (N - 1)
+        return mean, np.sqrt(np.maximum(var, 0))
+
+    def get_quality_percentiles(self, percentiles=(10, 25, 50, 75, 90)):
+        """Return percentiles of the quality per position (dataframe)
+
+        Computed on the sampled reads from the histograms of the qualities
+        at each position. Rows are the positions (starting at 1) and columns
+        the percentiles. Values are NaN if no read covers a position.
+        """
+        counts = self.quality_position_counts
+        cumulated = counts.cumsum(axis=1)
+        N = cumulated[:, -1] if len(counts) else np.zeros(0)
+        data = {}
+        for percentile in percentiles:
+            # lowest quality with a cumulated count above the threshold
+            threshold = N * percentile / 100.
+            values = (cumulated < threshold[:, None]).sum(axis=1)
+            data[percentile] = np.where(N > 0, values, np.nan)
+        return pd.DataFrame(data, index=range(1, len(counts) + 1),
+            columns=list(percentiles))
+
+    def get_tile_quality(self):
+        """Return mean quality per position for each tile (sorted by tile)"""
+        return [self.tile_quality_sum[k] / self.tile_quality_count[k]
+                for k in sorted(self.tile_quality_sum.keys())]
+
+    def get_acgt_content(self):
+        """Return base composition per position as a dataframe
+
+        Computed on the sampled reads. The N column is included only if
+        there is at least one N base.
+        """
+        df = pd.DataFrame(self.base_position_counts,
+            columns=list(self.bases) + ['other'])
+        df = df.divide(df.sum(axis=1), axis=0)
+        if df["N"].sum() > 0:
+            return df[["A", "C", "G", "T", "N"]]
+        return df[["A", "C", "G", "T"]]
+
+    def to_dict(self):
+        """Return the summary used by :meth:`FastQC.get_stats`"""
+        stats = dict(zip(self.bases, [int(x) for x in self.base_counts[0:5]]))
+        stats["mean_length"] = self.mean_length
+        stats["total_bp"] = self.total_bp
+        stats["mean_quality"] = self.mean_quality
+        if self.duplicates is not None:
+            stats["duplicate_rate"] = self.duplicates.duplicate_rate
+        return stats
+
+
+def _fastqc_stats_job(args):
+    # if head is True, only the first max_sample reads are read
+    filename, start, end, max_sample, tiles, head = args
+    stats = FastQCStats(max_sample=max_sample, tiles=tiles,
+        duplicates=not head)
+    for batch in FastQBlockReader(filename, start=start, end=end):
+        if head:
+            batch = batch[0:max_sample - stats.n_reads]
+        stats.update(batch)
+        if head and stats.n_reads >= max_sample:
+            break
+    return stats
+
+
+def get_fastqc_stats(filenames, max_sample=500000, tiles=False, jobs=1):
+    """Compute :class:`FastQCStats` of several FastQ files in parallel
+
+    :param list filenames: FastQ files (gzipped or not)
+    :param int max_sample: number of reads used for per-position statistics
+    :param bool tiles: accumulate quality per tile
+    :param int jobs: number of processes
+    :return: list of :class:`FastQCStats` (same order as input files)
+
+    Files are split into shards (see :func:`get_fastq_shards`) when there
+    are more jobs than files. Each shard is processed independently and the
+    results are merged. Statistics computed on the first *max_sample* reads
+    are computed by a dedicated job so that results are identical to a
+    sequential scan of the files.
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    nshards = max(1, jobs // len(filenames))
+
+    tasks, indices = [], []
+    for i, filename in enumerate(filenames):
+        shards = get_fastq_shards(filename, nshards)
+        if len(shards) == 1:
+            tasks.append((filename, 0, None, max_sample, tiles, False))
+            indices.append((i, True, True))
+        else:
+            tasks.append((filename, 0, None, max_sample, tiles, True))
+            indices.append((i, False, True))
+            for start, end in shards:
+                tasks.append((filename, start, end, 0, False, False))
+                indices.append((i, True, False))
+
+    if jobs > 1:
+        import multiprocessing
+        with multiprocessing.Pool(jobs) as pool:
+            results = pool.map(_fastqc_stats_job, tasks)
+    else:
+        results = [_fastqc_stats_job(task) for task in tasks]
+
+    stats = [FastQCStats(max_sample=max_sample, tiles=tiles) for x in filenames]
+    for (i, totals, sample), result in zip(indices, results):
+        stats[i].merge(result, totals=totals, sample=sample)
+    return stats
+
+
+def fastqc_batch(filenames, max_sample=500000, dotile=False, jobs=1):
+    """Return :class:`FastQC` instances of several samples computed in parallel
+
+    ::
+
+        from sequana.fastq import fastqc_batch
+        for qc in fastqc_batch(["A_R1_.fastq.gz", "B_R1_.fastq.gz"], jobs=4):
+            print(qc.get_stats())
+
+    See :func:`get_fastqc_stats` for details.
+    """
+    stats = get_fastqc_stats(filenames, max_sample=max_sample, tiles=dotile,
+        jobs=jobs)
+    results = []
+    for filename, this in zip(filenames, stats):
+        qc = FastQC(filename, max_sample=max_sample, dotile=dotile,
+            verbose=False)
+        qc._set_stats(this)
+        results.append(qc)
+    return results
+
+
 # a simple decorator to check whether the data was computed or not.
 # If not, compute it
 def run_info(f):
@@ -850,9 +2254,17 @@ class FastQC(object):
         nucleotides, some information uses a limited number of reads (e.g.
         qualities), which is set to 500,000 by deafult.
 
+    For a quick QC, set *full* to False: only the first *max_sample* reads are
+    then read and the total number of reads is estimated from the position
+    in the (compressed) file::
+
+        qc = FastQC(filename, full=False)
+        qc.N          # estimated number of reads
+        qc.N_exact    # False if N is an estimate
 
     """
-    def __init__(self, filename, max_sample=500000, dotile=False, verbose=True):
+    def __init__(self, filename, max_sample=500000, dotile=False, verbose=True,
+            jobs=1, full=True, exact=False):
         """.. rubric:: constructor
 
         :param filename:
@@ -862,99 +2274,108 @@ class FastQC(object):
             good feeling of the data quality. The entire input file is
             parsed tough. This is required for instance to get the number of
             nucleotides.
+        :param int jobs: number of processes. Uncompressed and BGZF files are
+            split into shards processed in parallel (see
+            :func:`get_fastqc_stats`).
+        :param bool full: if False, stops reading after *max_sample* reads.
+            All statistics are then computed on those reads and the number
+            of reads is estimated.
+        :param bool exact: if *full* is False, count the number of reads
+            exactly instead of estimating it. Counts are cached (see
+            :func:`sequana.tools.count_lines`) so that it is done only once.
         """
         self.verbose = verbose
+        self.jobs = jobs
         self.filename = filename
+        self.full = full
+        self.exact = exact
 
-        # Later we will use pysam to scan the fastq because
-        # it iterate quickly while providing the quality already converted
-        # However, the FastQ implementation in this module is faster at
-        # computing the length by a factor 3
         self.fastq = FastQ(filename)
-        self.N = len(self.fastq)
+        # number of reads computed on request (see N property)
+        self._N = None
+        self.N_exact = True
 
         # Use only max_sample in some of the computation
-        self.max_sample = min(max_sample, self.N)
+        self.max_sample = int(max_sample)
 
         self.summary = {}
         self.fontsize = 16
+        self.dotile = dotile
+
+    def _get_N(self):
+        if self._N is None:
+            if self.full or self.exact:
+                self._N = self.fastq.count_reads(cache=self.exact)
+            else:
+                self._get_info()
+        return self._N
+    N = property(_get_N, doc="Number of reads (see also :attr:`N_exact`)")
 
     def _get_info(self):
         """Populates the data structures for plotting.
 
-        Will be called on request"""
-
-        stats = {"A":0, "C":0, "G":0, "T":0, "N":0}
-        stats["qualities"] = []
-        stats["mean_qualities"] = []
-        stats["mean_length"] = 0
-        stats["sequences"] = []
-
-        minimum = 1e6
-        maximum = 0
-        # FIXME this self.N takes time in the cosntructor
-        # do we need it ?
-        self.lengths = np.empty(self.N)
-        self.gc_list = []
-        total_length = 0
-        C = defaultdict(int)
-        if self.verbose:
-            pb = Progress(self.N)
-
-        sequences = []
-        mean_qualities = []
-        qualities = []
-        # could use multiprocessing
-        # FastxFile has shown some errors while handling gzip files
-        # created with zlib (e.g. from atropos). This is now replaced
-        # by the Atropos FastqReader for now.
-        #fastq = pysam.FastxFile(self.filename)
-
-        with FastqReader(self.filename) as f:
-            for i, record in enumerate(f):
-                N = len(record.sequence)
-                self.lengths[i] = N
-
-                # we can store all qualities and sequences reads, so
-                # just max_sample are stored:
-                if i < self.max_sample:
-                    quality = [ord(x) -33 for x in record.qualities]
-                    mean_qualities.append(sum(quality) / N)
-                    qualities.append(quality)
-                    sequences.append(record.sequence)
-
-                # store count of all qualities
-                for k in record.qualities:
-                    C[k] += 1
-
-                GG = record.sequence.count('G') 
-                CC = record.sequence.count('C')
-                self.gc_list.append((GG+CC)/float(N)*100)
-
-                # not using a counter, or loop speed up the code
-                stats["A"] += record.sequence.count("A")
-                stats["C"] += CC
-                stats["G"] += GG
-                stats["T"] += record.sequence.count("T")
-                stats["N"] += record.sequence.count("N")
-
-                total_length += len(record.sequence)
+        Will be called on request. Reads are processed by batches (see
+        :class:`FastQCStats`) and only histograms are stored."""
+        if not self.full:
+            stats = FastQCStats(max_sample=self.max_sample, tiles=self.dotile)
+            with FastQBlockReader(self.filename) as reader:
+                batches = iter(reader)
+                complete = True
+                for batch in batches:
+                    N = self.max_sample - stats.n_reads
+                    stats.update(batch[0:N])
+                    if stats.n_reads >= self.max_sample:
+                        # the file may end exactly with the sample
+                        complete = len(batch) == N and next(batches, None) is None
+                        break
+                if complete:
+                    self._set_stats(stats)
+                elif self.exact:
+                    self._set_stats(stats, N=self.fastq.count_reads(cache=True))
+                else:
+                    self._set_stats(stats, N=reader.estimate_count(), exact=False)
+        elif self.jobs > 1:
+            stats = get_fastqc_stats([self.filename], max_sample=self.max_sample,
+                tiles=self.dotile, jobs=self.jobs)[0]
+            self._set_stats(stats)
+        else:
+            stats = FastQCStats(max_sample=self.max_sample, tiles=self.dotile)
+            reader = FastQBlockReader(self.filename)
+            if self.verbose:
+                pb = Progress(os.path.getsize(self.filename))
 
+            for batch in reader:
+                stats.update(batch)
                 if self.verbose:
-                    pb.animate(i+1)
+                    pb.animate(reader.tell())
+            reader.close()
+            self._set_stats(stats)
+
+    def _set_stats(self, stats, N=None, exact=True):
+        # N is the number of reads if not all reads were used in the stats
+        self.fastqc_stats = stats
+        self._N = stats.n_reads if N is None else N
+        self.N_exact = exact
+        self.minimum = stats.min_length
+        self.maximum = stats.max_length
+        self.gc_content = stats.gc_content
+        self.stats = stats.to_dict()
 
-        # other data
-        self.qualities = qualities
-        self.mean_qualities = mean_qualities
-        self.minimum = int(self.lengths.min())
-        self.maximum = int(self.lengths.max())
-        self.sequences = sequences
-        self.gc_content = np.mean(self.gc_list)
-        stats['mean_length'] = total_length / float(self.N)
-        stats['total_bp'] = stats['A'] + stats['C'] + stats['G'] + stats["T"] + stats['N']
-        stats['mean_quality'] = sum([(ord(k) -33)*v for k,v in C.items()]) / stats['total_bp']
+    @run_info
+    def _get_lengths(self):
+        counts = self.fastqc_stats.length_counts
+        return np.repeat(np.arange(len(counts)), counts)
+    lengths = property(_get_lengths,
+        doc="lengths of the reads (sorted; computed from the histogram)")
 
-        self.stats = stats
+    @run_info
+    def _get_gc_list(self):
+        counts = self.fastqc_stats.gc_counts
+        return np.repeat(np.arange(len(counts)), counts)
+    gc_list = property(_get_gc_list, doc="""GC content of the reads (%)
+
+        Computed from the histogram of the GC content so values are sorted
+        and rounded down to the percentage. Empty reads are ignored.""")
 
     @run_info
     def imshow_qualities(self):
@@ -970,11 +2391,17 @@ class FastQC(object):
             from pylab import tight_layout; tight_layout()
 
         """
-        tiles = self._get_tile_info()
-        d = defaultdict(list)
-        for tile, seq in zip(tiles['tiles'], self.qualities):
-            d[tile].append(seq)
-        self.data_imqual = [pd.DataFrame(d[key]).mean().values for key in sorted(d.keys())]
+        if self.fastqc_stats.tiles:
+            stats = self.fastqc_stats
+        else:
+            # tiles were not computed. Scan the sampled reads only
+            stats = FastQCStats(max_sample=self.max_sample, tiles=True,
+                duplicates=False)
+            for batch in FastQBlockReader(self.filename):
+                stats.update(batch[0:self.max_sample - stats.n_reads])
+                if stats.n_reads >= self.max_sample:
+                    break
+        self.data_imqual = stats.get_tile_quality()
 
         from biokit.viz import Imshow
         im = Imshow(self.data_imqual)
@@ -983,37 +2410,47 @@ class FastQC(object):
         pylab.xlabel("Position in read (bp)")
         pylab.ylabel("tile number")
 
-    def _get_qualities(self):
-        from sequana import logger
-        logger.info("Extracting qualities")
-        qualities = []
-        with FastqReader(self.filename) as f:
-            for i, record in enumerate(f):
-                if i < self.max_sample:
-                    quality = [ord(x) -33 for x in record.qualities]
-                    qualities.append(quality)
-                else:
-                    break
-        return qualities
-
+    @run_info
     def boxplot_quality(self, hold=False, ax=None):
         """Boxplot quality
 
-        Same plots as in FastQC that is average quality for all bases.
-        In addition a 1 sigma error enveloppe is shown (yellow).
+        Same plots as in FastQC: for each position, the box shows the
+        quartiles of the qualities and the whiskers the 10th and 90th
+        percentiles. The median is shown in red and the mean quality in
+        blue. Statistics are computed on the sampled reads (see
+        :meth:`FastQCStats.get_quality_percentiles`).
 
         Background separate zone of good, average and bad quality (arbitrary).
 
         """
-        qualities = self._get_qualities()
-        df = pd.DataFrame(qualities)
-        from biokit.viz.boxplot import Boxplot
-        bx = Boxplot(df)
-        try:
-            # new version of biokit
-            bx.plot(ax=ax)
-        except:
-            bx.plot()
+        df = self.fastqc_stats.get_quality_percentiles()
+        mean, std = self.fastqc_stats.get_quality_per_position()
+        if ax:
+            pylab.sca(ax)
+        ax = pylab.gca()
+        xmax = len(df) + 1
+        pylab.fill_between([0, xmax], [0, 0], [20, 20], color='red', alpha=0.3)
+        pylab.fill_between([0, xmax], [20, 20], [30, 30], color='orange', alpha=0.3)
+        pylab.fill_between([0, xmax], [30, 30], [41, 41], color='green', alpha=0.3)
+
+        df = df.dropna()
+        boxes = [{"whislo": row[10], "q1": row[25], "med": row[50],
+                  "q3": row[75], "whishi": row[90], "fliers": []}
+                 for _, row in df.iterrows()]
+        ax.bxp(boxes, positions=list(df.index), widths=0.8, showfliers=False,
+            patch_artist=True, boxprops={"facecolor": "yellow"},
+            medianprops={"color": "r"})
+        pylab.plot(range(1, len(mean) + 1), mean, color="b", lw=2)
+        # bxp sets a tick per box
+        from matplotlib.ticker import AutoLocator, ScalarFormatter
+        ax.xaxis.set_major_locator(AutoLocator())
+        ax.xaxis.set_major_formatter(ScalarFormatter())
+        pylab.ylim([0, 41])
+        pylab.xlim([0, xmax])
+        pylab.title("Quality scores across all bases")
+        pylab.xlabel("Position in read (bp)")
+        pylab.ylabel("Quality")
+        pylab.grid(axis='x')
 
     def _get_tile_info(self):
         identifiers = []
@@ -1062,8 +2499,10 @@ class FastQC(object):
             qc.histogram_sequence_lengths()
 
         """
-        data = [len(x) for x in self.sequences]
-        bary, barx = np.histogram(data, bins=range(max(data)+1))
+        counts = self.fastqc_stats.sample_length_counts
+        maxlength = len(counts) - 1
+        bary, barx = np.histogram(range(len(counts)), weights=counts,
+            bins=range(maxlength+1))
 
         # get rid of zeros to avoid warnings
         bx = [x for x,y in zip(barx, bary) if y!=0]
@@ -1073,7 +2512,7 @@ class FastQC(object):
         else:
             pylab.bar(bx, by)
 
-        pylab.xlim([1,max(data)+1])
+        pylab.xlim([1, maxlength+1])
 
         pylab.grid(True)
         pylab.xlabel("position (bp)", fontsize=self.fontsize)
@@ -1093,7 +2532,9 @@ class FastQC(object):
             qc.histogram_gc_content()
 
         """
-        pylab.hist(self.gc_list, bins=range(0, 100))
+        # GC content is stored as counts per percentage (floor value)
+        pylab.hist(range(101), weights=self.fastqc_stats.gc_counts,
+            bins=range(0, 100))
         pylab.grid()
         pylab.title("GC content distribution (per sequence)")
         pylab.xlabel(r"Mean GC content (%)", fontsize=self.fontsize)
@@ -1101,56 +2542,40 @@ class FastQC(object):
 
     @run_info
     def get_stats(self):
-        # FIXME the information should all be computed in _get_info
-
-        # !!! sequences is limited to 500,000 if max_sample set to 500,000
-        # full stats must be computed in run_info() method
-        # so do not use .sequences here
+        # mean quality is computed on max_sample reads only (mean of the read
+        # mean qualities). Other information are computed on all reads
         stats = self.stats.copy()
         stats['GC content'] = self.gc_content
         stats["n_reads"] = self.N
+        stats["n_reads exact"] = self.N_exact
 
         stats['total bases'] = self.stats['total_bp']
-        stats['mean quality'] = np.mean(self.mean_qualities)
+        stats['mean quality'] = self.fastqc_stats.mean_read_quality
         stats['average read length'] = self.stats['mean_length']
         stats['min read length'] = self.minimum
         stats['max read length'] = self.maximum
+        stats['duplicate rate'] = self.stats.get('duplicate_rate', np.nan)
 
         # use DataFrame instead of Series to mix types (int/float)
         ts = pd.DataFrame([stats])
         cols = ['n_reads', 'A', 'C', 'G', 'T', 'N','total bases' ]
         ts[cols] = ts[cols].astype(int)
-        ts = ts[cols + ['GC content', 'average read length', 'mean quality']]
+        ts = ts[cols + ['GC content', 'average read length', 'mean quality',
+                        'duplicate rate', 'n_reads exact']]
         return ts
 
     @run_info
-    def get_actg_content(self):
-        # what is the longest string ?
-        lengths = [len(x) for x in self.sequences]
-        max_length = max(lengths)
+    def get_overrepresented_sequences(self, min_fraction=0.001):
+        """Return the over-represented sequences (first 50 bases)
 
-        # count ACGTN in each columns for all sequences
-        Nseq = len(self.sequences)
-        from collections import Counter
-        data = []
-        for pos in range(max_length):
-            # we add empty strings to have all sequences with same lengths
-            data.append(Counter([
-                (self.sequences[i] + " " * (max_length - len(self.sequences[i])) )[pos] 
-                for i in range(Nseq)]))
-
-        # remove the empty strings to normalise the data
-        df = pd.DataFrame.from_records(data)
-        if " " in df.columns:
-            df.drop(" ", axis=1, inplace=True)
-        df.fillna(0, inplace=True)
-        df = df.divide(df.sum(axis=1), axis=0)
+        Counts are estimated with a Count-Min sketch (upper bounds). See
+        :meth:`DuplicateEstimator.get_overrepresented`.
+        """
+        return self.fastqc_stats.duplicates.get_overrepresented(min_fraction)
 
-        if "N" in df.columns:
-            df = df[["A", "C", "G", "T", "N"]]
-        else:
-            df = df[["A", "C", "G", "T"]]
-        return df
+    @run_info
+    def get_actg_content(self):
+        return self.fastqc_stats.get_acgt_content()
 
     def plot_acgt_content(self, stacked=False):
         """Plot histogram of GC content
@@ -194,10 +194,13 @@ class IsoSeqQC(object):
         bins is from 0 to 94 
         """
 
-        hq_qv = [pylab.mean([ord(X)-33 for X in read['quality'].decode()]) 
-                for read in self.hq_sequence]
-        lq_qv = [pylab.mean([ord(X) -33 for X in read['quality'].decode()]) 
-            for read in self.lq_sequence]
+        from sequana.fastq import FastQBlockReader
+        hq_qv = [phred.mean_quality(batch.qualities, batch.offsets)
+            for batch in FastQBlockReader(self.hq_sequence.filename)]
+        lq_qv = [phred.mean_quality(batch.qualities, batch.offsets)
+            for batch in FastQBlockReader(self.lq_sequence.filename)]
+        hq_qv = np.concatenate(hq_qv) if hq_qv else []
+        lq_qv = np.concatenate(lq_qv) if lq_qv else []
 
         if bins is None:
             bins = range(0,94)
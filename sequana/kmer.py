@@ -16,8 +16,23 @@
 #  documentation: http://sequana.readthedocs.io
 #
 ##############################################################################
+"""K-mer utilities
+
+Besides the simple :func:`build_kmer` and :func:`get_kmer` functions, this
+module provides a numpy engine (:class:`KmerCounter`) that encodes
+nucleotides on 2 bits so that a k-mer (k up to 31) is stored as a 64-bits
+integer. K-mers of a batch of reads are computed with vectorised shifts and
+counted with :func:`numpy.unique`.
+"""
 import itertools
 
+from sequana.lazy import numpy as np
+from sequana.lazy import pandas as pd
+
+
+__all__ = ["build_kmer", "get_kmer", "encode_kmers", "decode_kmers",
+    "KmerCounter", "get_kmer_profiles"]
+
 
 def build_kmer(length=6, letters='CG'):
     """Return list of kmer of given length based on a set of letters
@@ -39,3 +54,260 @@ def get_kmer(sequence, k=7):
     """
     for i in range(0, len(sequence)-k+1):
         yield sequence[i:i+k]
+
+
+def _get_codes():
+    # A, C, G, T (upper or lower case) are encoded as 0, 1, 2, 3. Other
+    # characters (e.g. N) are encoded as 4
+    codes = np.full(256, 4, dtype=np.uint8)
+    for i, letter in enumerate("ACGT"):
+        codes[ord(letter)] = i
+        codes[ord(letter.lower())] = i
+    return codes
+
+
+def _to_buffer(sequences):
+    # concatenate a list of sequences into a uint8 buffer and the offsets
+    # of each sequence (see sequana.fastq.FastQBatch)
+    sequences = [x.encode() if isinstance(x, str) else x for x in sequences]
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in sequences], out=offsets[1:])
+    buf = np.frombuffer(b"".join(sequences), dtype=np.uint8)
+    return buf, offsets
+
+
+def encode_kmers(sequences, offsets=None, k=7, canonical=False,
+        return_positions=False):
+    """Return all k-mers of a set of sequences encoded as 64-bits integers
+
+    :param sequences: a list of sequences (strings or bytes) or a numpy
+        uint8 array with the concatenated sequences. In the latter case,
+        *offsets* gives the start of each sequence (and the end of the last
+        one).
+    :param offsets: see *sequences*
+    :param int k: length of the k-mers (up to 31)
+    :param bool canonical: if True, a k-mer and its reverse complement are
+        counted as the same k-mer (the smallest of the two codes is used).
+    :param bool return_positions: also return the position of each k-mer in
+        the concatenated sequences.
+    :return: numpy array of k-mer codes. K-mers with other letters than ACGT
+        are ignored. If *return_positions* is True, a second array gives
+        their positions.
+
+    ::
+
+        >>> from sequana.kmer import encode_kmers, decode_kmers
+        >>> decode_kmers(encode_kmers(["ACGTAAAA"], k=4), k=4)
+        ['ACGT', 'CGTA', 'GTAA', 'TAAA', 'AAAA']
+
+    """
+    if k < 1 or k > 31:
+        raise ValueError("k must be between 1 and 31")
+    if offsets is None:
+        sequences, offsets = _to_buffer(sequences)
+    codes = _get_codes()[sequences]
+    N = len(codes) - k + 1
+    if N <= 0:
+        if return_positions:
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+        return np.zeros(0, dtype=np.uint64)
+
+    # a k-mer is valid if it is within a read and has only ACGT letters
+    lengths = np.diff(offsets)
+    ends = np.repeat(offsets[1:], lengths)[0:N]
+    invalid = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(codes == 4, out=invalid[1:])
+    valid = (np.arange(N) + k <= ends) & (invalid[k:] - invalid[0:N] == 0)
+
+    codes = np.where(codes == 4, 0, codes).astype(np.uint64)
+    kmers = np.zeros(N, dtype=np.uint64)
+    for j in range(k):
+        kmers <<= np.uint64(2)
+        kmers |= codes[j:j+N]
+    if canonical:
+        # reverse complement: complement of the last letter comes first
+        reverse = np.zeros(N, dtype=np.uint64)
+        for j in range(k):
+            reverse |= (np.uint64(3) - codes[j:j+N]) << np.uint64(2 * j)
+        kmers = np.minimum(kmers, reverse)
+    if return_positions:
+        return kmers[valid], np.flatnonzero(valid)
+    return kmers[valid]
+
+
+def decode_kmers(kmers, k=7):
+    """Convert k-mer codes (see :func:`encode_kmers`) into strings"""
+    kmers = np.asarray(kmers, dtype=np.uint64)
+    letters = np.frombuffer(b"ACGT", dtype=np.uint8)
+    data = np.empty((len(kmers), k), dtype=np.uint8)
+    for j in range(k):
+        data[:, j] = letters[(kmers >> np.uint64(2 * (k - 1 - j))) & np.uint64(3)]
+    return [x.decode() for x in data.view("S%s" % k).ravel()] if k else []
+
+
+def _merge_counts(kmers, counts):
+    # sum counts of identical k-mers. Inputs are lists of arrays.
+    kmers = np.concatenate(kmers)
+    counts = np.concatenate(counts)
+    order = np.argsort(kmers, kind="mergesort")
+    kmers, counts = kmers[order], counts[order]
+    if len(kmers) == 0:
+        return kmers, counts
+    starts = np.flatnonzero(np.concatenate([[True], kmers[1:] != kmers[:-1]]))
+    return kmers[starts], np.add.reduceat(counts, starts)
+
+
+class KmerCounter(object):
+    """Count k-mers of large sets of reads
+
+    ::
+
+        from sequana.kmer import KmerCounter
+        from sequana.fastq import FastQBlockReader
+
+        counter = KmerCounter(k=21, canonical=True)
+        for batch in FastQBlockReader("test.fastq.gz"):
+            counter.update(batch)
+        counter.get_top(10)
+        counter.get_spectrum()
+
+    K-mers of each batch of reads are counted with :func:`numpy.unique`. The
+    counts of the batches are merged when more than *buffer_size* distinct
+    k-mers are pending so memory is proportional to the number of distinct
+    k-mers.
+    """
+    def __init__(self, k=7, canonical=False, buffer_size=10000000):
+        """.. rubric:: constructor
+
+        :param int k: length of the k-mers (up to 31)
+        :param bool canonical: count a k-mer and its reverse complement
+            together.
+        :param int buffer_size: see above
+        """
+        if k < 1 or k > 31:
+            raise ValueError("k must be between 1 and 31")
+        self.k = k
+        self.canonical = canonical
+        self.buffer_size = buffer_size
+        self._kmers = [np.zeros(0, dtype=np.uint64)]
+        self._counts = [np.zeros(0, dtype=np.int64)]
+        self._pending = 0
+
+    def update(self, sequences):
+        """Count k-mers of a batch of sequences
+
+        :param sequences: a :class:`~sequana.fastq.FastQBatch` or a list of
+            sequences
+        """
+        if hasattr(sequences, "offsets"):
+            kmers = encode_kmers(sequences.sequences, sequences.offsets,
+                k=self.k, canonical=self.canonical)
+        else:
+            kmers = encode_kmers(sequences, k=self.k, canonical=self.canonical)
+        kmers, counts = np.unique(kmers, return_counts=True)
+        self._kmers.append(kmers)
+        self._counts.append(counts.astype(np.int64))
+        self._pending += len(kmers)
+        if self._pending > self.buffer_size:
+            self._merge()
+
+    def merge(self, other):
+        """Add the counts of another :class:`KmerCounter` (in place)"""
+        if other.k != self.k or other.canonical != self.canonical:
+            raise ValueError("k-mer counters must have same k and canonical")
+        self._kmers.append(other.kmers)
+        self._counts.append(other.counts)
+        self._merge()
+        return self
+
+    def _merge(self):
+        kmers, counts = _merge_counts(self._kmers, self._counts)
+        self._kmers, self._counts = [kmers], [counts]
+        self._pending = 0
+
+    def _get_kmers(self):
+        if len(self._kmers) > 1:
+            self._merge()
+        return self._kmers[0]
+    kmers = property(_get_kmers, doc="sorted k-mer codes")
+
+    def _get_counts(self):
+        if len(self._counts) > 1:
+            self._merge()
+        return self._counts[0]
+    counts = property(_get_counts, doc="counts of the k-mers (see kmers)")
+
+    def __len__(self):
+        return len(self.kmers)
+
+    def _get_total(self):
+        return int(self.counts.sum())
+    total = property(_get_total, doc="total number of k-mers")
+
+    def to_series(self):
+        """Return counts as a Series indexed by the k-mers (decreasing counts)"""
+        ts = pd.Series(self.counts, index=decode_kmers(self.kmers, self.k))
+        return ts.sort_values(ascending=False)
+
+    def get_top(self, N=10):
+        """Return the N most frequent k-mers as a Series"""
+        counts = self.counts
+        N = min(N, len(counts))
+        indices = np.argpartition(-counts, N - 1)[0:N] if N else []
+        indices = sorted(indices, key=lambda i: -counts[i])
+        kmers = decode_kmers(self.kmers[indices], self.k)
+        return pd.Series(counts[indices], index=kmers)
+
+    def get_spectrum(self):
+        """Return the k-mer spectrum
+
+        :return: a Series with the number of distinct k-mers (values) seen a
+            given number of times (index).
+        """
+        spectrum = np.bincount(self.counts)
+        indices = np.flatnonzero(spectrum)
+        return pd.Series(spectrum[indices], index=indices)
+
+    def plot_spectrum(self, logy=True):
+        """Plot the k-mer spectrum (see :meth:`get_spectrum`)"""
+        import pylab
+        spectrum = self.get_spectrum()
+        pylab.plot(spectrum.index, spectrum.values, "o-")
+        if logy:
+            pylab.semilogy()
+        pylab.xlabel("k-mer multiplicity")
+        pylab.ylabel("Number of distinct k-mers")
+        pylab.grid(True)
+
+
+def get_kmer_profiles(filenames, k=5, canonical=True, max_reads=None):
+    """Return k-mer profiles of several samples (FastQ files)
+
+    :param list filenames: FastQ files (one per sample)
+    :param int k: length of the k-mers
+    :param bool canonical: see :class:`KmerCounter`
+    :param int max_reads: only use the first reads of each file
+    :return: a DataFrame with k-mers as index and one column per sample. The
+        values are the frequencies of the k-mers in each sample.
+
+    Profiles can be used to compare samples (e.g. contamination)::
+
+        df = get_kmer_profiles(["A.fastq.gz", "B.fastq.gz"])
+        df.corr()
+    """
+    from sequana.fastq import FastQBlockReader
+    profiles = {}
+    for filename in filenames:
+        counter = KmerCounter(k=k, canonical=canonical)
+        nreads = 0
+        for batch in FastQBlockReader(filename):
+            if max_reads is not None:
+                batch = batch[0:max_reads - nreads]
+            counter.update(batch)
+            nreads += len(batch)
+            if max_reads is not None and nreads >= max_reads:
+                break
+        ts = pd.Series(counter.counts, index=decode_kmers(counter.kmers, k))
+        profiles[filename] = ts / max(1, counter.total)
+    df = pd.DataFrame(profiles).fillna(0)
+    return df[list(filenames)]
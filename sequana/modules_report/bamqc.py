@@ -53,14 +53,19 @@ class BAMQCModule(SequanaBaseModule):
 
         # report/bam.html is now available
 
+    Set *cache* to True (or a cache directory) to store the statistics of
+    the BAM file so that the report can be created again without reading
+    the BAM file (see :class:`sequana.cache.StatsCache`).
+
     .. todo:: right now, the computation is performed in the class. Ideally,
         we would like the computation to happen elsewhere, where a json is stored. 
         The json would be the input to this class.
     """
-    def __init__(self, bam_input, output_filename=None):
+    def __init__(self, bam_input, output_filename=None, cache=None):
         super().__init__()
 
         self.bam_input = bam_input
+        self.cache = cache
         self.title = "Bam Report"
         self.create_report_content()
         self.create_html(output_filename)
@@ -71,13 +76,13 @@ class BAMQCModule(SequanaBaseModule):
         self.add_images_section()
 
     def _computation(self):
-        self.bam = BAM(self.bam_input)
+        self.bam = BAM(self.bam_input, cache=self.cache)
 
         results = {}
         results['alignment_count'] = len(self.bam)
 
         # first, we store the flags
-        df = self.bam.get_flags_as_df().sum()
+        df = self.bam.get_flags_count()
         df = df.to_frame()
         df.columns = ['counter']
         sf = SAMFlags()
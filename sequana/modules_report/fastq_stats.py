@@ -92,8 +92,17 @@ class FastQStatsModule(SequanaBaseModule):
         else:
             df = pd.read_json(filenames[0])
             df.index = ['R1']
-        df = df[["A", "C", "G", "T", "N", "n_reads", "mean quality", "GC content",
-                "average read length", "total bases"]]
+        # older JSON files do not have this column (exact count)
+        if "n_reads exact" in df.columns:
+            self.n_reads_exact = bool(df["n_reads exact"].all())
+        else:
+            self.n_reads_exact = True
+        columns = ["A", "C", "G", "T", "N", "n_reads", "mean quality",
+            "GC content", "average read length", "total bases"]
+        # older JSON files do not have the duplicate rate
+        if "duplicate rate" in df.columns:
+            columns.append("duplicate rate")
+        df = df[columns]
         for this in "ACGTN":
             df[this] /= df["total bases"] 
             df[this] *= 100
@@ -120,6 +129,11 @@ class FastQStatsModule(SequanaBaseModule):
    <div>{} {}</div>
    <div>""".format(html_tab, js)
 
+        if not self.n_reads_exact:
+            html += """
+   <p>Only the first reads were analysed: the number of reads (n_reads) is
+   an estimation.</p>"""
+
         html += """
    <p>The following figure(s) gives the average quality (red line) of raw reads
    (500,000 at max). The x-axis being the length of the reads. The yellow
@@ -82,19 +82,31 @@ class PacbioBAMBase(object):
 
 
     """
-    def __init__(self, filename):
+    def __init__(self, filename, cache=None):
         """
 
         :param str filename: input BAM file
+        :param cache: store the statistics on disk so that they are not
+            computed again as long as the file is unchanged. True to store
+            them next to the input file, or a cache directory (see
+            :class:`sequana.cache.StatsCache`).
 
         """
+        from sequana.cache import get_cache
         self.filename = filename
         self.data = pysam.AlignmentFile(filename, check_sq=False)
+        self._cache = get_cache(cache)
         self._df = None
         self._nb_pass = None
         self.sample_name = os.path.basename(self.filename)
 
     def __len__(self):
+        # the index of BAM files (if any) stores the number of alignments
+        if self._df is None and not getattr(self, "_sample", 0):
+            from sequana.bamtools import _get_index_counts
+            counts = _get_index_counts(self.data)
+            if counts is not None:
+                return counts["total"]
         return len(self.df)
 
     def __str__(self):
@@ -104,6 +116,21 @@ class PacbioBAMBase(object):
         self.data.close()
         self.data = pysam.AlignmentFile(self.filename, check_sq=False)
 
+    def _get_cache_params(self):
+        # parameters of the statistics (part of the cache key)
+        return {}
+
+    def _load_df(self, name=None):
+        # dataframe stored in the cache (None if not found)
+        if self._cache:
+            return self._cache.get_dataframe(self.filename,
+                name or type(self).__name__, self._get_cache_params())
+
+    def _save_df(self, df, name=None):
+        if self._cache:
+            self._cache.set_dataframe(self.filename,
+                name or type(self).__name__, df, self._get_cache_params())
+
     def _to_fastX(self, mode, output_filename, threads=2):
         """
 
@@ -312,7 +339,7 @@ class PacbioSubreads(PacbioBAMBase):
 
 
     """
-    def __init__(self, filename, sample=0):
+    def __init__(self, filename, sample=0, cache=None):
         """.. rubric:: Constructor
 
         :param str filename: filename of the input pacbio BAM file. The content
@@ -320,10 +347,14 @@ class PacbioSubreads(PacbioBAMBase):
             output of a Pacbio (Sequel) sequencing (e.g., subreads).
         :param int sample: for sample, you can set the number of subreads to
             read (0 means read all subreads)
+        :param cache: see :class:`PacbioBAMBase`
         """
-        super(PacbioSubreads, self).__init__(filename)
+        super(PacbioSubreads, self).__init__(filename, cache=cache)
         self._sample = sample
 
+    def _get_cache_params(self):
+        return {"sample": self._sample}
+
     def _get_df(self):
         # When scanning the BAM, we can extract the length, SNR of ACGT (still
         # need to know how to use it). The GC content (note there is no
@@ -353,6 +384,8 @@ class PacbioSubreads(PacbioBAMBase):
         # - RG: ?
 
         # See http://pacbiofileformats.readthedocs.io/en/3.0/BAM.html
+        if self._df is None:
+            self._df = self._load_df()
         if self._df is None:
             logger.info("Scanning input file. Please wait")
             self.reset()
@@ -412,6 +445,7 @@ class PacbioSubreads(PacbioBAMBase):
             self._df['nb_passes'] = aa
             self._df['nb_passes'] -= 1 # nb passes starts at 0
 
+            self._save_df(self._df)
             self.reset()
         return self._df
     df = property(_get_df)
@@ -654,8 +688,8 @@ class CCS(PacbioBAMBase):
         test_pacbio_subreads.bam out.bam  --minPredictedAccuracy 0.7
 
     """
-    def __init__(self, filename):
-        super(CCS, self).__init__(filename)
+    def __init__(self, filename, cache=None):
+        super(CCS, self).__init__(filename, cache=cache)
 
     @property
     def df(self):
@@ -668,6 +702,8 @@ class CCS(PacbioBAMBase):
         # sn: SNR how is this computed ?
         # zs
         # - sn: list of ACGT SNRs. A, C, G, T in that order
+        if self._df is None:
+            self._df = self._load_df()
         if self._df is not None:
             return self._df
 
@@ -716,6 +752,7 @@ class CCS(PacbioBAMBase):
             logger.warning("Found non unique ZMW. This may not be a CCS but "
                         "a subread file. Consider using PacbioSubreads class")
 
+        self._save_df(self._df)
         self.reset()
         return self._df
 
@@ -767,36 +804,54 @@ class CCS(PacbioBAMBase):
 
 class PacbioMappedBAM(PacbioBAMBase):
 
-    def __init__(self, filename, method):
-        super(PacbioMappedBAM, self).__init__(filename)
+    def __init__(self, filename, method, cache=None):
+        super(PacbioMappedBAM, self).__init__(filename, cache=cache)
         assert method in ["bwa", "blasr", "minimap2"]
         self.method = method
 
+    def _get_cache_params(self):
+        return {"method": self.method}
+
+    def _get_concordance(self, batch):
+        # concordance of a batch of alignments (see _iter_batches) computed
+        # from the CIGAR (blasr, minimap2) or the NM tag (bwa)
+        from sequana.cigar import get_cigar_counts
+        counts = get_cigar_counts(batch["cigarstring"])
+        M = counts[:, 0]
+        if self.method in ["blasr", "minimap2"]:
+            S, D, I = counts[:, 4], counts[:, 2], counts[:, 1]
+            return 1 - (D + I + S) / (D + I + M + S)
+        else:
+            error = batch["NM"]  # suppose to be I + D + X
+            total = error + M
+            concordance = np.zeros(len(total))
+            concordance[total > 0] = 1 - error[total > 0] / total[total > 0]
+            return concordance
+
+    def _iter_batches(self):
+        from sequana.bamtools import _iter_batches
+        fields = ["mapping_quality", "query_length", "cigarstring",
+            ("NM", lambda x: x.get_tag("NM") if x.has_tag("NM") else 0)]
+        self.reset()
+        for batch in _iter_batches(self.data, fields):
+            batch["NM"] = np.array(batch["NM"], dtype=np.int64)
+            yield batch
+
     def _get_data(self):
         # return list of lists
         # each list is made of 3 values: mapq, length, concordance
-        from sequana import Cigar
+        df = self._load_df("data")
+        if df is not None:
+            return [list(x) for x in zip(df.mapq.tolist(), df.length.tolist(),
+                df.concordance.tolist())]
         data = []
-        self.reset()
-        count = 0
-
-        for align in self.data:
-            mapq = align.mapq
-            length = align.rlen
-            if self.method in ["blasr", "minimap2"]:
-                this = Cigar(align.cigarstring).stats()
-                S, D, I, M = this[4] , this[2] , this[1], this[0]
-                concordance = 1 - (D+I+S)/(D + I + M + S)
-            else:
-                this = align.get_cigar_stats()[0]
-                error = this[-1]  # suppose to be I + D + X
-                total = this[-1] + this[0]
-                if total:concordance = 1- (error)/(total)
-                else:concordance = 0
-            data.append([mapq, length, concordance])
-            if count % 10000 == 0:
-                logger.info("%s" % count)
-            count+=1
+        for batch in self._iter_batches():
+            concordance = self._get_concordance(batch)
+            data.extend(zip(batch["mapping_quality"].tolist(),
+                batch["query_length"].tolist(), concordance.tolist()))
+            logger.info("%s" % len(data))
+        self._save_df(pd.DataFrame(data, columns=["mapq", "length",
+            "concordance"]), "data")
         return data
 
     def filter_mapq(self, output_filename, threshold_min=0,
@@ -824,31 +879,19 @@ class PacbioMappedBAM(PacbioBAMBase):
                     logger.info("%s sequence processed" % count)
 
     def _set_concordance(self):
-        from sequana import Cigar
-        self._concordance = []
-        self.reset()
-        count = 0
-        if self.method in ["blasr", "minimap2"]:
-            for align in self.data:
-                if align.cigarstring:
-                    this = Cigar(align.cigarstring).as_dict()
-                    S, D, I, M = this["S"] , this["D"] , this["I"], this["M"]
-                    self._concordance.append((1- (D+I+S)/(D+I+M+S)))
-                count += 1
-                if count %1000 ==0 : print(count)
-                if count == 10000: break
-        elif self.method == "bwa":
-            for align in self.data:
-                if align.cigarstring:
-                    this = align.get_cigar_stats()[0]
-                    # Last item is total error though but cannot use Cigar class
-                    # that does not have that value
-                    error = this[-1]  # suppose to be I + D + X
-                    # can check with alignment.get_cigar_stats() on blasr data
-                    # for instance
-                    #
-                    total = this[-1] + this[0]
-                    self._concordance.append((1- (error)/(total)))
+        df = self._load_df("concordance")
+        if df is not None:
+            self._concordance = df.concordance.tolist()
+            return
+        # alignments without CIGAR are ignored
+        concordance = []
+        for batch in self._iter_batches():
+            keep = np.array([bool(x) for x in batch["cigarstring"]], dtype=bool)
+            concordance.append(self._get_concordance(batch)[keep])
+        self._concordance = np.concatenate(concordance).tolist() \
+            if concordance else []
+        self._save_df(pd.DataFrame({"concordance": self._concordance}),
+            "concordance")
 
     def hist_concordance(self,  bins=100, fontsize=16):
         """
@@ -922,16 +965,19 @@ class BAMSimul(PacbioBAMBase):
     information such as the length of the reads, the ACGT content, the GC content.
 
     """
-    def __init__(self, filename):
+    def __init__(self, filename, cache=None):
         """.. rubric:: Constructor
 
         :param str filename: filename of the input pacbio BAM file. The content
             of the BAM file is not the ouput of a mapper. Instead, it is the
             output of a Pacbio (Sequel) sequencing (e.g., subreads).
+        :param cache: see :class:`PacbioBAMBase`
         """
-        super(BAMSimul, self).__init__(filename)
+        super(BAMSimul, self).__init__(filename, cache=cache)
 
     def _get_df(self):
+        if self._df is None:
+            self._df = self._load_df()
         if self._df is None:
             self.reset()
             N = 0
@@ -956,6 +1002,7 @@ class BAMSimul(PacbioBAMBase):
 
             self._df = pd.DataFrame(all_results,
                 columns=['read_length','GC_content'])
+            self._save_df(self._df)
             self.reset()
         return self._df
     df = property(_get_df)
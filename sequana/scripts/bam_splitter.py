@@ -19,6 +19,7 @@ import os
 import sys
 import argparse
 
+from sequana.lazy import numpy as np
 from sequana.scripts.tools import SequanaOptions
 
 from easydev.console import purple
@@ -67,88 +68,91 @@ another file\n""" % prog
         self.add_argument("--keep-unmapped", dest="keep_unmapped",
                           action="store_true",
                           help="keep unmapped files")
+        self.add_argument("--compress", dest="compress",
+                          action="store_true",
+                          help="compress the output files (gzip)")
+        self.add_argument("--threads", dest="threads", type=int, default=1,
+                          help="number of threads used to decompress the input file")
 
         self.add_version(self)
         self.add_level(self)
 
 
-def sniff(filename):
+def sniff(filename, threads=1):
     logger.info("Sniffing file")
     from sequana import BAM, SAM, CRAM
     from sequana.sniffer import sniffer
     datatype = sniffer(filename)
     if datatype == "SAM":
         logger.info("Input data in SAM format")
-        data = SAM(filename)
+        data = SAM(filename, threads=threads)
     elif datatype == "BAM":
         logger.info("Input data in BAM format")
-        data = BAM(filename)
+        data = BAM(filename, threads=threads)
     elif datatype == "CRAM":
         logger.info("Input data in CRAM format")
-        data = CRAM(filename)
+        data = CRAM(filename, threads=threads)
     else:
         raise ValueError("Your input file does not seem to be a valid SAM/BAM/CRAM file")
     return data
 
 
-def splitter_mapped_unmapped(filename, prefix):
-    logger.info("Creating 2 files (mapped and unmapped reads)")
-    data = sniff(filename)
+def _splitter(filename, prefix, keep_unmapped=True, threads=1,
+        compress=False):
+    """Write the mapped (and unmapped) reads by batches"""
+    from sequana.bamtools import _iter_batches
+    from sequana.tools import ThreadedWriter, _format_fastq
+    data = sniff(filename, threads=threads)
+    extension = ".fastq.gz" if compress else ".fastq"
 
-    count = 0
     flags = []
     match = 0
-    unmatch = 0
+    outputs = {0: ThreadedWriter("{}.mapped{}".format(prefix, extension))}
+    if keep_unmapped:
+        outputs[4] = ThreadedWriter("{}.unmapped{}".format(prefix, extension))
+    fields = ["flag", "query_name", "query_sequence", "qual"]
+    try:
+        for batch in _iter_batches(data._data, fields):
+            # secondary reads (flag 256) are dropped. Others are split
+            # according to flag 4
+            status = np.where(batch["flag"] & 256, -1, batch["flag"] & 4)
+            for value, writer in outputs.items():
+                indices = np.flatnonzero(status == value).tolist()
+                sequences = [batch["query_sequence"][i] for i in indices]
+                qualities = [batch["qual"][i] for i in indices]
+                assert [len(x) for x in sequences] == [len(x) for x in qualities]
+                writer.write(_format_fastq([batch["query_name"][i]
+                    for i in indices], sequences, qualities))
+            match += int((status == 0).sum())
+            flags.extend(batch["flag"].tolist())
+    finally:
+        for writer in outputs.values():
+            writer.close()
+    return match, len(flags) - match, flags
+
+
+def splitter_mapped_unmapped(filename, prefix, threads=1, compress=False):
+    logger.info("Creating 2 files (mapped and unmapped reads)")
     logger.info("Please wait while creating output files")
-    with open("{}.unmapped.fastq".format(prefix), "w") as fnosirv:
-        with open("{}.mapped.fastq".format(prefix), "w") as fsirv:
-            for a in data:
-                if a.flag & 256:
-                    unmatch += 1
-                elif a.flag & 4:
-                    read = "@{}\n{}\n+\n{}\n".format(a.qname, a.query_sequence, a.qual)
-                    assert len(a.query_sequence) == len(a.qual)
-                    fnosirv.write(read)
-                    unmatch += 1
-                else:
-                    read = "@{}\n{}\n+\n{}\n".format(a.qname, a.query_sequence, a.qual)
-                    assert len(a.query_sequence) == len(a.qual)
-                    fsirv.write(read)
-                    match += 1
-                flags.append(a.flag)
-    return match, unmatch, flags
+    return _splitter(filename, prefix, True, threads=threads,
+        compress=compress)
 
 
-def splitter_mapped_only(filename, prefix):
+def splitter_mapped_only(filename, prefix, threads=1, compress=False):
     logger.info("Creating 1 file (mapped reads only). ")
     logger.info("Use --keep-unmapped to save unmapped reads.")
-    data = sniff(filename)
-
-    count = 0
-    flags = []
-    match = 0
-    unmatch = 0
-
     logger.info("Please wait while creating output file")
-    with open("{}.mapped.fastq".format(prefix), "w") as fsirv:
-        for a in data:
-            if a.flag & 260:
-                unmatch += 1
-                count += 1
-            else:
-                read = "@{}\n{}\n+\n{}\n".format(a.qname, a.query_sequence, a.qual)
-                assert len(a.query_sequence) == len(a.qual)
-                fsirv.write(read)
-                match += 1
-            flags.append(a.flag)
-    return match, unmatch, flags
+    return _splitter(filename, prefix, False, threads=threads,
+        compress=compress)
 
 
-def _main(filename, prefix, keep_unmapped=True):
+def _main(filename, prefix, keep_unmapped=True, threads=1, compress=False):
     if keep_unmapped:
-        match, unmatch, flags = splitter_mapped_unmapped(filename, prefix)
+        match, unmatch, flags = splitter_mapped_unmapped(filename, prefix,
+            threads=threads, compress=compress)
     else:
-        match, unmatch, flags = splitter_mapped_only(filename, prefix)
+        match, unmatch, flags = splitter_mapped_only(filename, prefix,
+            threads=threads, compress=compress)
     return match, unmatch, flags
 
 
@@ -192,7 +196,8 @@ def main(args=None):
 
 
     match, unmatch, flags = _main(options.input, prefix,
-        keep_unmapped=options.keep_unmapped)
+        keep_unmapped=options.keep_unmapped, threads=options.threads,
+        compress=options.compress)
 
     logger.info("Matched: {}".format(match))
     logger.info("Unmatched (flag 4 and 256): {}".format(unmatch))
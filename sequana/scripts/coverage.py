@@ -32,7 +32,7 @@ from sequana.utils import config
 from sequana import logger
 from sequana.bedtools import GenomeCov
 
-from easydev import shellcmd, mkdirs
+from easydev import mkdirs
 from easydev.console import purple
 
 from pylab import show, figure, savefig
@@ -73,7 +73,7 @@ class Options(argparse.ArgumentParser):
       The first column being the reference, the second is the position
       and the third column contains the coverage itself.
     - or a BAM file that is converted automatically
-      into a BED file using the following command:
+      into a BED file (same output as the following command):
 
         samtools depth -aa input.bam > output.bed
 
@@ -138,8 +138,7 @@ Issues: http://github.com/sequana/sequana
         group = self.add_argument_group("Required argument")
         group.add_argument("-i", "--input", dest="input", type=str,
             help=("Input file in BED or BAM format. If a BAM file is "
-                 "provided, it will be converted locally to a BED file "
-                 "using genomecov, which must be installed."))
+                 "provided, it will be converted locally to a BED file."))
 
         group = self.add_argument_group("Optional biological arguments")
         group.add_argument(
@@ -294,7 +293,9 @@ def main(args=None):
     if options.input.endswith(".bam"):
         bedfile = options.input.replace(".bam", ".bed")
         logger.info("Converting BAM into BED file")
-        shellcmd("bedtools genomecov -d -ibam %s > %s" % (options.input, bedfile))
+        from sequana import BAM
+        coverage = BAM(options.input).collect(["coverage"])["coverage"]
+        coverage.to_bed(bedfile)
     elif options.input.endswith(".bed"):
         bedfile = options.input
     else:
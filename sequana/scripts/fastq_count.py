@@ -34,6 +34,12 @@ class Options(argparse.ArgumentParser):
         super(Options, self).__init__(usage=usage, prog=prog)
         self.add_argument("--input", dest='input_filename', type=str,
                             required=True, help="input fastq gzipped or not")
+        self.add_argument("--jobs", dest='jobs', type=int, default=1,
+                            help="""number of cores used to decompress
+                            multi-member gzip files (e.g. BGZF)""")
+        self.add_argument("--cache", dest='cache', action="store_true",
+                            help="""store the counts in a cache so that further
+                            calls on the same file are immediate""")
  
 def main(args=None):
     if args is None:
@@ -48,13 +54,16 @@ def main(args=None):
             pass
         options = SimpleOpt()
         options.input_filename = args[1]
+        options.jobs = 1
+        options.cache = False
     else:
         options = user_options.parse_args(args[1:])
 
     f = FastQ(options.input_filename)
-    # could be simplified calling count_reads only once
-    print("Number of reads: %s" % f.count_reads())
-    print("Number of lines %s " % f.count_lines())
+    # a single pass: the number of reads is deduced from the number of lines
+    nlines = f.count_lines(jobs=options.jobs, cache=options.cache)
+    print("Number of reads: %s" % (nlines // 4))
+    print("Number of lines %s " % nlines)
 
 
 if __name__ == "__main__":
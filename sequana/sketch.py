@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of Sequana software
+#
+#  Copyright (c) 2016 - Sequana Development Team
+#
+#  File author(s):
+#      Thomas Cokelaer <thomas.cokelaer@pasteur.fr>
+#      Dimitri Desvillechabrol <dimitri.desvillechabrol@pasteur.fr>,
+#          <d.desvillechabrol@gmail.com>
+#
+#  Distributed under the terms of the 3-clause BSD license.
+#  The full license is in the LICENSE file, distributed with this software.
+#
+#  website: https://github.com/sequana/sequana
+#  documentation: http://sequana.readthedocs.io
+#
+##############################################################################
+"""Probabilistic data structures with a fixed memory footprint
+
+Sequences are hashed by batches into 64-bits integers
+(:func:`hash_sequences`). The hashes can then be fed to
+
+- a :class:`HyperLogLog` to estimate the number of distinct sequences,
+- a :class:`CountMinSketch` to estimate the number of occurences of a
+  sequence.
+
+Both structures can be merged so that statistics computed on several shards
+or lanes can be combined::
+
+    from sequana.sketch import hash_sequences, HyperLogLog
+    hll = HyperLogLog()
+    hll.update(hash_sequences([b"ACGT", b"ACGT", b"AAAA"]))
+    hll.cardinality     # about 2
+
+Hashes are deterministic (no random seed) so that sketches computed in
+different processes are compatible.
+"""
+from sequana.lazy import numpy as np
+
+
+__all__ = ["hash_sequences", "combine_hashes", "HyperLogLog",
+    "CountMinSketch"]
+
+
+def _mix64(values):
+    # splitmix64 finaliser (wraps modulo 2**64)
+    values = np.asarray(values, dtype=np.uint64)
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xbf58476d1ce4e5b9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+# one odd 64-bits coefficient per position (extended on request)
+_coefficients = np.zeros(0, dtype=np.uint64)
+
+
+def _get_coefficients(N):
+    global _coefficients
+    if len(_coefficients) < N:
+        N = max(N, 2 * len(_coefficients), 1024)
+        positions = np.arange(N, dtype=np.uint64) + np.uint64(0x9e3779b97f4a7c15)
+        _coefficients = _mix64(positions) | np.uint64(1)
+    return _coefficients
+
+
+def hash_sequences(sequences, offsets=None, length=None):
+    """Return a 64-bits hash of each sequence
+
+    :param sequences: list of sequences (bytes or str), or a uint8 buffer
+        of concatenated sequences
+    :param offsets: if *sequences* is a buffer, offsets of the sequences
+        (see :class:`sequana.fastq.FastQBatch`)
+    :param int length: hash only the first *length* characters of each
+        sequence. All characters are used if None.
+    :return: a numpy array of uint64
+
+    Sequences are hashed with a random linear combination of their
+    characters (one coefficient per position) followed by a bit mixer.
+    """
+    if offsets is None:
+        from sequana.kmer import _to_buffer
+        sequences, offsets = _to_buffer(sequences)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    position = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+    if length is not None:
+        keep = position < length
+        sequences, position = sequences[keep], position[keep]
+        lengths = np.minimum(lengths, length)
+
+    coefficients = _get_coefficients(int(lengths.max()) if len(lengths) else 0)
+    values = sequences.astype(np.uint64) * coefficients[position]
+    cumsum = np.zeros(len(values) + 1, dtype=np.uint64)
+    np.cumsum(values, out=cumsum[1:])
+    ends = np.cumsum(lengths)
+    values = cumsum[ends] - cumsum[ends - lengths]
+    return _mix64(values ^ _mix64(lengths.astype(np.uint64)))
+
+
+def combine_hashes(hashes1, hashes2):
+    """Combine the hashes of two sequences (e.g. paired reads)
+
+    The combination is not symmetric: (R1, R2) and (R2, R1) give different
+    hashes.
+    """
+    hashes2 = np.asarray(hashes2, dtype=np.uint64)
+    return _mix64(np.asarray(hashes1, dtype=np.uint64) ^
+        (hashes2 * np.uint64(0xc2b2ae3d27d4eb4f)))
+
+
+class HyperLogLog(object):
+    """Estimate the number of distinct items of a stream of hashes
+
+    ::
+
+        hll = HyperLogLog(p=14)
+        hll.update(hashes)
+        hll.cardinality
+
+    The memory footprint is 2**p bytes (16kb for p=14) and the relative
+    standard error is about 1.04 / sqrt(2**p) (0.8% for p=14).
+    """
+    def __init__(self, p=14):
+        """.. rubric:: constructor
+
+        :param int p: precision (number of bits used to select a register,
+            between 4 and 18)
+        """
+        if not 4 <= p <= 18:
+            raise ValueError("p must be between 4 and 18")
+        self.p = p
+        self.registers = np.zeros(2 ** p, dtype=np.uint8)
+
+    def update(self, hashes):
+        """Add 64-bits hashes (see :func:`hash_sequences`)"""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(hashes) == 0:
+            return
+        nbits = 64 - self.p
+        index = (hashes >> np.uint64(nbits)).astype(np.int64)
+        remainder = hashes & np.uint64(2 ** nbits - 1)
+        # rank of the leftmost 1-bit in the remaining bits (nbits + 1 if
+        # there is none). Values are shifted so that the conversion to float
+        # is exact (frexp returns the position of the leftmost 1-bit)
+        shift = max(0, nbits - 52)
+        exponent = np.frexp((remainder >> np.uint64(shift)).astype(np.float64))[1]
+        rank = (nbits + 1 - shift - exponent).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        """Merge another :class:`HyperLogLog` (in place)"""
+        if self.p != other.p:
+            raise ValueError("Cannot merge HyperLogLog with different precision")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def _get_cardinality(self):
+        m = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / np.power(2., -self.registers.astype(np.float64)).sum()
+        zeros = (self.registers == 0).sum()
+        if estimate <= 4 * m and zeros > 0:
+            # small range correction (linear counting). The raw estimate is
+            # biased up to about 5m, hence a threshold larger than the usual
+            # 2.5m
+            estimate = m * np.log(m / float(zeros))
+        return float(estimate)
+    cardinality = property(_get_cardinality,
+        doc="estimated number of distinct items")
+
+    def __len__(self):
+        return int(round(self.cardinality))
+
+
+class CountMinSketch(object):
+    """Estimate the number of occurences of items of a stream of hashes
+
+    ::
+
+        cms = CountMinSketch(width=2**16, depth=4)
+        cms.update(hashes)
+        cms.query(hashes)
+
+    Estimates are never below the true counts. The over-estimation is lower
+    than e / width times the total number of items with probability
+    1 - exp(-depth). The memory footprint is 8 x width x depth bytes (2Mb
+    with default parameters).
+    """
+    def __init__(self, width=2**16, depth=4):
+        """.. rubric:: constructor
+
+        :param int width: number of counters per row (a power of 2)
+        :param int depth: number of rows (independent hash functions)
+        """
+        if width & (width - 1):
+            raise ValueError("width must be a power of 2")
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.total = 0
+
+    def _get_indices(self, hashes, row):
+        salt = np.uint64((row + 1) * 0x9e3779b97f4a7c15 % 2**64)
+        return (_mix64(hashes ^ salt) & np.uint64(self.width - 1)).astype(np.int64)
+
+    def update(self, hashes, counts=None):
+        """Add 64-bits hashes (each with a count of 1 by default)"""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        for row in range(self.depth):
+            self.table[row] += np.bincount(self._get_indices(hashes, row),
+                weights=counts, minlength=self.width).astype(np.int64)
+        self.total += len(hashes) if counts is None else int(np.sum(counts))
+
+    def query(self, hashes):
+        """Return the estimated count of each hash"""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        counts = np.full(len(hashes), np.iinfo(np.int64).max, dtype=np.int64)
+        for row in range(self.depth):
+            np.minimum(counts, self.table[row][self._get_indices(hashes, row)],
+                out=counts)
+        return counts
+
+    def merge(self, other):
+        """Merge another :class:`CountMinSketch` (in place)"""
+        if self.table.shape != other.table.shape:
+            raise ValueError("Cannot merge CountMinSketch with different shapes")
+        self.table += other.table
+        self.total += other.total
+        return self
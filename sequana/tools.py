@@ -24,18 +24,19 @@ import json
 import re
 import gzip
 import io
-from collections import Counter
+import zlib
+from collections import Counter, OrderedDict
 
 from sequana.lazy import pandas as pd
 from sequana.lazy import numpy as np
-from sequana import BAM
+from sequana import BAM, logger
 
 from pysam import FastxFile
 from easydev import precision
-from easydev.misc import cmd_exists
-import subprocess
 
-__all__ = ['StatsBAM2Mapped', 'bam_to_mapped_unmapped_fastq', "GZLineCounter"]
+__all__ = ['StatsBAM2Mapped', 'bam_to_mapped_unmapped_fastq', "GZLineCounter",
+    "count_lines", "is_bgzf", "open_writer", "ThreadedWriter",
+    "ReservoirSampler"]
 
 
 class DataContainer(dict):
@@ -57,6 +58,7 @@ try:
         return x
 except:
     _translate = bytes.maketrans(b'ACGTacgt', b'TGCAtgca')
+_translate_str = str.maketrans('ACGTacgt', 'TGCAtgca')
 
 
 def reverse_complement(seq):
@@ -69,10 +71,11 @@ def reverse(seq):
 
 class StatsBAM2Mapped(DataContainer):
 
-    def __init__(self, bamfile=None, wkdir=None, verbose=True):
+    def __init__(self, bamfile=None, wkdir=None, verbose=True, **kwargs):
         super(StatsBAM2Mapped, self).__init__(wkdir=wkdir)
         if bamfile.endswith(".bam"):
-            self.data = bam_to_mapped_unmapped_fastq(bamfile, wkdir, verbose)
+            self.data = bam_to_mapped_unmapped_fastq(bamfile, wkdir, verbose,
+                **kwargs)
         elif bamfile.endswith(".json"):
             self.data = self.read_json(bamfile)
 
@@ -97,7 +100,41 @@ class StatsBAM2Mapped(DataContainer):
         return html
 
 
-def bam_to_mapped_unmapped_fastq(filename, output_directory=None, verbose=True):
+def _format_fastq(names, sequences, qualities, reverse=None, suffixes=None):
+    """Format reads as FastQ records in a single block of bytes
+
+    :param names: list of read names
+    :param sequences: list of sequences (str)
+    :param qualities: list of qualities (str)
+    :param reverse: indices of the reads to reverse complement (e.g. reads
+        mapped on the reverse strand). The lists are modified in place.
+    :param suffixes: optional list of suffixes appended to the names (e.g.
+        /1 and /2)
+
+    The lines of all records are interleaved and joined at once, which is
+    much faster than formatting the records one by one.
+    """
+    N = len(names)
+    if N == 0:
+        return b""
+    if reverse is not None:
+        for i in reverse:
+            sequences[i] = sequences[i].translate(_translate_str)[::-1]
+            qualities[i] = qualities[i][::-1]
+    lines = [None] * (4 * N)
+    if suffixes is None:
+        lines[0::4] = ["@" + x for x in names]
+    else:
+        lines[0::4] = ["@" + x + y for x, y in zip(names, suffixes)]
+    lines[1::4] = sequences
+    lines[2::4] = ["+"] * N
+    lines[3::4] = qualities
+    lines.append("")
+    return "\n".join(lines).encode()
+
+
+def bam_to_mapped_unmapped_fastq(filename, output_directory=None, verbose=True,
+        compress=False, threads=1, chunksize=10000, window=1000000):
     """Create mapped and unmapped fastq files from a BAM file
 
     :context: given a reference, one or two FastQ files are mapped onto the
@@ -107,6 +144,13 @@ def bam_to_mapped_unmapped_fastq(filename, output_directory=None, verbose=True):
 
     :param filename: input BAM file
     :param output_directory: where to save the mapped and unmapped files
+    :param bool compress: if True, the FastQ files are compressed (.fastq.gz)
+    :param int threads: number of threads used by pysam to decompress the
+        BAM file
+    :param int chunksize: number of reads processed at once
+    :param int window: maximum number of reads waiting for their mate. When
+        the limit is reached, the oldest reads are written according to the
+        mate flags stored in the BAM file. This bounds the memory used.
     :return: dictionary with number of reads for each file (mapped/unmapped for
         R1/R2) as well as the mode (paired or not), the number of unpaired
         reads, and the number of duplicated reads. The unpaired reads should
@@ -116,9 +160,9 @@ def bam_to_mapped_unmapped_fastq(filename, output_directory=None, verbose=True):
     In the paired-end case, 4 files are created.
 
     Note that this function is efficient in that it does not create intermediate
-    files limiting IO in the process. As compared to standard tools such as 
-    bedtools bamtofastq, it is 1.5 to 2X slower but it does create the mapped
-    AND unmapped reads.
+    files limiting IO in the process. Reads are processed by batches and
+    formatted in bulk. Each output file is written (and compressed) by a
+    dedicated thread (see :class:`ThreadedWriter`).
 
     :Details: Secondary alignment (flag 256) are dropped so as to remove any
         ambiguous alignments. The output dictionary stores "secondary" key to
@@ -133,6 +177,11 @@ def bam_to_mapped_unmapped_fastq(filename, output_directory=None, verbose=True):
         If R1 is mapped **or** R2 is mapped then the reads are considered mapped. If
         both R1 and R2 are unmapped, then reads are unmapped.
 
+        Mates are not expected to be adjacent in the BAM file: a read waits
+        in a table (indexed by read name) until its mate is found. The two
+        mates are then written together so that the R1 and R2 files are
+        synchronised, even if the BAM file is sorted by coordinates.
+
     .. note:: about chimeric alignment: one is the representative and the other is
         the supplementary. This flag is not used in this function. Note also that
         chimeric alignment have same QNAME and flag 4 and 8
@@ -147,7 +196,9 @@ def bam_to_mapped_unmapped_fastq(filename, output_directory=None, verbose=True):
         total reads = unmappeds reads + R1 mapped + R2 mapped - supplementary
         reads (those with flag 2048).
     """
-    bam = BAM(filename)
+    from sequana.bamtools import _iter_batches
+
+    bam = BAM(filename, threads=threads)
     # figure out if this is paired or unpaired
 
     newname, ext = os.path.splitext(filename)
@@ -166,26 +217,39 @@ def bam_to_mapped_unmapped_fastq(filename, output_directory=None, verbose=True):
         ff = FileFactory(filename)
         newname = output_directory + os.sep + ff.filenames[0]
 
-    rt1 = "_R1_"
-    rt2 = "_R2_"
-
-    R1_mapped = open(newname + "{}.mapped.fastq".format(rt1), "wb")
-    R1_unmapped = open(newname + "{}.unmapped.fastq".format(rt1), "wb")
+    # the outputs in this order: R1 mapped/unmapped, R2 mapped/unmapped
+    keys = ['R1_mapped', 'R1_unmapped']
     stats['duplicated'] = 0
     stats['unpaired'] = 0
 
-    unpaired = 0
-
     # if paired, let open other files
     if bam.is_paired:
         stats['mode'] = "pe"
         stats['R2_unmapped'] = 0
         stats['R2_mapped'] = 0
-        R2_mapped = open(newname + "{}.mapped.fastq".format(rt2), "wb")
-        R2_unmapped = open(newname + "{}.unmapped.fastq".format(rt2), "wb")
+        keys += ['R2_mapped', 'R2_unmapped']
     else:
         stats['mode'] = "se"
 
+    extension = ".fastq.gz" if compress else ".fastq"
+    outputs = [ThreadedWriter("{}_{}_.{}{}".format(newname, key[0:2], key[3:],
+        extension)) for key in keys]
+
+    # reads waiting for their mate ((name, R2) -> [output, unmapped, mate
+    # unmapped, record]), oldest first
+    pending = collections.OrderedDict()
+
+    def get_output(read, status):
+        # output of a read given the status of the pair (1 if unmapped)
+        return read[0] - read[1] + status
+
+    def write_pending(records, key):
+        # write a read without mate according to the mate flags
+        read = pending.pop(key)
+        index = get_output(read, int(read[1] and read[2]))
+        records[index].append(read[3])
+        stats[keys[index]] += 1
+
     # loop through the BAM (make sure it is rewinded)
     bam.reset()
 
@@ -193,82 +257,117 @@ def bam_to_mapped_unmapped_fastq(filename, output_directory=None, verbose=True):
         from easydev import Progress
         pb = Progress(len(bam))
 
-    for i, this in enumerate(bam):
-        if this.flag & 256:
-            # Unmapped reads are in the BAM file but have no valid assigned
-            # position (N.B., they may have an assigned position, but it should be ignored).
-            # It's typically the case that a number of reads can't be aligned, due to things
-            # like sequencing errors, imperfect matches between the DNA sequenced and the
-            # reference, random e. coli or other contamination, etc..
-            # A secondary alignment occurs when a given read could align reasonably well to
-            # more than one place. One of the possible reported alignments is termed "primary"
-            # and the others will be marked as "secondary".
-            stats['secondary'] += 1
-            if this.is_paired is False:
-                stats['unpaired'] += 1
-        else:
+    fields = ["flag", "query_name", "query_sequence", "qual"]
+    count = 0
+    try:
+        for batch in _iter_batches(bam._data, fields, chunksize=chunksize):
+            flags = batch['flag']
+            names = batch['query_name']
+            sequences = batch['query_sequence']
+            qualities = batch['qual']
+            suffixes = np.where(flags & 64, "/1", "/2").tolist()
 
-            # quick hack
-            if this.is_read1:
-                suffix = b"/1"
-            else:
-                suffix = b"/2"
-
-            # in pysam, seq is a string and qual a bytes....
-            if this.is_reverse is True:
-                txt = b"@" + bytes(this.qname, "utf-8") + suffix + b"\n"
-                revcomp = reverse_complement(this.seq)
-                txt += bytes(revcomp, "utf-8") + b"\n"
-                txt += b"+\n"
-                txt += bytes(this.qual[::-1], 'utf-8') + b"\n"
-            else:
-                txt = b"@" + bytes(this.qname, "utf-8") + suffix + b"\n"
-                txt += bytes(this.seq, "utf-8") + b"\n"
-                txt += b"+\n"
-                txt += bytes(this.qual,"utf-8") + b"\n"
-
-            # Here, we must be careful as to keep the pairs. So if R1 is mapped
-            # but R2 is unmapped (or the inverse), then the pair is mapped
-            if this.is_read1:
-                if this.is_unmapped and this.mate_is_unmapped:
-                    R1_unmapped.write(txt)
-                    stats['R1_unmapped'] += 1
-                else:
-                    R1_mapped.write(txt)
-                    stats['R1_mapped'] += 1
-            elif this.is_read2:
-                if this.is_unmapped and this.mate_is_unmapped:
-                    R2_unmapped.write(txt)
-                    stats['R2_unmapped'] += 1
-                else:
-                    R2_mapped.write(txt)
-                    stats['R2_mapped'] += 1
-            else:
-                # This should be a single read
-                #assert self.is_paired is False
-                stats['unpaired'] += 1
-                if this.is_unmapped:
-                    R1_unmapped.write(txt)
-                    stats['R1_unmapped'] += 1
+            # Unmapped reads are in the BAM file but have no valid assigned
+            # position (N.B., they may have an assigned position, but it
+            # should be ignored). A secondary alignment occurs when a given
+            # read could align reasonably well to more than one place. One of
+            # the possible reported alignments is termed "primary" and the
+            # others will be marked as "secondary". Those are dropped.
+            secondary = flags & 256 > 0
+            single = flags & 192 == 0
+            stats['secondary'] += int(secondary.sum())
+            stats['unpaired'] += int((secondary & (flags & 1 == 0)).sum())
+            stats['unpaired'] += int((~secondary & single).sum())
+            stats['duplicated'] += int((~secondary & (flags & 1024 > 0)).sum())
+
+            unmapped = (flags & 4 > 0).astype(int)
+            output = unmapped.copy()
+            if stats['mode'] == "pe":
+                output += np.where(flags & 128, 2, 0)
+            output[secondary] = -1
+
+            # Here, we must be careful as to keep the pairs. So if R1 is
+            # mapped but R2 is unmapped (or the inverse), then the pair is
+            # mapped. Supplementary alignments (flag 2048) are not paired.
+            def format_read(i):
+                return _format_fastq([names[i]], [sequences[i]],
+                    [qualities[i]], reverse=[0] if flags[i] & 16 else None,
+                    suffixes=[suffixes[i]])
+
+            records = [[] for x in outputs]
+            rank = np.arange(len(flags))
+            paired = ~secondary & ~single & (flags & 2048 == 0)
+            in_batch = {}
+            for i in np.flatnonzero(paired).tolist():
+                # mates are identified by their name and R1/R2 flag
+                key = (names[i], bool(flags[i] & 128))
+                mate = pending.pop((key[0], not key[1]), None)
+                read = [int(output[i]), int(unmapped[i]), bool(flags[i] & 8)]
+                if mate is None:
+                    if key in in_batch:
+                        # same name and flag: the previous read has no mate
+                        j = in_batch.pop(key)
+                        previous = pending.pop(key)
+                        output[j] = get_output(previous,
+                            int(previous[1] and previous[2]))
+                    elif key in pending:
+                        write_pending(records, key)
+                    pending[key] = read + [None]
+                    in_batch[key] = i
+                    continue
+                # the two mates are written at the position of the second one
+                # so that the R1 and R2 files are synchronised
+                status = int(read[1] and mate[1])
+                output[i] = get_output(read, status)
+                if mate[3] is None:
+                    # mate in this batch
+                    j = in_batch.pop((key[0], not key[1]))
+                    output[j] = get_output(mate, status)
+                    rank[j] = i
                 else:
-                    R1_mapped.write(txt)
-                    stats['R1_mapped'] += 1
-
-            if this.is_duplicate:
-                stats['duplicated'] += 1
-
-        if verbose:
-            pb.animate(i+1)
-
-    if bam.is_paired:
-        R2_mapped.close()
-        R2_unmapped.close()
+                    index = get_output(mate, status)
+                    records[index].append(mate[3])
+                    records[output[i]].append(format_read(i))
+                    stats[keys[index]] += 1
+                    stats[keys[output[i]]] += 1
+                    output[i] = -1
+
+            # the reads of this batch still waiting for their mate are
+            # formatted now
+            for key, i in in_batch.items():
+                pending[key][3] = format_read(i)
+                output[i] = -1
+            while len(pending) > window:
+                write_pending(records, next(iter(pending)))
+
+            for i, writer in enumerate(outputs):
+                selection = np.flatnonzero(output == i)
+                selection = selection[np.argsort(rank[selection],
+                    kind="stable")].tolist()
+                stats[keys[i]] += len(selection)
+                reverse = [j for j, k in enumerate(selection) if flags[k] & 16]
+                records[i].append(_format_fastq([names[k] for k in selection],
+                    [sequences[k] for k in selection],
+                    [qualities[k] for k in selection], reverse=reverse,
+                    suffixes=[suffixes[k] for k in selection]))
+                writer.write(b"".join(records[i]))
+
+            count += len(flags)
+            if verbose:
+                pb.animate(count)
+
+        # reads without mate
+        records = [[] for x in outputs]
+        while pending:
+            write_pending(records, next(iter(pending)))
+        for writer, data in zip(outputs, records):
+            writer.write(b"".join(data))
+    finally:
+        for writer in outputs:
+            writer.close()
 
     if verbose:
-        print("\nNumber of entries in the BAM: %s" % str(i+1))
-
-    R1_mapped.close()
-    R1_unmapped.close()
+        print("\nNumber of entries in the BAM: %s" % str(count))
 
     _x = stats['R1_mapped']
     _y = stats['R1_unmapped']
@@ -277,7 +376,7 @@ def bam_to_mapped_unmapped_fastq(filename, output_directory=None, verbose=True):
     return stats
 
 
-def bam_get_paired_distance(filename):
+def bam_get_paired_distance(filename, chunksize=10000, max_pending=1000000):
     """Return distance between 2 mated-reads
 
     :return: list of tuples where each tuple contains the position start,
@@ -290,41 +389,46 @@ def bam_get_paired_distance(filename):
         distances = bam_get_paired_distance(bamfile)
         hist([x[1]-x[0] for x in distances])
 
+    Mates are paired by names so the file does not need to be sorted by
+    names (see :class:`sequana.bamtools.InsertSizeMetric`, which pairs the
+    mates the same way). Only primary alignments of pairs mapped on the
+    same reference are used. Between batches of *chunksize* alignments, at
+    most *max_pending* reads wait for their mate (pairs whose mate is
+    removed are not reported). Histograms of the insert sizes are computed faster with
+    :meth:`sequana.bamtools.SAMBAMbase.get_insert_sizes`.
+
     .. warning:: experimental
     """
+    from sequana.bamtools import _iter_batches, _MatePairing
 
     b = BAM(filename)
     distances = []
-
-    for fragment in b:
-        if fragment.is_unmapped is False and fragment.mate_is_unmapped is False \
-            and fragment.is_read1:
-
-            # get the mate:
-            mate = next(b)
-
-
-            if fragment.is_reverse:
-                position2 = fragment.reference_end
-                position1 = mate.reference_start
-                mode = 1
-            elif mate.is_reverse:
-                position1 = fragment.reference_start
-                position2 = mate.reference_end
-                mode = 2
-            else: # if both are not reversed, what does that mean.
+    pairing = _MatePairing(max_pending, max_unpaired=max_pending)
+    fields = _MatePairing.fields + ("reference_end",)
+    for batch in _iter_batches(b._data, fields, chunksize):
+        indices = pairing.select(batch)
+        flags = batch["flag"][indices]
+        # (is_read1, start, end, reverse) of each mate
+        values = zip(((flags & 64) > 0).tolist(),
+            batch["reference_start"][indices].tolist(),
+            batch["reference_end"][indices].tolist(),
+            ((flags & 16) > 0).tolist())
+        pairs, _ = pairing.update(batch, indices, values)
+        for fragment, mate in pairs:
+            if not fragment[0]:
+                fragment, mate = mate, fragment
+
+            if fragment[3]:
+                distances.append((mate[1], fragment[2], 1))
+            elif mate[3]:
+                distances.append((fragment[1], mate[2], 2))
+            else:
+                # if both are not reversed, what does that mean.
                 # On Hm2, this is the case for 4 pairs out of 1622
                 # This seems to be a special case for fragment ends exactly
                 # at the end of the reference and mate starts exactly at
                 # the beginnin with a length less than 100
-                print(fragment.reference_start, fragment.reference_end)
-                print(mate.reference_start, mate.reference_end)
-                position1 = -1
-                position2 = -1
-                mode = 3
-
-            distances.append((position1, position2, mode))
-
+                distances.append((-1, -1, 3))
     return distances
 
 
@@ -444,89 +548,628 @@ def genbank_features_parser(input_filename):
 
 
 
+_GZIP_MAGIC = b"\x1f\x8b\x08"
+
+
+def _find_gzip_member(fin, start, end, block_size=1024*1024):
+    """Return offset of the first gzip header found in [start, end[
+
+    Only the header is checked (magic number, reserved flags, XFL and OS
+    fields). Returns None if no header is found.
+    """
+    offset = start
+    fin.seek(offset)
+    while offset < end:
+        data = fin.read(block_size + 9)
+        if len(data) < 10:
+            return None
+        i = data.find(_GZIP_MAGIC)
+        while i != -1 and i + 10 <= len(data) and offset + i < end:
+            flg, xfl, os_ = data[i+3], data[i+8], data[i+9]
+            if flg & 0xE0 == 0 and xfl in (0, 2, 4) and (os_ <= 13 or os_ == 255):
+                return offset + i
+            i = data.find(_GZIP_MAGIC, i + 1)
+        offset += block_size
+        fin.seek(offset)
+    return None
+
+
+def _find_bgzf_block(fin, start, end):
+    """Return offset of the first BGZF block found in [start, end[
+
+    A candidate gzip header is accepted if it has the BGZF extra field and if
+    the block size it stores points to another BGZF header (or the end of
+    the file). Returns None if no block is found.
+    """
+    fin.seek(0, 2)
+    size = fin.tell()
+    while start < end:
+        start = _find_gzip_member(fin, start, end)
+        if start is None:
+            return None
+        fin.seek(start)
+        header = fin.read(18)
+        if len(header) == 18 and header[3] & 4 and header[12:14] == b"BC":
+            bsize = header[16] + header[17] * 256
+            nextblock = start + bsize + 1
+            fin.seek(nextblock)
+            if nextblock == size or fin.read(3) == _GZIP_MAGIC:
+                return start
+        start += 1
+    return None
+
+
+def _read_bgzf_header(fin, offset):
+    # return size of the BGZF block starting at offset (None if not BGZF)
+    fin.seek(offset)
+    header = fin.read(18)
+    if len(header) == 18 and header[0:3] == _GZIP_MAGIC and header[3] & 4 \
+            and header[12:14] == b"BC":
+        return header[16] + header[17] * 256 + 1
+    return None
+
+
+def is_bgzf(filename):
+    """Return True if the file is compressed with BGZF (blocked gzip)"""
+    with open(filename, "rb") as fin:
+        return _read_bgzf_header(fin, 0) is not None
+
+
+def _get_bgzf_blocks(filename):
+    """Return offsets of the BGZF blocks in the compressed and decompressed data
+
+    Only the headers and trailers (decompressed size) of the blocks are read.
+    """
+    starts, sizes = [], []
+    with open(filename, "rb") as fin:
+        fin.seek(0, 2)
+        size = fin.tell()
+        offset = 0
+        while offset < size:
+            bsize = _read_bgzf_header(fin, offset)
+            if bsize is None:
+                raise ValueError("%s is not a BGZF file" % filename)
+            fin.seek(offset + bsize - 4)
+            starts.append(offset)
+            sizes.append(int.from_bytes(fin.read(4), "little"))
+            offset += bsize
+    decompressed = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=decompressed[1:])
+    return np.array(starts, dtype=np.int64), decompressed
+
+
+def _count_gzip_members(filename, start, end, block_size=1024*1024):
+    """Count newlines in consecutive gzip members starting at *start*
+
+    Members are decompressed until the end of a member is found at or after
+    the offset *end*.
+
+    :return: tuple with offset of the end of the last member decompressed,
+        number of newlines, and last decompressed character.
+    """
+    count = 0
+    last = b"\n"
+    with open(filename, "rb") as fin:
+        fin.seek(start)
+        # offset in the file of the first byte of data
+        offset = start
+        data = fin.read(block_size)
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while data:
+            outstr = d.decompress(data)
+            if outstr:
+                count += outstr.count(b"\n")
+                last = outstr[-1:]
+            if d.eof:
+                stop = offset + len(data) - len(d.unused_data)
+                if stop >= end:
+                    return stop, count, last
+                # new member
+                data = d.unused_data or fin.read(block_size)
+                offset = stop
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                if not data:
+                    return stop, count, last
+            else:
+                offset += len(data)
+                data = fin.read(block_size)
+    raise ValueError("%s seems to be truncated" % filename)
+
+
+def _count_gzip_members_job(args):
+    # returns None if the candidate offset is not the start of a valid member
+    filename, start, end = args
+    try:
+        return (start,) + _count_gzip_members(filename, start, end)
+    except (zlib.error, ValueError):
+        return None
+
+
+def _count_lines_gz(filename, jobs=1):
+    # figure out where to split the file. Multi-member files (e.g., BGZF) can
+    # be decompressed in parallel starting at each member. This is not the
+    # case for standard gzip files, in which case a unique job is used.
+    size = os.path.getsize(filename)
+    starts = [0]
+    if jobs > 1:
+        with open(filename, "rb") as fin:
+            for k in range(1, jobs):
+                start = _find_gzip_member(fin, size * k // jobs,
+                    size * (k+1) // jobs)
+                if start is not None and start > starts[-1]:
+                    starts.append(start)
+
+    results = {}
+    if len(starts) > 1:
+        import multiprocessing
+        ends = starts[1:] + [size]
+        with multiprocessing.Pool(min(jobs, len(starts))) as pool:
+            for res in pool.imap_unordered(_count_gzip_members_job,
+                    [(filename, x, y) for x, y in zip(starts, ends)]):
+                if res is not None:
+                    results[res[0]] = res[1:]
+
+    # gather the results. Jobs that started at the end of the member decoded by
+    # the previous job are kept. Missing parts are decompressed here.
+    pos, count, last = 0, 0, b"\n"
+    while pos < size:
+        if pos in results:
+            stop, this_count, last = results[pos]
+        else:
+            nextpos = min([x for x in results if x > pos] + [size])
+            stop, this_count, last = _count_gzip_members(filename, pos, nextpos)
+        count += this_count
+        pos = stop
+    # last line has no carriage return
+    if last != b"\n":
+        count += 1
+    return count
+
+
+def _count_lines_buf(filename, block_size=1024*1024):
+    count = 0
+    last = b"\n"
+    with open(filename, 'rb') as fin:
+        buf = fin.read(block_size)
+        while buf:
+            count += buf.count(b'\n')
+            last = buf[-1:]
+            buf = fin.read(block_size)
+    if last != b"\n":
+        count += 1
+    return count
+
+
+def _get_counts_cache():
+    # counts are small entries: the size limit keeps about 20,000 files
+    from sequana import sequana_config_path
+    from sequana.cache import StatsCache
+    return StatsCache(sequana_config_path + os.sep + "line_counts",
+        max_size=10000000)
+
+
+def count_lines(filename, jobs=1, cache=False):
+    """Count the number of lines in a file (gzipped or not)
+
+    :param str filename: the input file. Files ending in .gz are decompressed
+        on the fly.
+    :param int jobs: number of processes used to decompress gzipped files.
+        Parallelism is only possible for multi-member gzip files such as
+        BGZF (bgzip) files or concatenated gzip files. Standard gzip files are
+        processed with a single process.
+    :param bool cache: if True, the count is stored in the sequana
+        configuration directory (see :class:`sequana.cache.StatsCache`). The
+        entry is keyed by the absolute path, size and modification time of
+        the file so that further calls on the same (unchanged) file return
+        immediately.
+
+    Newlines are counted on large blocks of binary data (decompressed if
+    needed) using :meth:`bytes.count`. The last line is counted even if it
+    does not end with a carriage return.
+
+    """
+    if cache:
+        cache = _get_counts_cache()
+        data = cache.get(filename, "line_count")
+        if data is not None:
+            return int(data["count"])
+
+    if filename.endswith(".gz"):
+        count = _count_lines_gz(filename, jobs=jobs)
+    else:
+        count = _count_lines_buf(filename)
+
+    if cache:
+        cache.set(filename, "line_count", {"count": count})
+    return count
+
+
+def open_writer(filename, buffer_size=4*1024*1024, compresslevel=6):
+    """Open an output file for writing bytes through a large buffer
+
+    :param str filename: output file. If the extension is .gz, data is
+        compressed.
+    :param int buffer_size: size of the buffer (bytes)
+    :param int compresslevel: gzip compression level. The default (6) is
+        faster than the gzip default (9) for a similar compression ratio.
+
+    ::
+
+        with open_writer("output.fastq.gz") as fout:
+            fout.write(b"@read1\nACGT\n+\nIIII\n")
+
+    """
+    if filename.endswith(".gz"):
+        fileobj = gzip.open(filename, "wb", compresslevel=compresslevel)
+    else:
+        fileobj = open(filename, "wb", buffering=0)
+    return io.BufferedWriter(fileobj, buffer_size=buffer_size)
+
+
+def _gzip_compress(data, compresslevel=6):
+    # compress data as a complete gzip member
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+        16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ThreadedWriter(object):
+    """Write (and compress) data in a background thread
+
+    Data written by the caller is put in a bounded queue and written to the
+    output file by a dedicated thread. Compression with zlib releases the
+    GIL so several writers compress their data concurrently while the main
+    thread parses the input::
+
+        writer = ThreadedWriter("output.fastq.gz")
+        writer.write(b"@read1\nACGT\n+\nIIII\n")
+        writer.close()
+
+    :param str filename: output file. Compressed with gzip if the extension
+        is .gz.
+    :param int compresslevel: gzip compression level
+    :param bool bgzf: compress as BGZF (blocked gzip) instead of plain gzip.
+        BGZF files can be indexed and processed in parallel (see e.g.
+        :func:`count_lines`).
+    :param int maxsize: maximum number of pending chunks of data
+    :param executor: a :class:`concurrent.futures.ThreadPoolExecutor`. If
+        provided, chunks of data are compressed concurrently by the pool as
+        independent gzip members (concatenated gzip members are a valid gzip
+        file). Can be shared by several writers.
+    """
+    def __init__(self, filename, compresslevel=6, bgzf=False, maxsize=16,
+            executor=None):
+        import queue
+        import threading
+        self.filename = filename
+        self.compresslevel = compresslevel
+        self.bgzf = bgzf
+        self.executor = executor
+        if bgzf or not filename.endswith(".gz"):
+            self.executor = None
+        self._error = None
+        self.closed = False
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        compressor = None
+        try:
+            if self.bgzf:
+                import pysam
+                fout = pysam.BGZFile(self.filename, "wb")
+            else:
+                fout = open(self.filename, "wb")
+                if self.filename.endswith(".gz") and not self.executor:
+                    compressor = zlib.compressobj(self.compresslevel,
+                        zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            with fout:
+                data = self._queue.get()
+                while data is not None:
+                    if self.executor:
+                        data = data.result()
+                    elif compressor:
+                        data = compressor.compress(data)
+                    fout.write(data)
+                    data = self._queue.get()
+                if compressor:
+                    fout.write(compressor.flush())
+        except Exception as err:
+            self._error = err
+            # consume remaining data so that the caller is never blocked
+            while self._queue.get() is not None:
+                pass
+
+    def write(self, data):
+        """Add data (bytes) to the queue of data to be written"""
+        if self._error:
+            raise self._error
+        if data and self.executor:
+            self._queue.put(self.executor.submit(_gzip_compress, data,
+                self.compresslevel))
+        elif data:
+            self._queue.put(data)
+
+    def close(self, wait=True):
+        """Close the output file once all pending data is written
+
+        :param bool wait: if False, returns immediately. Use :meth:`join`
+            later to wait for the end of the writing.
+        """
+        if not self.closed:
+            self._queue.put(None)
+            self.closed = True
+        if wait:
+            self.join()
+
+    def join(self):
+        """Wait for the end of the writing (see :meth:`close`)"""
+        self._thread.join()
+        if self._error:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class ReservoirSampler(object):
+    """Select N items uniformly at random from a stream in a single pass
+
+    This is the Algorithm L of Li (1994): once the reservoir is full, the
+    number of items to skip before the next replacement is drawn directly so
+    that only the selected items are visited. Items are provided by chunks of
+    consecutive items (e.g. batches of reads)::
+
+        sampler = ReservoirSampler(10, seed=1)
+        for chunk in chunks:
+            sampler.update(chunk)
+        sampler.indices         # sorted indices of the selected items
+        sampler.items           # selected items (in the stream order)
+
+    """
+    def __init__(self, N, seed=None):
+        """.. rubric:: constructor
+
+        :param int N: number of items to select
+        :param seed: seed of the random generator
+        """
+        self.N = int(N)
+        self.random = np.random.RandomState(seed)
+        self.count = 0
+        self._reservoir = []
+        self._W = np.exp(np.log(self._uniform()) / max(self.N, 1))
+        self._next = self.N + self._skip()
+
+    def _uniform(self):
+        # uniform in (0, 1) excluding 0
+        return 1. - self.random.random_sample()
+
+    def _skip(self):
+        return int(np.floor(np.log(self._uniform()) / np.log1p(-self._W)))
+
+    def update(self, items):
+        """Process the next items of the stream
+
+        :param items: a sequence supporting len() and indexing
+        """
+        start, end = self.count, self.count + len(items)
+        # fill the reservoir with the first N items
+        while len(self._reservoir) < self.N and self.count < end:
+            self._reservoir.append((self.count, items[self.count - start]))
+            self.count += 1
+        while self.N and self._next < end:
+            position = self.random.randint(self.N)
+            self._reservoir[position] = (self._next, items[self._next - start])
+            self._W *= np.exp(np.log(self._uniform()) / self.N)
+            self._next += self._skip() + 1
+        self.count = end
+
+    def _get_sorted(self):
+        return sorted(self._reservoir, key=lambda x: x[0])
+
+    def _get_indices(self):
+        return [x[0] for x in self._get_sorted()]
+    indices = property(_get_indices, doc="sorted indices of selected items")
+
+    def _get_items(self):
+        return [x[1] for x in self._get_sorted()]
+    items = property(_get_items, doc="selected items (in the stream order)")
+
+
 class GZLineCounter(object):
     """Fast GZipped line counter
 
-    Uses zcat if possible, otherwise gzip library (twice as slow).
+    Decompress the file by blocks and count the newlines in each block.
+    Multi-member files (e.g. BGZF) can be decompressed on several cores.
+    See :func:`count_lines` for details.
 
     .. doctest::
 
         >>> from sequana import sequana_data
-        >>> from sequana.misc import GZLineCounter
+        >>> from sequana.tools import GZLineCounter
         >>> gz = GZLineCounter(sequana_data("test.fastq.gz"))
         >>> len(gz)
-        100
+        1000
 
     """
-    def __init__(self, filename):
+    def __init__(self, filename, jobs=1, cache=False):
         self.filename = filename
-        if cmd_exists("zcat"):
-            self.use_zcat = True
-        else:
-            self.use_zcat = False
+        self.jobs = jobs
+        self.cache = cache
 
     def __len__(self):
-        if self.use_zcat:
-            return self._use_zcat()
-        else:
-            return self._use_gzip()
-
-    def _use_zcat(self):
-        i = 0
-        p = subprocess.Popen(["zcat", self.filename], stdout=subprocess.PIPE)
-        for line in p.stdout:
-            i +=1
-        return i
-
-    """twice as fast as the other method below but large memory print
-    def _use_gzip(self):
-        with gzip.open(self.filename) as gz_file:
-            data = gz_file.read()
-        return len(data.splitlines())
-    """
-    def _use_gzip(self):
-        i = 0
-        with gzip.open(self.filename) as gz_file:
-            with io.BufferedReader(gz_file) as f:
-                for line in f:
-                    i += 1
-        return i
+        return count_lines(self.filename, jobs=self.jobs, cache=self.cache)
+
 
+def _isin(names, table):
+    # boolean array: names found in the keys of a dictionary
+    return np.fromiter((name in table for name in names), dtype=bool,
+        count=len(names))
 
 
 class PairedFastQ(object):
+    """Check and repair the synchronisation of paired FastQ files
+
+    Reads of R1 and R2 files must be in the same order. This is not the
+    case anymore if the files were trimmed independently or truncated::
 
+        from sequana.tools import PairedFastQ
+        pfq = PairedFastQ("test_R1_.fastq.gz", "test_R2_.fastq.gz")
+        pfq.is_synchronised()
+        report = pfq.check()
+        pfq.repair("fixed_R1_.fastq.gz", "fixed_R2_.fastq.gz",
+            singletons="singletons.fastq.gz")
+
+    Files are read by batches (see :class:`sequana.fastq.FastQBlockReader`)
+    and the read names (without comments and /1, /2 suffixes) are compared
+    in bulk.
+    """
     def __init__(self, fq1, fq2):
         self.fq1 = fq1
         self.fq2 = fq2
 
+    def _get_names(self, batch):
+        from sequana.fastq import _get_read_name
+        return np.array([_get_read_name(x) for x in batch.identifiers],
+            dtype=object)
+
+    def _get_batches(self):
+        from sequana.fastq import FastQBlockReader, _zip_batches
+        return _zip_batches(FastQBlockReader(self.fq1),
+            FastQBlockReader(self.fq2), strict=False)
+
+    def check(self):
+        """Compare the read names of the two files
+
+        :return: a dictionary with the number of reads in each file
+            (*n_reads1*, *n_reads2*), the number of pairs with same names
+            (*n_pairs*), the number of pairs with different names
+            (*n_mismatches*) and the position and names of the first pair
+            that is not synchronised (*first_desync*, *first_desync_names*;
+            None if the files are synchronised).
+        """
+        report = {"n_reads1": 0, "n_reads2": 0, "n_pairs": 0,
+                  "n_mismatches": 0, "first_desync": None,
+                  "first_desync_names": None}
+        for batch1, batch2 in self._get_batches():
+            if batch1 is None or batch2 is None:
+                # one file is longer than the other
+                if report["first_desync"] is None:
+                    report["first_desync"] = report["n_reads1"] if batch2 \
+                        is None else report["n_reads2"]
+                key = "n_reads1" if batch2 is None else "n_reads2"
+                report[key] += len(batch1 if batch2 is None else batch2)
+                continue
+            names1 = self._get_names(batch1)
+            names2 = self._get_names(batch2)
+            mismatches = np.flatnonzero(names1 != names2)
+            if len(mismatches) and report["first_desync"] is None:
+                i = mismatches[0]
+                report["first_desync"] = report["n_reads1"] + int(i)
+                report["first_desync_names"] = (batch1.identifiers[i],
+                    batch2.identifiers[i])
+            report["n_mismatches"] += len(mismatches)
+            report["n_pairs"] += len(batch1) - len(mismatches)
+            report["n_reads1"] += len(batch1)
+            report["n_reads2"] += len(batch2)
+        return report
+
     def is_synchronised(self):
-        from sequana import FastQ
-        N = 0
-        for a, b in zip(FastQ(self.fq1), FastQ(self.fq2)):
-            a = a['identifier'].decode()
-            b = b['identifier'].decode()
-            a = a.split()[0]
-            b = b.split()[0]
-
-            if a.endswith("/1"):
-                id1 = a.rsplit("/1")[0]
-            elif a.endswith("/2"):
-                id1 = a.rsplit("/2")[0]
-            else:
-                id1 = a
-            if b.endswith("/1"):
-                id2 = b.rsplit("/1")[0]
-            elif b.endswith("/2"):
-                id2 = b.rsplit("/2")[0]
-            else:
-                id2 = b
-
-            if id1 != id2:
-                print("%s differs from %s" % (id1, id2))
-                print(a)
-                print(b)
-                return False
-            N += 1
-        print(N)
+        """Return True if reads of the two files are in the same order"""
+        report = self.check()
+        if report["first_desync"] is not None:
+            logger.warning("Files are not synchronised. First difference at "
+                "read %s: %s" % (report["first_desync"],
+                report["first_desync_names"]))
+            return False
         return True
+
+    def repair(self, output1, output2, singletons=None, window=1000000):
+        """Write the synchronised pairs (and the singletons)
+
+        :param str output1: output file for R1 reads (compressed if the
+            extension is .gz)
+        :param str output2: output file for R2 reads
+        :param str singletons: output file for reads without mate (None to
+            discard them)
+        :param int window: maximum number of reads waiting for their mate
+            (per file). When the limit is reached, the oldest reads are
+            considered as singletons. This bounds the memory used.
+        :return: a dictionary with the number of pairs and singletons
+            written, and the number of duplicated names in each file
+
+        Mates found in the same batches are paired in bulk, in any order.
+        The other reads are compared to the reads waiting for their mate.
+        Reads without mate found within the window are written as
+        singletons. A read whose name was already seen in the same file (and
+        is still waiting for its mate) is a duplicate: it is written as a
+        singleton. Pairs are written in the order they are found.
+        """
+        outputs = [ThreadedWriter(output1), ThreadedWriter(output2)]
+        if singletons:
+            outputs.append(ThreadedWriter(singletons))
+        report = {"n_pairs": 0, "n_singletons1": 0, "n_singletons2": 0,
+                  "n_duplicates1": 0, "n_duplicates2": 0}
+        # reads waiting for their mate (name -> record), oldest first
+        pending = [OrderedDict(), OrderedDict()]
+
+        def add_singletons(i, data, count):
+            report["n_singletons%s" % (i + 1)] += count
+            if singletons:
+                outputs[2].write(data)
+
+        try:
+            for batches in self._get_batches():
+                names = [np.array([], dtype=object) if x is None else
+                         self._get_names(x) for x in batches]
+
+                # first read of each name not already waiting in the file
+                indices = []
+                for i in (0, 1):
+                    unique = np.zeros(len(names[i]), dtype=bool)
+                    unique[np.unique(names[i], return_index=True)[1]] = True
+                    unique &= ~_isin(names[i], pending[i])
+                    duplicates = np.flatnonzero(~unique)
+                    if len(duplicates):
+                        report["n_duplicates%s" % (i + 1)] += len(duplicates)
+                        add_singletons(i, batches[i].to_fastq(duplicates),
+                            len(duplicates))
+                    indices.append(np.flatnonzero(unique))
+
+                # mates in the same batches
+                _, first, second = np.intersect1d(names[0][indices[0]],
+                    names[1][indices[1]], assume_unique=True,
+                    return_indices=True)
+                order = np.argsort(indices[0][first])
+                pairs = [indices[0][first][order], indices[1][second][order]]
+
+                # other reads: mates read previously or waiting for them
+                data = [[], []]
+                for i in (0, 1):
+                    rest = np.setdiff1d(indices[i], pairs[i],
+                        assume_unique=True)
+                    found = _isin(names[i][rest], pending[1 - i])
+                    for j in rest[found]:
+                        data[i].append(batches[i].to_fastq([j]))
+                        data[1 - i].append(pending[1 - i].pop(names[i][j]))
+                    for j in rest[~found]:
+                        pending[i][names[i][j]] = batches[i].to_fastq([j])
+                report["n_pairs"] += len(pairs[0]) + len(data[0])
+                for i in (0, 1):
+                    if len(pairs[i]):
+                        data[i].append(batches[i].to_fastq(pairs[i]))
+                    outputs[i].write(b"".join(data[i]))
+                    while len(pending[i]) > window:
+                        add_singletons(i, pending[i].popitem(last=False)[1], 1)
+            for i in (0, 1):
+                add_singletons(i, b"".join(pending[i].values()),
+                    len(pending[i]))
+        finally:
+            for output in outputs:
+                output.close()
+        return report
@@ -21,6 +21,11 @@ def test_input():
         bam_splitter.main([prog, '--input', filename,
             "--output-directory" , tmpdir, "--keep-unmapped", "--prefix", "test"])
 
+    with TemporaryDirectory() as tmpdir:
+        bam_splitter.main([prog, '--input', filename, "--output-directory",
+            tmpdir, "--keep-unmapped", "--compress", "--threads", "2"])
+        assert os.path.exists(tmpdir + "/test.unmapped.fastq.gz")
+
     try: bam_splitter.main([prog, '--help'])
     except:pass
     try: bam_splitter.main([prog])
@@ -336,3 +336,46 @@ def test_all_adapters():
 
 
 
+
+
+def test_adapter_index(tmpdir):
+    from sequana.adapters import AdapterIndex, AdapterContent, AdapterReader
+    filename = sequana_data("adapters_Nextera_fwd.fa")
+    ar = AdapterReader(filename)
+    index = AdapterIndex(filename)
+    assert len(index) == len(ar)
+    # same results as a linear search (short and long subsequences)
+    for subsequence in ["GTAAGGAG", "TCGTCGGCAGCGTC", "ACACGTAAGGAGTCGTCGGCAG",
+            "TTTTTTTTTTTTTTTTTTTT"]:
+        expected = [i for i, x in enumerate(ar.sequences) if subsequence in x]
+        assert index.get_adapters(subsequence) == expected
+    assert len(ar.get_adapter_by_sequence("TCGTCGGCAGCGTC")) == 28
+
+    # reads with the transposase sequence at position 10
+    fastq = str(tmpdir.join("test.fastq"))
+    with open(fastq, "w") as fout:
+        for i in range(10):
+            sequence = "ACGTACGTAC" + "CTGTCTCTTATACACATCT" if i < 5 else "A" * 29
+            fout.write("@read%s\n%s\n+\n%s\n" % (i, sequence, "I" * 29))
+    content = adapters.scan_adapters(fastq, ["Nextera"])
+    assert content.n_reads == 10
+    assert content.n_reads_with_adapters == 5
+    df = content.get_adapters()
+    assert set(df.identifier) == {
+        "Nextera_transposase_seq_1|name:transposase_seq_1",
+        "Nextera_transposase_seq_2|name:transposase_seq_2"}
+    assert (df.reads == 5).all()
+    assert content.get_adapter_content()[9] == 0
+    assert content.get_adapter_content()[10] == 50
+
+    # same results by batches with a prebuilt index; merge sums the counts
+    from sequana.fastq import FastQBlockReader
+    other = AdapterContent(AdapterIndex(["Nextera"]))
+    for batch in FastQBlockReader(fastq, block_size=100):
+        other.update(batch)
+    assert (other.adapter_counts == content.adapter_counts).all()
+    content.merge(other)
+    assert content.n_reads == 20
+    assert content.n_reads_with_adapters == 10
+    assert content.get_adapter_content()[10] == 50
+    content.plot_adapter_content()
@@ -98,6 +98,18 @@ def test_bam_others():
     b.plot_coverage()
     b.boxplot_qualities()
     b.plot_indel_dist()
+    # depth of all alignments up to the largest end
+    assert len(b.coverage) == 15875
+
+    # one row per alignment, in the order of the file
+    import pysam
+    alignments = list(pysam.AlignmentFile(sequana_data("measles.fa.sorted.bam")))
+    df = b.get_flags_as_df()
+    assert (df[16].values == [x.is_reverse for x in alignments]).all()
+    assert (df.sum() == b.get_flags_count()).all()
+    assert b.get_mapq_as_df().mapq.tolist() == [x.mapping_quality for x in alignments]
+    assert b.get_mapped_read_length() == [x.reference_length for x in alignments
+        if not x.is_unmapped]
 
 
 def test_alignment():
@@ -127,7 +139,7 @@ def test_bamreport(tmpdir):
 
 def test_cs():
     from sequana.bamtools import CS
-    assert  CS('-a:6-g:14+g:2+c:9*ac:10-a:13-a') ==  {'D': 3, 'I': 2, 'M': 54, 'S': 1}
+    assert  CS('-a:6-g:14+g:2+c:9*ac:10-a:13-a') ==  {'D': 4, 'I': 2, 'M': 54, 'S': 1}
 
 
 def test_cs_in_bam():
@@ -139,7 +151,230 @@ def test_cs_in_bam():
          'read_length': {1772: 1, 10779: 1, 13726: 1, 20480: 1}}
     df = b.get_df_concordance()
     import math
-    assert math.floor(df.sum().sum()) == 103769  # exact is 103769.5600734975
+    assert math.floor(df.sum().sum()) == 103813  # exact is 103813.56057974519
+
+
+
+
+
+def test_collect():
+    b = BAM(sequana_data("measles.fa.sorted.bam"))
+    results = b.collect()
+    assert results["count"].count == 2998
+    assert results["flags"].counts.sum() == 2998
+    assert results["read_length"].counts.sum() == 2623
+    assert results["flags"].get_samflags_count()[4] == 375
+    assert b.get_samflags_count()[4] == 375
+    depth = results["coverage"].get_depth(0)
+    assert len(depth) == 15894
+    assert depth.sum() == results["read_length"].get_values().sum()
+    assert results["indels"].insertions.sum() == 11
+
+    # results are cached and metrics can be merged
+    assert b.collect(["flags"])["flags"] is results["flags"]
+    other = BAM(sequana_data("measles.fa.sorted.bam")).collect(["mapq", "gc"])
+    mapq = other["mapq"].merge(results["mapq"])
+    assert mapq.counts.sum() == 2 * 2998
+    assert abs(other["gc"].mean - 47.28) < 0.01
 
+    try:
+        b.collect(["dummy"])
+        assert False
+    except ValueError:
+        assert True
 
 
+def test_run_on_regions(tmpdir):
+    import shutil
+    import pysam
+    from sequana.bamtools import get_bam_regions, run_on_regions
+    filename = str(tmpdir.join("measles.bam"))
+    shutil.copy(sequana_data("measles.fa.sorted.bam"), filename)
+    pysam.index(filename)
+
+    regions = get_bam_regions(filename, region_size=5000)
+    assert len(regions) == 5
+    assert regions[-1] == ("*", None, None)
+
+    def count(alignments):
+        return sum(1 for x in alignments)
+    assert run_on_regions(filename, count, regions=regions,
+        merge=lambda x, y: x + y) == 2998
+
+    ref = BAM(sequana_data("measles.fa.sorted.bam")).collect()
+    results = BAM(filename).collect(jobs=2, region_size=1000)
+    assert results["count"].count == 2998
+    for name in ("flags", "mapq", "read_length", "gc"):
+        assert (results[name].counts == ref[name].counts).all()
+    assert (results["coverage"].get_depth(0) == ref["coverage"].get_depth(0)).all()
+    # mates processed in different regions are paired when merging
+    assert (results["insert_size"].get_counts() ==
+        ref["insert_size"].get_counts()).all()
+
+    # rows of the regions are concatenated in the order of the file
+    df = BAM(filename).get_df_concordance(jobs=2, region_size=1000)
+    assert df.equals(BAM(filename).get_df_concordance())
+
+
+def test_read_counts(tmpdir, monkeypatch):
+    import shutil
+    import pysam
+    filename = str(tmpdir.join("measles.bam"))
+    shutil.copy(sequana_data("measles.fa.sorted.bam"), filename)
+    expected = BAM(filename).get_read_counts()
+    assert expected["total"] == 2998
+    assert expected["mapped"] + expected["unmapped"] == 2998
+
+    # counts from the statistics stored in the cache
+    cache = str(tmpdir.join("cache"))
+    b = BAM(filename, cache=cache)
+    assert b.get_read_counts() == expected
+    from sequana import bamtools
+    from sequana.cache import StatsCache
+    collect_job = bamtools._collect_job
+    def scan(*args, **kwargs):
+        raise AssertionError("the file should not be read")
+    monkeypatch.setattr(bamtools, "_collect_job", scan)
+    assert len(BAM(filename, cache=cache)) == 2998
+    # invalidating the cache invalidates the counts
+    StatsCache(cache).invalidate(filename)
+    with pytest.raises(AssertionError):
+        len(BAM(filename, cache=cache))
+    monkeypatch.setattr(bamtools, "_collect_job", collect_job)
+
+    # from the index (the file is not read)
+    pysam.index(filename)
+    b = BAM(filename)
+    assert b.get_read_counts() == expected
+    assert len(b) == 2998
+    assert b._collected == {}
+
+
+def test_collect_cache(tmpdir, monkeypatch):
+    import shutil
+    from sequana import bamtools
+    filename = str(tmpdir.join("measles.bam"))
+    shutil.copy(sequana_data("measles.fa.sorted.bam"), filename)
+    ref = BAM(filename).collect()
+    BAM(filename, cache=True).collect()
+
+    # the file is not read anymore
+    def scan(*args, **kwargs):
+        raise AssertionError("the file should not be read")
+    monkeypatch.setattr(bamtools, "_collect_job", scan)
+    b = BAM(filename, cache=True)
+    results = b.collect()
+    assert len(b) == 2998
+    for name in ("flags", "mapq", "read_length", "gc"):
+        assert (results[name].counts == ref[name].counts).all()
+    assert (results["coverage"].get_depth(0) == ref["coverage"].get_depth(0)).all()
+    assert results["indels"].get_positions(0).equals(ref["indels"].get_positions(0))
+
+    # metrics with other parameters are computed
+    from sequana.bamtools import CoverageMetric
+    with pytest.raises(AssertionError):
+        b.collect([CoverageMetric(min_mapq=30)])
+
+
+def test_coverage_metric(tmpdir):
+    from sequana.bamtools import CoverageMetric
+    from sequana import GenomeCov
+    b = BAM(sequana_data("measles.fa.sorted.bam"))
+    coverage = b.collect(["coverage"])["coverage"]
+    name = "ENA|K01711|K01711.1"
+    depth = coverage.get_depth(name)
+    assert (depth == coverage.get_depth(0)).all()
+    assert list(coverage.get_depth_as_dict()) == [name]
+    assert coverage.get_stats().loc[name, "length"] == 15894
+
+    # filters
+    filtered = b.collect([CoverageMetric(min_mapq=100)])["coverage"]
+    assert filtered.get_depth(0).sum() == 0
+    filtered = b.collect([CoverageMetric(exclude_flags=16)])["coverage"]
+    assert 0 < filtered.get_depth(0).sum() < depth.sum()
+
+    # merge of partial results
+    coverage2 = CoverageMetric()
+    coverage2.set_header(coverage.references, coverage.lengths)
+    coverage2.merge(coverage).merge(coverage)
+    assert (coverage2.get_depth(0) == 2 * depth).all()
+
+    # BED file that can be read by GenomeCov
+    filename = str(tmpdir.join("measles.bed"))
+    coverage.to_bed(filename)
+    gc = GenomeCov(filename)
+    assert (gc[0].df["cov"].values == depth).all()
+
+
+def test_indel_metric():
+    from sequana.bamtools import IndelMetric
+    b = BAM(sequana_data("test_CS_tiny.bam"))
+    indels = b.collect(["indels"])["indels"]
+    assert indels.insertions.sum() == 1819
+    assert indels.deletions.sum() == 1485
+    stats = indels.get_stats()
+    assert stats.loc["tig00000001", "insertions"] == 1819
+    assert indels.get_positions("tig00000001").deletions.sum() == 1485
+
+    # long indels are counted in the overflow bin
+    small = b.collect([IndelMetric(max_length=2, bin_size=100)])["indels"]
+    assert len(small.insertions) == 3
+    assert small.insertions.sum() == 1819
+    assert small.insertions[2] == indels.insertions[2:].sum()
+
+    # merge
+    other = BAM(sequana_data("test_CS_tiny.bam")).collect(["indels"])["indels"]
+    indels.merge(other)
+    assert indels.deletions.sum() == 2 * 1485
+    try:
+        indels.merge(small)
+        assert False
+    except ValueError:
+        assert True
+
+
+def test_insert_size_metric(tmpdir):
+    import pysam
+    from sequana.bamtools import InsertSizeMetric
+    b = BAM(sequana_data("measles.fa.sorted.bam"))
+    insert_size = b.get_insert_sizes()
+    counts = insert_size.get_counts()
+    assert counts.sum() == 1308
+    stats = insert_size.get_stats()
+    assert stats.loc["all", "pairs"] == 1308
+    assert stats.loc["all", "median"] == 374
+
+    # same results on a file sorted by names
+    filename = str(tmpdir.join("measles.bam"))
+    pysam.sort("-n", "-o", filename, sequana_data("measles.fa.sorted.bam"))
+    assert (BAM(filename).get_insert_sizes().get_counts() == counts).all()
+
+    # large inserts are counted in the overflow bin
+    overflow = b.collect([InsertSizeMetric(max_size=300)])["insert_size"]
+    assert overflow.get_counts()[300] == counts[300:].sum()
+    assert b.get_insert_sizes(group_by="read_group").get_counts("1").sum() == 1308
+
+    # the TLEN is used for mates whose mate was not seen
+    small = b.get_insert_sizes(max_pending=0)
+    assert small.get_counts().sum() == 1308
+
+    # unsorted file with bounded tables
+    import random
+    alignments = list(pysam.AlignmentFile(sequana_data("measles.fa.sorted.bam")))
+    random.Random(1).shuffle(alignments)
+    filename = str(tmpdir.join("shuffled.bam"))
+    template = pysam.AlignmentFile(sequana_data("measles.fa.sorted.bam"))
+    with pysam.AlignmentFile(filename, "wb", template=template) as fout:
+        for alignment in alignments:
+            fout.write(alignment)
+    b = BAM(filename)
+    assert (b.get_insert_sizes().get_counts() == counts).all()
+    metric = InsertSizeMetric(max_pending=10, max_unpaired=10)
+    small = b.collect([metric], chunksize=100)["insert_size"]
+    assert len(small._pairing.pending) <= 10
+    assert len(small._pairing.unpaired) <= 10
+    assert small.get_counts().sum() == 1308
+    with pytest.raises(ValueError):
+        overflow.merge(insert_size)
+    with pytest.raises(ValueError):
+        InsertSizeMetric(group_by="sample")
@@ -0,0 +1,66 @@
+from sequana.cache import StatsCache, get_cache
+from sequana import sequana_data
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+
+def test_stats_cache(tmpdir):
+    filename = str(tmpdir.join("test.bam"))
+    shutil.copy(sequana_data("test.bam"), filename)
+
+    # entries next to the input file
+    cache = StatsCache()
+    assert cache.get(filename, "mapq") is None
+    cache.set(filename, "mapq", {"counts": np.arange(10)}, params={"min": 0})
+    assert os.path.isdir(filename + ".sequana_cache")
+    assert cache.get(filename, "mapq") is None
+    data = cache.get(filename, "mapq", params={"min": 0})
+    assert (data["counts"] == np.arange(10)).all()
+
+    # explicit invalidation
+    cache.invalidate(filename, "map")
+    assert cache.get(filename, "mapq", params={"min": 0}) is not None
+    cache.invalidate(filename, "mapq")
+    assert cache.get(filename, "mapq", params={"min": 0}) is None
+
+    # entries are ignored if the file changed
+    cache.set(filename, "mapq", {"counts": np.arange(10)})
+    os.utime(filename, (0, 0))
+    assert cache.get(filename, "mapq") is None
+
+    # dataframes
+    df = pd.DataFrame({"name": ["a", "b"], "value": [1, 2],
+                       "missing": [None, 1.5]})
+    cache.set_dataframe(filename, "df", df)
+    df2 = cache.get_dataframe(filename, "df")
+    assert list(df2.columns) == ["name", "value", "missing"]
+    assert list(df2.name) == ["a", "b"]
+    assert list(df2.value) == [1, 2]
+    assert np.isnan(df2.missing[0])
+    cache.invalidate(filename)
+    assert not os.path.exists(filename + ".sequana_cache")
+
+
+def test_stats_cache_size(tmpdir):
+    filename = str(tmpdir.join("test.bam"))
+    shutil.copy(sequana_data("test.bam"), filename)
+    directory = str(tmpdir.join("cache"))
+    cache = StatsCache(directory, max_size=20000)
+    cache.set(filename, "first", {"counts": np.zeros(1000)})
+    cache.set(filename, "second", {"counts": np.zeros(1000)})
+    cache.get(filename, "first")
+    os.utime(cache._get_entry(filename, "first", None), (1e10, 1e10))
+    # the least recently used entry is removed
+    cache.set(filename, "third", {"counts": np.zeros(1000)})
+    assert cache.get(filename, "first") is not None
+    assert cache.get(filename, "second") is None
+    assert cache.get(filename, "third") is not None
+    cache.clear()
+    assert not os.path.exists(directory)
+
+    assert get_cache(None) is None
+    assert get_cache(directory).directory == directory
+    assert get_cache(cache) is cache
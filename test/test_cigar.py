@@ -26,3 +26,30 @@ def test_cigar():
     c = Cigar("1S1S1S1S")
     c.compress()
     assert c.cigarstring == "4S"
+
+
+def test_cigar_counts():
+    from sequana.cigar import get_cigar_counts, get_cs_counts
+    counts = get_cigar_counts(["10S80M5I5I1D", "2H10=", None, "100M"])
+    assert counts.shape == (4, 10)
+    assert list(counts[0]) == [80, 10, 1, 0, 10, 0, 0, 0, 0, 0]
+    assert list(counts[1]) == [0, 0, 0, 0, 0, 2, 0, 10, 0, 0]
+    assert counts[2].sum() == 0
+    assert counts[3, 0] == 100
+
+    # pysam cigartuples
+    counts = get_cigar_counts([[(4, 10), (0, 80), (1, 10)], None])
+    assert list(counts[0][0:5]) == [80, 10, 0, 0, 10]
+    assert counts[1].sum() == 0
+
+    # cs tags (columns are M, I, D, S)
+    counts = get_cs_counts([":6-g:14+g:2+c:9*ac:10-a", None, "=ACGT*ag=TT+aa:3"])
+    assert list(counts[0]) == [41, 2, 2, 1]
+    assert counts[1].sum() == 0
+    assert list(counts[2]) == [9, 2, 0, 1]
+
+    # the decomposition is cached and updated if the CIGAR changes
+    c = Cigar("1S1S10M")
+    assert c.as_dict() == {"S": 2, "M": 10}
+    c.compress()
+    assert c.as_tuple() == (("S", 2), ("M", 10))
@@ -0,0 +1,76 @@
+import json
+import os
+
+from sequana import sequana_data
+from sequana.demultiplex import BarcodeMatcher, Demultiplexer
+from sequana.demultiplex import UNDETERMINED, AMBIGUOUS
+from sequana.fastq import FastQ
+
+import pytest
+
+
+def _create_fastq(filename, barcodes):
+    with open(filename, "w") as fout:
+        for i, barcode in enumerate(barcodes):
+            fout.write("@read%s 1:N:0:%s\nACGTACGT\n+\nIIIIIIII\n" % (i, barcode))
+
+
+def test_barcode_matcher():
+    matcher = BarcodeMatcher(["ACGTAC", "TTGGCC"], mismatches=1)
+    found, mismatches = matcher.lookup([b"ACGTAC", b"ACGTAN", b"TTGGCCAA",
+        b"GGGGGG"])
+    assert list(found) == [0, 0, 1, UNDETERMINED]
+    assert list(mismatches) == [0, 1, 0, 0]
+
+    # AAAA and AATT are both at 1 mismatch from AAAT
+    matcher = BarcodeMatcher(["AAAA", "AATT"], mismatches=1)
+    assert len(matcher.collisions) == 2
+    found, _ = matcher.lookup([b"AAAT", b"AAAA"])
+    assert list(found) == [AMBIGUOUS, 0]
+
+    with pytest.raises(ValueError):
+        BarcodeMatcher(["AAAA", "AAA"])
+
+
+def test_demultiplex(tmpdir):
+    filename = str(tmpdir.join("input.fastq"))
+    _create_fastq(filename, ["ACGTAC", "ACGTAA", "TTGGCC", "GGGGGG"] * 10)
+
+    demux = Demultiplexer({"A": "ACGTAC", "B": "TTGGCC"})
+    outdir = str(tmpdir.join("out"))
+    stats = demux.run(filename, output_directory=outdir)
+    assert stats["samples"]["A"]["reads"] == 20
+    assert stats["samples"]["A"]["mismatch_counts"] == [10, 10]
+    assert stats["samples"]["B"]["reads"] == 10
+    assert stats["undetermined"] == 10
+    assert stats["top_undetermined"] == {"GGGGGG": 10}
+    assert len(FastQ(outdir + "/A_R1_.fastq.gz")) == 20
+    assert len(FastQ(outdir + "/Undetermined_R1_.fastq.gz")) == 10
+    with open(outdir + "/demultiplex.json") as fin:
+        assert json.load(fin)["total"] == 40
+
+    # exact matches only, paired and no undetermined file
+    demux = Demultiplexer({"A": "ACGTAC", "B": "TTGGCC"}, mismatches=0)
+    outdir = str(tmpdir.join("out2"))
+    stats = demux.run(filename, paired_filename=filename,
+        output_directory=outdir, undetermined=False)
+    assert stats["samples"]["A"]["reads"] == 10
+    assert len(FastQ(outdir + "/A_R2_.fastq.gz")) == 10
+    assert not os.path.exists(outdir + "/Undetermined_R1_.fastq.gz")
+
+
+def test_demultiplex_dual(tmpdir):
+    filename = sequana_data("test_expdesign_hiseq_doubleindex.csv", "testing")
+    with pytest.raises(ValueError):
+        Demultiplexer(filename)
+    demux = Demultiplexer(filename, lane=1)
+    assert demux.dual
+    assert len(demux.samples) == 63
+
+    fastq = str(tmpdir.join("input.fastq"))
+    _create_fastq(fastq, ["TAAGGCGA+TCTCTCCG", "TAAGGCGT+TCTCTCCG",
+        "TAAGGCGT+TCTCTCCC", "TAAGGCGA", "TAAGGCGA+GCGTAAGA"])
+    stats = demux.run(fastq, output_directory=str(tmpdir.join("out")))
+    assert stats["samples"]["AL46E4"]["reads"] == 3
+    assert stats["samples"]["AL46E4"]["mismatch_counts"] == [1, 1, 1]
+    assert stats["undetermined"] == 2
@@ -15,3 +15,63 @@ def test_format_contigs_denovo():
     contigs.names
     contigs.lengths
     contigs.comments
+
+
+def test_select_random_reads():
+    filename = sequana_data("test_fasta.fasta")
+    contigs = FastA(filename)
+    with TempFile(suffix='.fasta') as fh:
+        selection = contigs.select_random_reads(2, fh.name, seed=1)
+        assert len(selection) == 2
+        assert len(FastA(fh.name)) == 2
+        assert contigs.select_random_reads(selection, fh.name) == selection
+        contigs.select_random_reads(fraction=0.5, output_filename=fh.name)
+
+
+def test_kmer_content():
+    contigs = FastA(sequana_data("test_fasta.fasta"))
+    ts = contigs.to_kmer_content(k=3)
+    assert len(ts) <= 64
+
+
+def test_index(tmpdir):
+    filename = str(tmpdir.join("test.fasta"))
+    sequence = "ACGTN" * 30
+    with open(filename, "w") as fout:
+        fout.write(">chr1 comment\n%s\n%s\n>chr2\nACGT\n" % (sequence[0:80],
+            sequence[80:]))
+    fasta = FastA(filename)
+    assert len(fasta) == 2
+    assert os.path.exists(filename + ".fai")
+    assert fasta.names == ["chr1", "chr2"]
+    assert fasta.lengths == [150, 4]
+    assert fasta["chr1"] == sequence
+    assert fasta[1] == "ACGT"
+    assert fasta.get_sequence("chr1", 75, 85) == sequence[75:85]
+    assert "chr3" not in fasta
+
+    fasta.close()
+    assert fasta._mmap is None
+    # reopened on request
+    assert fasta[1] == "ACGT"
+    with FastA(filename) as fasta:
+        assert fasta["chr2"] == "ACGT"
+    assert fasta._mmap is None
+
+
+def test_index_uneven_lines(tmpdir):
+    # rejected by samtools: the index is built in memory
+    filename = str(tmpdir.join("uneven.fasta"))
+    with open(filename, "w") as fout:
+        fout.write(">a\nACGTACGT\nAC\nGTTT\n>b\nGGGG\n")
+    fasta = FastA(filename)
+    assert fasta.lengths == [14, 4]
+    assert fasta.sequences == ["ACGTACGTACGTTT", "GGGG"]
+    assert fasta.get_sequence("a", 6, 12) == "GTACGT"
+
+
+def test_index_package_data():
+    filename = sequana_data("test_fasta.fasta")
+    fasta = FastA(filename)
+    assert len(fasta) and not os.path.exists(filename + ".fai")
+    assert fasta[0] == next(iter(FastA(filename))).sequence
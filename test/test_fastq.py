@@ -1,7 +1,8 @@
 from sequana import fastq, sequana_data, FastQ
 from easydev import TempFile
 import os
-from numpy import mean
+import gzip
+import numpy as np
 
 datagz = sequana_data("test.fastq.gz", "testing")
 data = sequana_data("test.fastq", "testing")
@@ -43,9 +44,37 @@ def test_fastq_unzipped():
             f.select_random_reads(selection, fh.name)
 
 
-def test_split():
-    # general tests
+def test_select_random_reads():
     f = fastq.FastQ(data)
+    with TempFile(suffix=".fastq.gz") as fh, TempFile() as fh2:
+        selection = f.select_random_reads(10, fh.name, seed=1)
+        assert len(selection) == 10
+        assert len(fastq.FastQ(fh.name)) == 10
+        # same seed, same selection
+        assert f.select_random_reads(10, fh2.name, seed=1) == selection
+
+        # paired mode
+        f.select_random_reads(20, fh.name, paired_filename=data,
+            paired_output_filename=fh2.name)
+        assert fastq.FastQ(fh.name).count_reads() == 20
+        assert fastq.FastQ(fh2.name).count_reads() == 20
+
+        # fraction mode
+        selection = f.select_random_reads(fraction=0.5,
+            output_filename=fh.name, seed=1)
+        assert len(fastq.FastQ(fh.name)) == len(selection)
+
+
+def test_split(tmpdir):
+    # output files are written next to the input file
+    import shutil
+    filename = str(tmpdir.join("test.fastq"))
+    filenamegz = filename + ".gz"
+    shutil.copy(data, filename)
+    shutil.copy(datagz, filenamegz)
+
+    # general tests
+    f = fastq.FastQ(filename)
     try:
         f.split_lines(250) # not a multiple of 4
         assert False
@@ -61,13 +90,13 @@ def test_split():
     remove_files(outputs)
 
     # Now tests the zip/unzip cases
-    f = fastq.FastQ(data)
+    f = fastq.FastQ(filename)
     outputs = f.split_lines(500, gzip=False)
     remove_files(outputs)
     outputs = f.split_lines(500, gzip=True)
     remove_files(outputs)
 
-    f = fastq.FastQ(datagz)
+    f = fastq.FastQ(filenamegz)
     outputs = f.split_lines(500, gzip=False)
     remove_files(outputs)
     outputs = f.split_lines(500, gzip=True)
@@ -76,6 +105,26 @@ def test_split():
 
     f.split_lines(1000000) is None # too many
 
+
+def test_split_files(tmpdir):
+    f = fastq.FastQ(data)
+    template = str(tmpdir.join("split_{}.fastq.gz"))
+    outputs = f.split(template, N=100)
+    assert [len(fastq.FastQ(x)) for x in outputs] == [100, 100, 50]
+
+    outputs = f.split(template, nfiles=2)
+    assert [len(fastq.FastQ(x)) for x in outputs] == [125, 125]
+
+    outputs = f.split(template, nfiles=3, round_robin=True, bgzf=True)
+    assert [len(fastq.FastQ(x)) for x in outputs] == [84, 83, 83]
+
+    template2 = str(tmpdir.join("split_{}_R2.fastq"))
+    outputs = f.split(template, N=200, paired_filename=data,
+        paired_output_filename=template2)
+    assert len(outputs) == 2
+    for R1, R2 in outputs:
+        assert open(R2).read() == gzip.open(R1, "rt").read()
+
 def test_filter():
     f = fastq.FastQ(data)
     # keeps all
@@ -95,6 +144,35 @@ def test_filter():
         ff = FastQ(fh.name)
         assert len(ff) == 0
 
+def test_filter_identifiers(tmpdir):
+    from sequana.fastq import IdentifierFilter, FastQBlockReader
+    f = fastq.FastQ(data)
+    identifiers = list(next(iter(FastQBlockReader(data))).identifiers)
+
+    for method in ["set", "table"]:
+        ids = IdentifierFilter(identifiers[0:100], method=method)
+        assert ids.method == method
+        assert identifiers[0] in ids
+        assert identifiers[200] not in ids
+
+        output = str(tmpdir.join("filtered.fastq.gz"))
+        assert f.filter(ids, output_filename=output, progressbar=False) == 150
+        assert len(FastQ(output)) == 150
+
+        # keep mode and paired files
+        output2 = str(tmpdir.join("filtered_R2.fastq"))
+        f.filter(ids, output_filename=output, progressbar=False, remove=False,
+            paired_filename=data, paired_output_filename=output2)
+        assert len(FastQ(output)) == 100
+        assert len(FastQ(output2)) == 100
+
+    # identifiers from a file
+    filename = str(tmpdir.join("ids.txt"))
+    with open(filename, "wb") as fout:
+        fout.write(b"\n".join(identifiers[0:10]))
+    assert len(IdentifierFilter(filename)) == 10
+
+
 def remove_files(filenames):
     for filename in filenames:
         os.remove(filename)
@@ -141,8 +219,11 @@ def test_fastqc():
     qc = fastq.FastQC(data, dotile=True)
     qc.boxplot_quality()
     qc.histogram_gc_content()
-    GC = mean(qc.gc_list)
+    GC = np.mean(qc.gc_list)
     assert GC>0 and GC<100
+    assert len(qc.lengths) == 250 and qc.lengths.max() == qc.maximum
+    df = qc.fastqc_stats.get_quality_percentiles()
+    assert list(df.loc[1]) == [31, 31, 34, 34, 34]
     qc.imshow_qualities()
     qc.histogram_sequence_lengths()
     qc.histogram_sequence_coordinates()
@@ -155,3 +236,176 @@ def test_fastqc():
     assert stats['G'][0] == 5768
 
 
+
+
+def test_block_reader():
+    import pysam
+    from sequana.fastq import FastQBlockReader
+    for thisdata in [data, datagz]:
+        expected = [x for x in pysam.FastxFile(thisdata)]
+        # a small block size to make sure records overlapping 2 blocks are
+        # handled
+        with FastQBlockReader(thisdata, block_size=1000) as reader:
+            batches = list(reader)
+        assert len(batches) > 1
+        assert sum(len(x) for x in batches) == 250
+        records = [b.get_record(i) for b in batches for i in range(len(b))]
+        for this, read in zip(records, expected):
+            assert this['sequence'].decode() == read.sequence
+            assert this['quality'].decode() == read.quality
+            assert this['identifier'].split()[0].decode() == "@" + read.name
+        assert batches[0].lengths[0] == len(expected[0].sequence)
+
+
+def test_next_invalid(tmpdir):
+    # parse errors are not turned into the end of the iteration
+    import pytest
+    lines = open(data).read().splitlines(True)
+    filename = str(tmpdir.join("truncated.fastq"))
+    with open(filename, "w") as fout:
+        fout.write("".join(lines[0:10]))
+    f = fastq.FastQ(filename)
+    with pytest.raises(ValueError):
+        [read for read in f]
+
+    with open(filename, "w") as fout:
+        fout.write("".join(lines[0:4] + lines[5:]))
+    with pytest.raises(ValueError):
+        fastq.FastQ(filename).next()
+
+
+def test_fastqc_stats():
+    from sequana.fastq import FastQBlockReader, FastQCStats
+    stats = FastQCStats(max_sample=100, tiles=True)
+    for batch in FastQBlockReader(data, block_size=5000):
+        stats.update(batch)
+    assert stats.n_reads == 250
+    assert stats.n_sampled == 100
+    assert stats.to_dict()['A'] == 6952
+    assert stats.total_bp == 6952 + 6400 + 6129 + 5768 + stats.base_counts[4]
+    mean, std = stats.get_quality_per_position()
+    assert len(mean) == stats.max_length
+    assert len(stats.get_tile_quality()) > 0
+    df = stats.get_acgt_content()
+    assert abs(df.sum(axis=1) - 1).max() < 1e-6
+
+
+def test_fastqc_jobs():
+    from sequana.fastq import get_fastq_shards, fastqc_batch, FastQBlockReader
+    names = [x.identifiers for x in FastQBlockReader(data)]
+    shards = get_fastq_shards(data, 3)
+    assert len(shards) == 3
+    shard_names = []
+    for start, end in shards:
+        for batch in FastQBlockReader(data, start=start, end=end):
+            shard_names.extend(batch.identifiers)
+    # shards cover all reads, in order
+    assert shard_names == [x for batch in names for x in batch]
+    assert len(shard_names) == 250
+
+    qc1 = fastq.FastQC(data, max_sample=100, verbose=False)
+    qc2 = fastq.FastQC(data, max_sample=100, verbose=False, jobs=2)
+    cols = ["n_reads", "A", "C", "G", "T", "GC content", "mean quality"]
+    assert np.allclose(qc1.get_stats()[cols].values, qc2.get_stats()[cols].values)
+    assert qc1.fastqc_stats.n_sampled == qc2.fastqc_stats.n_sampled
+
+    qc1, qc2 = fastqc_batch([data, data], jobs=2)
+    assert qc1.fastqc_stats.n_reads == 250
+    stats = qc1.fastqc_stats.merge(qc2.fastqc_stats)
+    assert stats.n_reads == 500
+    assert stats.n_sampled == 500
+
+
+def test_fastqc_empty(tmpdir):
+    from sequana.fastq import fastqc_batch
+    filename = str(tmpdir.join("empty.fastq"))
+    open(filename, "w").close()
+    qc, = fastqc_batch([filename])
+    assert qc.N == 0
+    assert qc.minimum == 0 and qc.maximum == 0
+    assert qc.get_stats()["n_reads"][0] == 0
+
+
+def test_fastqc_sample(tmpdir, monkeypatch):
+    from sequana import tools
+    from sequana.cache import StatsCache
+    monkeypatch.setattr(tools, "_get_counts_cache",
+        lambda: StatsCache(str(tmpdir)))
+    # full=False stops after max_sample reads; N is then estimated
+    qc = fastq.FastQC(data, max_sample=100, verbose=False, full=False)
+    assert 150 < qc.N < 350
+    assert qc.N_exact is False
+    assert qc.fastqc_stats.n_reads == 100
+    assert qc.get_stats()["n_reads exact"][0] == False
+
+    qc = fastq.FastQC(data, max_sample=100, verbose=False, full=False, exact=True)
+    assert qc.N == 250
+    assert qc.N_exact
+
+    # all reads were sampled: the count is exact
+    qc = fastq.FastQC(data, max_sample=250, verbose=False, full=False)
+    assert qc.N == 250
+    assert qc.N_exact
+
+    # file smaller than max_sample: count is exact
+    qc = fastq.FastQC(data, verbose=False, full=False)
+    assert qc.N == 250
+    assert qc.N_exact
+
+
+def test_fastq_index(tmpdir):
+    import shutil
+    import pysam
+    from sequana.fastq import FastQIndex, FastQBlockReader
+    identifiers = next(iter(FastQBlockReader(data))).identifiers
+
+    filename = str(tmpdir.join("test.fastq"))
+    shutil.copy(data, filename)
+    bgzf = str(tmpdir.join("test.fastq.gz"))
+    pysam.tabix_compress(data, bgzf)
+
+    for this in [filename, bgzf]:
+        index = FastQIndex(this, step=7, names=True)
+        assert len(index) == 250
+        assert index.read(8)["identifier"] == identifiers[8]
+        assert index.get_record_number(identifiers[100]) == 100
+        # cached index
+        assert os.path.exists(this + ".fqi")
+        assert FastQIndex(this, step=7).read(249)["identifier"] == identifiers[-1]
+
+        f = fastq.FastQ(this)
+        assert f[0]["identifier"] == identifiers[0]
+        assert f[-1]["identifier"] == identifiers[-1]
+        assert list(f[10:20].identifiers) == list(identifiers[10:20])
+        assert f[identifiers[42]]["identifier"] == identifiers[42]
+
+    # not a BGZF file
+    try:
+        FastQIndex(datagz)
+        assert False
+    except ValueError:
+        assert True
+
+
+def test_duplicates():
+    from sequana.fastq import FastQBlockReader, DuplicateEstimator
+    # the same file twice (196 distinct reads, first 50 bases only)
+    dups = DuplicateEstimator(ntop=5)
+    for batch in FastQBlockReader(data):
+        dups.update(batch)
+    other = fastq.estimate_duplicates(data, ntop=5)
+    dups.merge(other)
+    assert dups.n_reads == 500
+    assert abs(dups.distinct - 196) < 5
+    df = dups.get_overrepresented()
+    assert len(df) == 5
+    assert (df["count"] >= 2).all()
+
+    # pairs of identical files
+    dups = fastq.estimate_duplicates(data, data)
+    assert dups.n_reads == 250
+    assert "sequence2" in dups.get_overrepresented().columns
+
+    qc = fastq.FastQC(data, verbose=False)
+    assert abs(qc.get_stats()["duplicate rate"][0] - 54 / 250.) < 0.02
+    qc.get_overrepresented_sequences()
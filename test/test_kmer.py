@@ -19,3 +19,35 @@ def test_get_kmer():
     res = list(get_kmer('ACGTAAAA', k=4))
     assert res == ['ACGT', 'CGTA', 'GTAA', 'TAAA', 'AAAA']
 
+
+
+def test_kmer_counter():
+    from sequana.kmer import KmerCounter, encode_kmers, decode_kmers
+    kmers = encode_kmers(['ACGTAAAA', 'NACGT'], k=4)
+    assert decode_kmers(kmers, k=4) == ['ACGT', 'CGTA', 'GTAA', 'TAAA', 'AAAA',
+        'ACGT']
+
+    counter = KmerCounter(k=4)
+    counter.update(['ACGTAAAA', 'NACGT'])
+    assert counter.get_top(1).to_dict() == {'ACGT': 2}
+    assert counter.total == 6
+    assert counter.get_spectrum().to_dict() == {1: 4, 2: 1}
+
+    # TTTT is the reverse complement of AAAA
+    counter = KmerCounter(k=4, canonical=True)
+    counter.update(['AAAA', 'TTTT'])
+    assert counter.to_series().to_dict() == {'AAAA': 2}
+
+    other = KmerCounter(k=4, canonical=True)
+    other.update(['AAAAC'])
+    counter.merge(other)
+    assert counter.to_series().to_dict() == {'AAAA': 3, 'AAAC': 1}
+
+
+def test_kmer_profiles():
+    from sequana.kmer import get_kmer_profiles
+    from sequana import sequana_data
+    data = sequana_data("test.fastq", "testing")
+    df = get_kmer_profiles([data], k=3, max_reads=100)
+    assert df.shape == (32, 1)
+    assert abs(df.sum().sum() - 1) < 1e-6
@@ -70,6 +70,16 @@ def test_pacbio_random():
             reference_length=10000)
 
 
+def test_pacbio_cache(tmpdir):
+    filename = sequana_data("test_pacbio_subreads.bam")
+    directory = str(tmpdir.join("cache"))
+    df = PacbioSubreads(filename, cache=directory).df
+    b = PacbioSubreads(filename, cache=directory)
+    assert b._load_df() is not None
+    assert (b.df.read_length == df.read_length).all()
+    assert (b.df.ZMW == df.ZMW).all()
+
+
 def test_bamsim():
     filename = sequana_data("test_pacbio_subreads.bam")
     b = BAMSimul(filename)
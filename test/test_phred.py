@@ -50,3 +50,44 @@ def test_others():
     # inverse here
     assert phred.quality_sanger_to_quality_solexa(64) < 64
     assert phred.quality_sanger_to_quality_solexa(64) > 63.99
+
+
+def test_vectorised():
+    import numpy as np
+    assert list(phred.to_scores(b"II5")) == [40, 40, 20]
+    assert list(phred.to_scores("II5")) == [40, 40, 20]
+    assert phred.detect_offset(b"II5!!") == 33
+    assert phred.detect_offset(b"hhT") == 64
+
+    buf, offsets = phred.concatenate([b"II5", b"", b"+5"])
+    mq = phred.mean_quality(buf, offsets)
+    assert abs(mq[0] - 100 / 3.) < 1e-6
+    assert np.isnan(mq[1])
+    assert mq[2] == 15
+    assert list(phred.min_quality(buf, offsets)) == [20, -1, 10]
+
+    ee = phred.expected_errors(buf, offsets)
+    assert abs(ee[0] - (2e-4 + 1e-2)) < 1e-9
+    assert ee[1] == 0
+    assert abs(ee[2] - 0.11) < 1e-9
+
+    counts = phred.quality_per_position(buf, offsets)
+    assert counts[0, 40] == 1 and counts[0, 10] == 1
+    assert counts[2, 20] == 1
+    assert counts.sum() == 5
+
+
+def test_mean_quality_loop():
+    # the vectorised conversion gives the per-character results
+    import numpy as np
+    qualities = [b"BCCFFFFFHHHHHIIJJJJJJIIJJJJJJJJFH" * 3, b"II5", b"+"] * 100
+    expected = [np.mean([x - 33 for x in q]) for q in qualities]
+    buf, offsets = phred.concatenate(qualities)
+    assert np.allclose(phred.mean_quality(buf, offsets), expected)
+
+
+def test_solexa():
+    q = phred.QualitySolexa(";;@@")
+    assert list(q.quality) == [-5, -5, 0, 0]
+    assert q.mean_quality == -2.5
+    assert list(phred.Quality(b"II5").quality) == [40, 40, 20]
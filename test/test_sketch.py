@@ -0,0 +1,50 @@
+from sequana.sketch import hash_sequences, combine_hashes
+from sequana.sketch import HyperLogLog, CountMinSketch
+
+
+def test_hash_sequences():
+    hashes = hash_sequences([b"ACGT", "ACGT", b"ACGA", b"", b"ACGTT"])
+    assert hashes[0] == hashes[1]
+    assert len(set(hashes)) == 4
+    # only the first bases are used
+    hashes = hash_sequences([b"ACGTA", b"ACGTT", b"ACGT"], length=4)
+    assert len(set(hashes)) == 1
+    assert len(hash_sequences([])) == 0
+
+    h1 = hash_sequences([b"AAAA", b"CCCC"])
+    assert combine_hashes(h1[0:1], h1[1:2]) != combine_hashes(h1[1:2], h1[0:1])
+
+
+def test_hyperloglog():
+    hashes = hash_sequences(["%s" % i for i in range(20000)])
+    hll = HyperLogLog()
+    hll.update(hashes)
+    hll.update(hashes[0:1000])
+    assert abs(hll.cardinality / 20000. - 1) < 0.05
+
+    hll1, hll2 = HyperLogLog(), HyperLogLog()
+    hll1.update(hashes[0:10000])
+    hll2.update(hashes[10000:])
+    assert len(hll1.merge(hll2)) == len(hll)
+
+    try:
+        hll1.merge(HyperLogLog(p=10))
+        assert False
+    except ValueError:
+        assert True
+
+
+def test_countminsketch():
+    hashes = hash_sequences(["%s" % i for i in range(10000)])
+    cms = CountMinSketch(width=2**10)
+    cms.update(hashes)
+    cms.update(hashes[0:10])
+    counts = cms.query(hashes)
+    assert (counts[0:10] >= 2).all()
+    assert (counts >= 1).all()
+    assert cms.total == 10010
+
+    other = CountMinSketch(width=2**10)
+    other.update(hashes[0:10])
+    cms.merge(other)
+    assert (cms.query(hashes[0:10]) >= 3).all()
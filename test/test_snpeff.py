@@ -4,7 +4,9 @@ from easydev import TempFile
 import os
 
 
-def test_snpeff():
+def test_snpeff(tmpdir, monkeypatch):
+    # snpEff files are created in the working directory
+    monkeypatch.chdir(tmpdir)
     # a custom refrence
     fh_log = TempFile()
 
@@ -52,7 +54,8 @@ def test_snpeff_download():
             assert False
 
 
-def test_add_locus_no_modification():
+def test_add_locus_no_modification(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
     mydata = snpeff.SnpEff(reference=sequana_data("JB409847.gbk"))
     with TempFile() as fh:
         fastafile = sequana_data("JB409847.fasta")
@@ -64,8 +67,8 @@ def test_add_locus_no_modification():
             pass
 
 
-def test_add_locus_with_modification():
-
+def test_add_locus_with_modification(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
     # Alter the original GBK to alter the locus name
     data = open(sequana_data("JB409847.gbk"), "r").read()
     newdata = data.replace("JB409847", "DUMMY_JB409847")
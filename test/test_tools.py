@@ -3,14 +3,33 @@ from sequana import sequana_data
 from sequana.tools import bam_get_paired_distance, GZLineCounter, PairedFastQ
 
 
-def test_StatsBAM2Mapped():
+def test_StatsBAM2Mapped(tmpdir):
     data = sequana_data("test.bam", "testing")
-    res = StatsBAM2Mapped(data)
+    res = StatsBAM2Mapped(data, wkdir=str(tmpdir))
 
 
-def test_bam2fastq():
+def test_bam2fastq(tmpdir):
     data = sequana_data("test.bam", "testing")
-    res = bam_to_mapped_unmapped_fastq(data)
+    res = bam_to_mapped_unmapped_fastq(data, output_directory=str(tmpdir))
+
+
+def test_bam2fastq_compressed(tmpdir):
+    import gzip
+    import shutil
+    data = str(tmpdir.join("test_measles.bam"))
+    shutil.copy(sequana_data("test_measles.bam", "testing"), data)
+    res = bam_to_mapped_unmapped_fastq(data, verbose=False, compress=True,
+        chunksize=7, window=4)
+    assert res['R1_mapped'] == res['R2_mapped'] == 24
+    assert res['R1_unmapped'] == res['R2_unmapped'] == 6
+    # mates are written in the same order
+    for key in ["mapped", "unmapped"]:
+        names = []
+        for read in ["R1", "R2"]:
+            filename = str(tmpdir.join("test_measles_%s_.%s.fastq.gz" % (read, key)))
+            lines = gzip.open(filename, "rt").read().split("\n")
+            names.append([x[:-2] for x in lines[0::4] if x])
+        assert names[0] == names[1]
 
 
 
@@ -26,6 +45,13 @@ def test_reverse():
 def test_distance():
     data = sequana_data("test.bam", "testing")
     distances = bam_get_paired_distance(data)
+    assert len(distances) == 13
+    assert all(x[2] in (1, 2) for x in distances)
+    # the file does not need to be sorted by names
+    data = sequana_data("measles.fa.sorted.bam")
+    assert len(bam_get_paired_distance(data)) == 1308
+    # pairs whose mate waited too long are dropped (bounded table)
+    assert len(bam_get_paired_distance(data, chunksize=100, max_pending=10)) < 1308
 
 
 def test_gc_content():
@@ -42,3 +68,75 @@ def test_paired_file():
     f2 = sequana_data("test.fastq.gz")
 
     assert PairedFastQ(f1,f2).is_synchronised()
+
+
+def test_paired_file_repair(tmpdir, monkeypatch):
+    from sequana import FastQ
+    data = sequana_data("test.fastq", "testing")
+    lines = open(data).read().splitlines(True)
+    reads = ["".join(lines[i:i+4]) for i in range(0, len(lines), 4)]
+    f1 = tmpdir.join("R1.fastq")
+    f1.write("".join(reads))
+    # two missing reads in R2
+    f2 = tmpdir.join("R2.fastq")
+    f2.write("".join(reads[0:10] + reads[11:100] + reads[101:]))
+
+    pfq = PairedFastQ(str(f1), str(f2))
+    assert pfq.is_synchronised() is False
+    report = pfq.check()
+    assert report["first_desync"] == 10
+    assert report["n_reads2"] == 248
+
+    o1, o2 = str(tmpdir.join("o1.fastq")), str(tmpdir.join("o2.fastq.gz"))
+    singletons = str(tmpdir.join("singletons.fastq"))
+    report = pfq.repair(o1, o2, singletons=singletons)
+    assert report == {"n_pairs": 248, "n_singletons1": 2, "n_singletons2": 0,
+        "n_duplicates1": 0, "n_duplicates2": 0}
+    assert PairedFastQ(o1, o2).is_synchronised()
+    assert len(FastQ(singletons)) == 2
+
+    # shuffled R2 with a duplicated read
+    f2.write("".join(reads[100:] + reads[0:10] + reads[11:100] + reads[5:6]))
+    report = pfq.repair(o1, o2, singletons=singletons)
+    expected = {"n_pairs": 249, "n_singletons1": 1, "n_singletons2": 1,
+        "n_duplicates1": 0, "n_duplicates2": 1}
+    assert report == expected
+    assert PairedFastQ(o1, o2).is_synchronised()
+    assert len(FastQ(singletons)) == 2
+
+    # small batches: mates are found in previous batches
+    from sequana.fastq import FastQBlockReader, _zip_batches
+    monkeypatch.setattr(pfq, "_get_batches", lambda: _zip_batches(
+        FastQBlockReader(str(f1), block_size=1000),
+        FastQBlockReader(str(f2), block_size=1000), strict=False))
+    # the duplicate is read after its first occurrence was paired: it is
+    # a singleton but is not counted as a duplicate
+    expected["n_duplicates2"] = 0
+    assert pfq.repair(o1, o2, singletons=singletons) == expected
+    assert PairedFastQ(o1, o2).is_synchronised()
+    report = pfq.repair(o1, o2, window=10)
+    assert report["n_pairs"] < 249
+    assert report["n_pairs"] + report["n_singletons1"] == 250
+
+
+def test_count_lines(tmpdir, monkeypatch):
+    import pysam
+    from sequana import tools
+    from sequana.cache import StatsCache
+    from sequana.tools import count_lines
+    cache = StatsCache(str(tmpdir.join("cache")))
+    monkeypatch.setattr(tools, "_get_counts_cache", lambda: cache)
+    data = sequana_data("test.fastq", "testing")
+    assert count_lines(data) == 1000
+    assert count_lines(sequana_data("test.fastq.gz")) == 1000
+
+    # BGZF files are multi-member gzip files that can be split
+    bgzf = str(tmpdir.join("test.fastq.gz"))
+    pysam.tabix_compress(data, bgzf, force=True)
+    assert count_lines(bgzf, jobs=2) == 1000
+    assert len(GZLineCounter(bgzf, jobs=2)) == 1000
+    # second call uses the cache
+    assert count_lines(bgzf, cache=True) == 1000
+    assert int(cache.get(bgzf, "line_count")["count"]) == 1000
+    cache.set(bgzf, "line_count", {"count": 4})
+    assert count_lines(bgzf, cache=True) == 4